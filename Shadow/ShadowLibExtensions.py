@@ -5,6 +5,7 @@
 # It also define GeometricSource and Beamline
 #
 import Shadow.ShadowLib as ShadowLib
+import Shadow.beamfile as beamfile
 import numpy
 import inspect
 import copy
@@ -19,10 +20,170 @@ class Beam(ShadowLib.Beam):
   def duplicate(self):
       beam_copy = Beam()
       beam_copy.rays = copy.deepcopy(self.rays)
+      if getattr(self,'_compacted',None) is not None:
+          beam_copy._compacted = copy.deepcopy(self._compacted)
       return beam_copy
 
+  def set_dtype(self,dtype):
+      """
+      sets the storage of the rays: numpy.float64 (default) or numpy.float32, which halves the
+      memory of the beam. The kernel always works in double precision: float32 rays are traced
+      in chunks of TRACE_CHUNK_SIZE rays converted to float64 and back (see traceOE), the other
+      methods work on them unchanged.
+
+      :param dtype: numpy.float32 or numpy.float64
+      :return: the beam
+      """
+      dtype = numpy.dtype(dtype)
+      if dtype not in (numpy.dtype(numpy.float32),numpy.dtype(numpy.float64)):
+          raise ValueError("set_dtype: the rays can be float32 or float64, not %s"%dtype)
+      if getattr(self,'rays',None) is not None and self.rays.dtype != dtype:
+          self.rays = numpy.ascontiguousarray(self.rays,dtype=dtype)
+      return self
+
+  def _single(self):
+      """
+      True if the rays are float32 (see set_dtype)
+      """
+      return getattr(self,'rays',None) is not None and self.rays.dtype == numpy.float32
+
+  def traceOE(self,oe,iCount,seed=0,stream=0,substream=0):
+      """
+      traces the rays through an oe (optional seed, stream, substream: random stream to use).
+      float32 rays (see set_dtype) are traced in chunks of TRACE_CHUNK_SIZE rays, with the setup
+      of the oe done once (as with OE.prepare), unless the oe writes files (FWRITE != 3).
+      """
+      if not self._single():
+          self._inMemory()
+          ShadowLib.Beam.traceOE(self,oe,iCount,seed,stream,substream)
+          return
+      dtype = self.rays.dtype
+      chunk = ShadowLib.Beam()
+      if oe.FWRITE != 3:
+          chunk.rays = self.rays.astype(numpy.float64)
+          ShadowLib.Beam.traceOE(chunk,oe,iCount,seed,stream,substream)
+          self.rays = chunk.rays.astype(dtype)
+          return
+      prepared = oe.prepared
+      oe.prepare()
+      try:
+          for i in range(0,self.rays.shape[0],TRACE_CHUNK_SIZE):
+              chunk.rays = self.rays[i:i+TRACE_CHUNK_SIZE].astype(numpy.float64)
+              # the next chunks continue the random stream of the first one
+              ShadowLib.Beam.traceOE(chunk,oe,iCount,seed if i == 0 else 0,stream,substream)
+              self.rays[i:i+TRACE_CHUNK_SIZE] = chunk.rays
+      finally:
+          oe.prepare(prepared)
+
+  def traceOEList(self,oe_list,iCount,verbose=1,seed=0,substream=0):
+      """
+      traces the rays through a list of oe's in a single kernel call (iCount of the first one;
+      optional verbose, seed, substream: oe i uses the random stream (seed,i,substream)).
+      float32 rays (see set_dtype) are traced oe by oe with traceOE.
+      """
+      if not self._single():
+          self._inMemory()
+          ShadowLib.Beam.traceOEList(self,oe_list,iCount,verbose,seed,substream)
+          return
+      for i,oe in enumerate(oe_list):
+          if verbose:
+              print(">> traceOEList: tracing surface %d"%(iCount+i))
+          self.traceOE(oe,iCount+i,seed,iCount+i,substream)
+
+  def write(self,file,ncol=18):
+      """
+      writes the rays in a SHADOW binary file with numpy (see Shadow.beamfile.write: float32 rays
+      are written as float64, more than 2**31-1 rays with the version 1 of the header)
+
+      :param file: file name
+      :param ncol: number of columns written: 18 (default), 13 or 12
+      """
+      if isinstance(file,bytes):
+          file = file.decode()
+      beamfile.write(file,self.rays,ncol)
+
+  def load(self,file,mmap=False):
+      """
+      loads the rays of a SHADOW binary file with numpy (see Shadow.beamfile.read)
+
+      :param file: file name
+      :param mmap: False: read the rays (default), True: map the file in memory read-only
+                   (a numpy.memmap view of the rays, see Shadow.beamfile.memmap) without reading
+                   it, 'c': map it copy-on-write (the changes of the rays are not written to the
+                   file). Only the pages used are read: the header, or a column, of a large file
+                   cost little. Files with 12 or 13 columns are always read.
+                   A mapped beam works unchanged with the methods that only read the rays
+                   (getshonecol, getshcol, intensity, nrays, histo1, histo2, get_good_range,
+                   get_standard_deviation, write, write_hdf5, duplicate). traceOE, traceOEList,
+                   traceCompoundOE, retrace and OE.trace first read the rays in memory: the beam
+                   is then no longer mapped, and the file is not changed.
+      """
+      if isinstance(file,bytes):
+          file = file.decode()
+      if mmap and beamfile.header(file)['ncol'] == 18:
+          self.rays = beamfile.memmap(file,'c' if mmap == 'c' else 'r')
+          return
+      self.rays = beamfile.read(file)
+
+  def write_hdf5(self,file,source=None,oes=None,chunk_rays=None,compression='gzip'):
+      """
+      writes the rays in an HDF5 file, column by column in compressed chunks, with the variables
+      of the source and the oe's (see Shadow.beamhdf5, needs h5py)
+
+      :param file: file name
+      :param source: Shadow.Source whose variables are stored (default: None)
+      :param oes: Shadow.CompoundOE or list of Shadow.OE whose variables are stored (default: None)
+      :param chunk_rays: number of rays per chunk (default: SOURCE_CHUNK_SIZE)
+      :param compression: 'gzip' (default), 'lzf' or None
+      """
+      import Shadow.beamhdf5 as beamhdf5
+      beamhdf5.write(file,self,source,oes,chunk_rays or SOURCE_CHUNK_SIZE,compression)
+
+  def load_hdf5(self,file,start=0,stop=None,workers=None):
+      """
+      loads the rays of an HDF5 file written by write_hdf5 or Shadow.beamhdf5.Writer
+
+      :param file: file name
+      :param start: first ray (starting from 0)
+      :param stop: end of the range of rays (default: None, up to the last ray)
+      :param workers: number of processes reading parts of the file at a time (default: None)
+      """
+      import Shadow.beamhdf5 as beamhdf5
+      self.rays = beamhdf5.load(file,start,stop,workers)
+
+  def _inMemory(self):
+      """
+      reads in memory the rays mapped from a file (see load), for the kernel
+      """
+      if isinstance(self.rays,numpy.memmap):
+          self.rays = numpy.array(self.rays,dtype=numpy.float64)
+
+  def genSource(self,src,seed=0,stream=0,substream=0,chunk_size=None,workers=None):
+      """
+      generates the rays of a source
+
+      :param src: the Shadow.Source
+      :param seed: if not zero, use the random stream (seed,stream,substream) from its start
+                   (default=0, continue the current stream, started from ISTAR1)
+      :param stream: random stream number
+      :param substream: random substream number
+      :param chunk_size: if set, generate the rays in independent chunks of chunk_size rays
+                         (see Source.genBeamChunks). The beam depends on ISTAR1 (or seed), stream
+                         and chunk_size only, not on the number of workers.
+      :param workers: number of threads generating chunks (default: None, in this thread).
+                      If set without chunk_size, chunks of SOURCE_CHUNK_SIZE rays are used.
+      """
+      if chunk_size is None and workers is None:
+          ShadowLib.Beam.genSource(self,src,seed,stream,substream)
+          return
+      if chunk_size is None:
+          chunk_size = SOURCE_CHUNK_SIZE
+      chunks = src.genBeamChunks(chunk_size,workers,seed=seed,stream=stream)
+      self.rays = numpy.concatenate([beam.rays for beam in chunks])
+
   def retrace(self,dist):
     try:
+      self._inMemory()
       tof = (-self.rays[:,1].flatten() + dist)/self.rays[:,4].flatten()
       self.rays[:,0] += tof*self.rays[:,3].flatten()
       self.rays[:,1] += tof*self.rays[:,4].flatten()
@@ -31,7 +192,8 @@ class Beam(ShadowLib.Beam):
       print ('retrace: No rays')
 
   def traceCompoundOE(self,compoundOE,from_oe=1,write_start_files=0,write_end_files=0,\
-                      write_star_files=0, write_mirr_files=0):
+                      write_star_files=0, write_mirr_files=0, workers=None, chunk_size=None, seed=0,\
+                      verbose=1, compact=0):
       """
       traces a compound optical element
 
@@ -50,8 +212,49 @@ class Beam(ShadowLib.Beam):
       :param write_end_files:  0=No (default), 1=Yes (all), 2: only first and last ones
       :param write_star_files:  0=No (default), 1=Yes (all), 2: only first and last ones
       :param write_mirr_files:  0=No (default), 1=Yes (all), 2: only first and last ones
-      :return: a new compoundOE with the list of the OE objects after tracing (the info of end.xx files)
+      :param workers: number of processes tracing blocks of rays (default: None, trace in this process;
+                      0 = one per cpu). The rays are independent, so the beam is split in blocks of
+                      chunk_size rays, each block is traced through the whole compoundOE in a
+                      separate process, and the blocks are put back in the original order.
+                      SHADOW writes no files in this mode (FWRITE=3) and write_*_files must be 0.
+      :param chunk_size: number of rays per block (default: the rays divided among the workers)
+      :param seed: seed of the random streams of the blocks: oe i traces block j with the random
+                   substream j of stream from_oe+i, so the result depends on seed and chunk_size,
+                   not on workers (default=0: a random seed)
+      :param verbose: 1=print a line for each oe traced (default), 0=silent
+      :param compact: 0=trace all the rays through all the oe's (default), 1=hand to each oe only the
+                      rays not lost (col10 >= 0) by the previous ones, and put back the full-size beam at
+                      the end, with the lost rays frozen as they were when lost, 2=as 1, but the beam
+                      keeps only the good rays (see uncompact to rebuild the full-size beam).
+                      The oe's are traced one by one (with seed, oe i uses the random stream
+                      (seed,from_oe+i,0) as in the single call). The good rays are those of compact=0,
+                      apart from optics consuming random numbers per ray; the lost rays keep the flag
+                      and position of the oe that lost them. Once all the rays are lost, the next oe's
+                      are not traced (they keep their values) and the full-size beam is returned,
+                      also with compact=2.
+      :return: with compact, a dictionary with the number of rays traced by each oe ('traced'), the
+               number of ray traces of the full trace ('full') and the time taken ('time'); None otherwise
       """
+      self._inMemory()
+      if compact:
+          if workers is not None or chunk_size is not None or \
+              write_start_files or write_end_files or write_star_files or write_mirr_files:
+              raise ValueError("traceCompoundOE: compact cannot be used with workers, chunk_size or write_*_files")
+          return self._traceCompoundOECompact(compoundOE,from_oe,seed,verbose,compact == 2)
+
+      if workers is not None or chunk_size is not None:
+          if write_start_files or write_end_files or write_star_files or write_mirr_files:
+              raise ValueError("traceCompoundOE: write_*_files cannot be used with workers or chunk_size")
+          # with no rays there is no block: the oe's are traced in this process
+          if self.rays.shape[0]:
+              self._traceCompoundOEChunks(compoundOE,from_oe,workers,chunk_size,seed)
+              return
+
+      # without files to write between the oe's, trace all of them in a single kernel call
+      if not (write_start_files or write_end_files or write_star_files or write_mirr_files):
+          self.traceOEList(compoundOE.list,from_oe,verbose)
+          return
+
       # oe_index = from_oe
       # oe_n = compoundOE.number_oe()
       # list = CompoundOE()
@@ -111,7 +314,8 @@ class Beam(ShadowLib.Beam):
 
       oe_n = len(compoundOE.list)
       for i in range(oe_n):
-          print("\nTracing compound oe %d from %d. Absolute oe number is: %d"%(i+1,oe_n,from_oe+i))
+          if verbose:
+              print("\nTracing compound oe %d from %d. Absolute oe number is: %d"%(i+1,oe_n,from_oe+i))
 
           #if wanted to write mirr.xx, tell SHADOW to do it
           if write_mirr_files == 1:
@@ -128,7 +332,7 @@ class Beam(ShadowLib.Beam):
 
 
 
-          self.traceOE( compoundOE.list[i], from_oe+1)
+          self.traceOE( compoundOE.list[i], from_oe+i)
 
           #dump star.xx files, if selected
           if write_star_files == 1:
@@ -145,6 +349,107 @@ class Beam(ShadowLib.Beam):
 
       return
 
+  def _traceCompoundOEChunks(self,compoundOE,from_oe,workers,chunk_size,seed):
+      """
+      traces a compound optical element splitting the rays in blocks traced by a pool of processes
+      (see traceCompoundOE)
+      """
+      from concurrent.futures import ProcessPoolExecutor
+      import multiprocessing
+
+      if not workers:
+          workers = multiprocessing.cpu_count()
+      npoint = self.rays.shape[0]
+      if chunk_size is None:
+          chunk_size = -(-npoint // workers)
+      chunk_size = max(1,int(chunk_size))
+      if seed == 0:
+          seed = _randomSeed()
+      oe_list = [oe.to_dictionary() for oe in compoundOE.list]
+      blocks = [self.rays[i:i+chunk_size] for i in range(0,npoint,chunk_size)]
+
+      with ProcessPoolExecutor(max_workers=workers) as executor:
+          results = list(executor.map(_traceCompoundOEChunk,[oe_list]*len(blocks),blocks,
+                                      [from_oe]*len(blocks),[seed]*len(blocks),range(len(blocks))))
+
+      self.rays = numpy.concatenate([rays.astype(self.rays.dtype,copy=False) for rays,oe_end in results])
+      # as in the sequential trace, the oe's keep the values after tracing (those of the last block)
+      for oe,oe_end in zip(compoundOE.list,results[-1][1]):
+          fwrite = oe.FWRITE
+          for name,value in oe_end.items():
+              setattr(oe,name,value)
+          oe.FWRITE = fwrite
+
+  def _traceCompoundOECompact(self,compoundOE,from_oe,seed,verbose,keep):
+      """
+      traces a compound optical element handing to each oe only the rays still good
+      (see traceCompoundOE with compact)
+      """
+      import time
+
+      t0 = time.time()
+      full,index = self._compactState()
+      rays = full[index]
+      traced = numpy.zeros(len(compoundOE.list),dtype=int)
+      for i,oe in enumerate(compoundOE.list):
+          good = _select(rays,1)
+          if not good.all():
+              # rays lost by the previous oe are frozen in the full-size beam
+              full[index[~good]] = rays[~good]
+              rays = rays[good]
+              index = index[good]
+          if not rays.shape[0]:
+              break
+          if verbose:
+              print("\nTracing compound oe %d from %d. Absolute oe number is: %d (%d rays)"%\
+                    (i+1,len(compoundOE.list),from_oe+i,rays.shape[0]))
+          beam = Beam()
+          beam.rays = numpy.ascontiguousarray(rays)
+          if seed != 0:
+              beam.traceOE(oe,from_oe+i,seed,from_oe+i,0)
+          else:
+              beam.traceOE(oe,from_oe+i)
+          rays = beam.rays
+          traced[i] = rays.shape[0]
+      full[index] = rays
+      good = _select(rays,1)
+      if keep and good.any():
+          self.rays = numpy.ascontiguousarray(rays[good])
+          self._compacted = (full,index[good])
+      else:
+          self.rays = full
+          self._compacted = None
+      result = {'traced':traced,
+                'full':full.shape[0]*len(traced),
+                'time':time.time()-t0}
+      if self._compacted is not None:
+          result['index'] = self._compacted[1]
+      if verbose:
+          print("traceCompoundOE: %d ray-oe traces instead of %d (%.2f s)"%\
+                (result['traced'].sum(),result['full'],result['time']))
+      return result
+
+  def _compactState(self):
+      """
+      returns the full-size rays and the index of the rays of the beam in them: those kept by
+      traceCompoundOE(compact=2), with the current rays put back, or the rays themselves
+      """
+      compacted = getattr(self,'_compacted',None)
+      if compacted is None:
+          return self.rays.copy(),numpy.arange(self.rays.shape[0])
+      full,index = compacted
+      full[index] = self.rays
+      return full,index
+
+  def uncompact(self):
+      """
+      rebuilds the full-size beam after traceCompoundOE(compact=2): the good rays go back to their
+      place among the lost ones, frozen where they were lost. Does nothing on a full-size beam.
+      """
+      full,index = self._compactState()
+      self.rays = full
+      self._compacted = None
+
   def get_standard_deviation(self,col, nolost=1, ref=0):
       '''
       returns the standard deviation of one viariable in the beam
@@ -265,14 +570,14 @@ class Beam(ShadowLib.Beam):
         return column.copy()
 
     if nolost == 1:
-        f  = numpy.where(ray[:,9] > 0.0)
+        f  = numpy.where(_select(ray,1))
         if len(f[0])==0:
             print ('getshonecol: no GOOD rays, returning empty array')
             return numpy.empty(0)
         return column[f].copy()
 
     if nolost == 2:
-        f  = numpy.where(ray[:,9] < 0.0)
+        f  = numpy.where(_select(ray,2))
         if len(f[0])==0:
             print ('getshonecol: no BAD rays, returning empty array')
             return numpy.empty(0)
@@ -629,7 +934,7 @@ class Beam(ShadowLib.Beam):
     else:
         weights = self.getshonecol(ref,nolost=nolost)
 
-    (hh,xx,yy) = numpy.histogram2d(col1, col2, bins=[nbins_h,nbins_v], range=[xrange,yrange], normed=False, weights=weights)
+    (hh,xx,yy) = numpy.histogram2d(col1, col2, bins=[nbins_h,nbins_v], range=[xrange,yrange], weights=weights)
 
     ticket['xrange'] = xrange
     ticket['yrange'] = yrange
@@ -680,10 +985,104 @@ class Beam(ShadowLib.Beam):
       ticket = self.histo2(*args,**kwargs)
       return(ticket)
 
+# default number of rays of the chunks of Beam.genSource
+SOURCE_CHUNK_SIZE = 100000
+
+# number of float32 rays converted to float64 at a time by Beam.traceOE
+TRACE_CHUNK_SIZE = 100000
+
+def _randomSeed():
+  """
+  returns a seed for the random streams, when none is given
+  """
+  return int(numpy.random.randint(1,2147483647))
+
+def _select(rays,nolost):
+  """
+  returns the mask of the rays selected by nolost: 0=all, 1=good (flag, col10, >= 0, as in
+  Beam.nrays), 2=lost (flag < 0)
+  """
+  if nolost == 1:
+    return rays[:,9] >= 0.0
+  if nolost == 2:
+    return rays[:,9] < 0.0
+  return numpy.ones(rays.shape[0],dtype=bool)
+
+def _genSourceChunk(src,seed,stream,index,first):
+  """
+  generates a chunk of rays starting at ray first, with the random substream index,
+  used by Source.genBeamChunks
+  """
+  beam = Beam()
+  beam.genSource(src,seed,stream,index)
+  beam.rays[:,11] += first
+  return beam
+
+
+def _traceCompoundOEChunk(oe_list,rays,from_oe,seed,index):
+  """
+  traces the block of rays index through a compound optical element given as a list of oe
+  dictionaries, used by the processes of Beam.traceCompoundOE. Returns the rays and the oe
+  dictionaries after tracing.
+  """
+  beam = Beam()
+  beam.rays = rays.astype(numpy.float64)
+  oes = []
+  for oe_dict in oe_list:
+    oe = OE()
+    for name,value in oe_dict.items():
+      setattr(oe,name,value)
+    oe.FWRITE = 3
+    oes.append(oe)
+  beam.traceOEList(oes,from_oe,0,seed,index)
+  return beam.rays,[oe.to_dictionary() for oe in oes]
+
+
+def _scanPoint(rays,oe,icount,seed,index,stats,cols,nbins):
+  """
+  traces a copy of rays through oe (the variant number index made by OE.scan) with the random
+  stream (seed,icount,index) and returns the statistics of the result, used by the threads of
+  OE.scan
+  """
+  beam = Beam()
+  beam.rays = rays.copy()
+  beam.traceOE(oe,icount,seed,icount,index)
+  result = {'good':beam.nrays(nolost=1),'intensity':beam.intensity(nolost=1)}
+  for stat in ('fwhm','centroid','std'):
+    if stat in stats:
+      result[stat] = numpy.zeros(len(cols))*numpy.nan
+  if not result['good']:
+    return result
+  weights = beam.getshonecol(23,nolost=1)
+  if not weights.sum():
+    weights = None
+  for i,col in enumerate(cols):
+    column = beam.getshonecol(col,nolost=1)
+    centroid = numpy.average(column,weights=weights)
+    if 'centroid' in stats:
+      result['centroid'][i] = centroid
+    if 'std' in stats:
+      result['std'][i] = numpy.sqrt(numpy.average((column-centroid)**2,weights=weights))
+    if 'fwhm' in stats:
+      fwhm = beam.histo1(col,nbins=nbins,nolost=1,ref=23)['fwhm']
+      if fwhm is not None:
+        result['fwhm'][i] = fwhm
+  return result
+
+
 class OE(ShadowLib.OE):
   def __init__(self):
     ShadowLib.OE.__init__(self)
 
+  def trace(self,beam,iCount,seed=0,stream=0,substream=0):
+    """
+    traces the rays of beam through the oe (see Beam.traceOE). The rays of a beam mapped from
+    a file (see Beam.load) are read in memory first.
+    """
+    if isinstance(beam,Beam):
+      beam._inMemory()
+    return ShadowLib.OE.trace(self,beam,iCount,seed,stream,substream)
+
   # here methods to initialize the OE
 
   # renamed setScreens -> set_screens srio@esrf.eu
@@ -1064,6 +1463,97 @@ class OE(ShadowLib.OE):
         mydict[var[0]]= var[1]
     return(mydict)
 
+  def load_tables(self,pin=1):
+    """
+    reads the reflectivity, refraction index, surface error and screen files used by the oe (prerefl,
+    pre_mlayer, bragg, presurface and external polygon files) in the table cache of the kernel, so they are read
+    once for all the traces of the process (see ShadowLib.loadTable)
+    :param pin: 1 to keep them in the cache until ShadowLib.clearTables
+    :return: a list with the (kind,file) of the tables
+    """
+    tables = []
+    if self.F_CRYSTAL == 1:
+      tables.append(('bragg',self.FILE_REFL))
+    elif self.F_REFLEC != 0 and self.F_REFL in (0,2):
+      tables.append(('prerefl' if self.F_REFL == 0 else 'pre_mlayer',self.FILE_REFL))
+    if self.F_REFRAC == 1 and self.F_CRYSTAL == 0:
+      if self.F_R_IND in (1,3):
+        tables.append(('prerefl',self.FILE_R_IND_OBJ))
+      if self.F_R_IND in (2,3):
+        tables.append(('prerefl',self.FILE_R_IND_IMA))
+    if self.F_RIPPLE == 1 and self.F_G_S == 2:
+      tables.append(('presurface',self.FILE_RIP))
+    if self.F_SCREEN == 1:
+      for i in range(self.N_SCREEN):
+        if self.I_ABS[i] == 1:
+          tables.append(('prerefl',self.FILE_ABS[i]))
+        if self.I_SLIT[i] == 1 and self.K_SLIT[i] == 2:
+          tables.append(('screen_external',self.FILE_SCR_EXT[i]))
+    for i,(kind,file) in enumerate(tables):
+      if isinstance(file,bytes):
+        file = file.decode()
+      tables[i] = (kind,file.strip())
+      ShadowLib.loadTable(kind,tables[i][1],pin)
+    return tables
+
+  def scan(self,beam,variants,stats=('intensity','fwhm','centroid'),workers=None,cols=(1,3),\
+           nbins=200,icount=1,seed=0):
+    """
+    traces beam through variants of the oe at the same time, in threads, and returns
+    statistics of each trace instead of the beams. Neither beam nor the oe are modified, and
+    nothing is written to files (FWRITE=3). For example, a tolerance scan of a mirror rotation
+    (with F_MOVE=1):
+
+        table = oe.scan(beam,{'X_ROT':numpy.linspace(-0.01,0.01,31)},stats=['fwhm'])
+        table['X_ROT'], table['fwhm'][:,0], table['fwhm'][:,1]
+
+    :param beam: the Shadow.Beam incident on the oe
+    :param variants: dictionary {attribute: values}, the oe is traced once for each combination
+                     of the values of the attributes (in the order of the keys, the last one
+                     varying fastest)
+    :param stats: list with the statistics of the good rays to compute: 'good' (number of rays),
+                  'intensity', and 'fwhm', 'centroid' and 'std' of the columns cols (the last
+                  two weighted with the intensity)
+    :param workers: number of threads (default: None, one per cpu). The traces run at the same
+                    time if the kernel is reentrant (see ShadowLib.isReentrant).
+    :param cols: columns of fwhm, centroid and std (default: 1 and 3, x and z)
+    :param nbins: number of bins of the histograms for the fwhm (see Beam.histo1)
+    :param icount: oe number
+    :param seed: seed of the random streams (default=0: a random seed). Variant i uses the random
+                 stream (seed,icount,i), so the result with a given seed does not depend on the
+                 workers or on the order the threads run in.
+    :return: a dictionary of numpy arrays with a row per variant: the value of each attribute and
+             each statistic in stats (fwhm, centroid and std with a column per col)
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    import itertools
+    import multiprocessing
+
+    for stat in stats:
+      if stat not in ('good','intensity','fwhm','centroid','std'):
+        raise ValueError("scan: unknown statistic: %s"%stat)
+    names = list(variants.keys())
+    points = list(itertools.product(*[variants[name] for name in names]))
+    oes = []
+    for point in points:
+      oe = self.duplicate()
+      for name,value in zip(names,point):
+        setattr(oe,name,value)
+      oe.FWRITE = 3
+      oes.append(oe)
+    if seed == 0:
+      seed = _randomSeed()
+    with ThreadPoolExecutor(max_workers=workers or multiprocessing.cpu_count()) as executor:
+      results = list(executor.map(_scanPoint,[beam.rays]*len(oes),oes,[icount]*len(oes),
+                                  [seed]*len(oes),range(len(oes)),
+                                  [stats]*len(oes),[cols]*len(oes),[nbins]*len(oes)))
+    table = {}
+    for i,name in enumerate(names):
+      table[name] = numpy.array([point[i] for point in points])
+    for stat in stats:
+      table[stat] = numpy.array([result[stat] for result in results])
+    return table
+
   # def duplicate(self):
   #   oe_new = OE()
   #   mem = inspect.getmembers(self)
@@ -1744,6 +2234,20 @@ class CompoundOE():
       return new_coe
 
 
+  def load_tables(self,pin=1):
+      """
+      Reads the reflectivity, refraction index and surface error files of all the optical elements
+      once for all the traces of the process (see OE.load_tables)
+      :param pin: 1 to keep them in the cache until ShadowLib.clearTables
+      :return: a list with the (kind,file) of the tables
+      """
+      tables = []
+      for oe in self.list:
+          for table in oe.load_tables(pin):
+              if table not in tables:
+                  tables.append(table)
+      return tables
+
   def add_drift_space_downstream(self,dd):
       """
       Adds empty space to the last element of the compound oe
@@ -2384,6 +2888,48 @@ class Source(ShadowLib.Source):
             setattr(src_new,var[0],var[1])
         return(src_new)
 
+    def genBeamChunks(self,chunk_size=SOURCE_CHUNK_SIZE,workers=None,seed=0,stream=0):
+        """
+        generates the NPOINT rays of the source in chunks of chunk_size rays (the last one may be
+        shorter). Chunk number i is generated with the random substream i of (seed,stream), so
+        the concatenated chunks are the same whether they are generated lazily or by several
+        threads. Only random sources (FGRID=0) can be chunked.
+        :param chunk_size: number of rays per chunk
+        :param workers: number of threads generating the chunks ahead (default: None, each
+                        chunk is generated when it is requested)
+        :param seed: seed of the random streams (default=0: ISTAR1, or a random seed if ISTAR1=0)
+        :param stream: random stream number
+        :return: iterator over Shadow.Beam instances, in ray order
+        """
+        if self.FGRID != 0:
+            raise ValueError("genBeamChunks: only random sources (FGRID=0) can be generated in chunks")
+        npoint = self.NPOINT
+        if seed == 0:
+            seed = self.ISTAR1
+        if seed == 0:
+            seed = _randomSeed()
+
+        def chunk_args():
+            for index,first in enumerate(range(0,npoint,chunk_size)):
+                src = self.duplicate()
+                src.NPOINT = min(chunk_size,npoint-first)
+                yield src,seed,stream,index,first
+
+        if not workers:
+            for args in chunk_args():
+                yield _genSourceChunk(*args)
+            return
+        from concurrent.futures import ThreadPoolExecutor
+        import collections
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = collections.deque()
+            for args in chunk_args():
+                pending.append(executor.submit(_genSourceChunk,*args))
+                if len(pending) > 2*workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
     #Gaussian source
     def set_divergence_gauss(self, sigmaxp, sigmazp):
         """
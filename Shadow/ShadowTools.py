@@ -84,7 +84,7 @@ def getshonecol(beam,col):
     ray = beam.rays
   else:
     bm = sd.Beam()
-    bm.load(beam)
+    bm.load(beam,mmap=True)
     ray = bm.rays
   if col>=0 and col<18 and col!=10:  column =  ray[:,col]
   if col==10: column =  ray[:,col]/A2EV
@@ -180,7 +180,7 @@ def getshcol(beam,col):
     bm = beam
   else:
     bm = sd.Beam()
-    bm.load(beam)  
+    bm.load(beam,mmap=True)
   ret = []
   if isinstance(col, int): return getshonecol(bm,col)
   for c in col:
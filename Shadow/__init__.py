@@ -6,6 +6,14 @@
 from __future__ import print_function
 #from Shadow import ShadowLib
 from Shadow.ShadowLibExtensions import OE, Source, Beam, CompoundOE 
+# distributed tracing (replaces trace3mpi)
+import Shadow.parallel as parallel
+# bounded-memory tracing with accumulators
+import Shadow.streaming as streaming
+from Shadow.streaming import stream
+# beam files read and written with numpy
+import Shadow.beamfile as beamfile
+from Shadow.beamfile import read_columns
 
 # Defined in C, not used at main level
 #from Shadow.ShadowLib import saveBeam, FastCDFfromZeroIndex, FastCDFfromOneIndex, FastCDFfromTwoIndex
@@ -14,6 +22,7 @@ from Shadow.ShadowLibExtensions import OE, Source, Beam, CompoundOE
 # import optional packages: 
 #     ShadowTools: graphic application (plotxy, etc)
 #     ShadowPreprocessorsXraylib: preprocessors (bragg, etc) using Xraylib
+#     beamhdf5: beams in HDF5 files (h5py)
 #     ShadowSrw: Srw+Shadow binding
 #
 import sys
@@ -27,6 +36,11 @@ try:
 except ImportError:
     print(sys.exc_info()[1]) 
     pass
+try:
+    import Shadow.beamhdf5 as beamhdf5
+except ImportError:
+    print(sys.exc_info()[1])
+    pass
 try:
     import Shadow.ShadowSrw as ShadowSrw
 except:
@@ -0,0 +1,174 @@
+"""
+Access to the SHADOW binary beam files (begin.dat, star.xx, mirr.xx, screen.xxyy) from numpy,
+without the Fortran i/o of the kernel: the files are read and written by plain numpy calls on
+the files given, so several threads can use them at a time.
+
+The files are Fortran unformatted sequential files: each record is framed by two 4-byte
+markers with its length in bytes. The first record holds three 4-byte integers (NCOL, the
+number of columns, 12, 13 or 18, NPOINT, the number of rays, and IFLAG, always 0), each of
+the next NPOINT records holds the NCOL float64 values of a ray. The byte order is that of the
+machine that wrote the file, found from the first marker.
+
+NPOINT does not hold more than 2**31-1 rays. Larger beams are written with the version 1 of
+the first record, 24 bytes long: NCOL, NPOINT=-1, IFLAG, VERSION=1 (4-byte integers) and the
+number of rays as an 8-byte integer. Only this module reads them: Beam.load always uses it,
+and the kernel readers (beamGetDim, ShadowLib.Beam.load) reject NPOINT=-1 with a message.
+"""
+from __future__ import print_function
+import os
+import numpy
+
+# length of the first record: NCOL, NPOINT, IFLAG
+HEADER_LENGTH = 12
+
+# length of the first record of version 1: NCOL, -1, IFLAG, VERSION, NPOINT (8 bytes)
+HEADER_LENGTH_V1 = 24
+
+# rays read or written at a time by read and write
+BLOCK_RAYS = 100000
+
+def header(file):
+    """
+    reads the first record of a beam file
+    :param file: file name
+    :return: a dictionary with 'ncol', 'npoint', 'iflag', 'version' (0, or 1 for more than
+             2**31-1 rays), 'byteorder' ('<' or '>'), 'offset' (position of the first ray record)
+             and 'record' (length of a ray record in the file, markers included)
+    """
+    with open(file,'rb') as f:
+        head = f.read(8+HEADER_LENGTH_V1)
+    byteorder = None
+    length = 0
+    if len(head) >= 8+HEADER_LENGTH:
+        for order in ('<','>'):
+            length = numpy.frombuffer(head,order+'i4',1)[0]
+            if length in (HEADER_LENGTH,HEADER_LENGTH_V1) and len(head) >= 8+length and \
+               numpy.frombuffer(head,order+'i4',1,4+length)[0] == length:
+                byteorder = order
+                break
+    if byteorder is None:
+        raise ValueError("header: not a SHADOW beam file: %s"%file)
+    ncol,npoint,iflag = [int(i) for i in numpy.frombuffer(head,byteorder+'i4',3,4)]
+    version = 0
+    if length == HEADER_LENGTH_V1:
+        version = int(numpy.frombuffer(head,byteorder+'i4',1,16)[0])
+        npoint = int(numpy.frombuffer(head,byteorder+'i8',1,20)[0])
+        if version != 1:
+            raise ValueError("header: unknown version %d of file: %s"%(version,file))
+    if ncol not in (12,13,18) or npoint < 0:
+        raise ValueError("header: wrong number of columns or rays (%d,%d) in file: %s"%(ncol,npoint,file))
+    result = {'ncol':ncol,'npoint':npoint,'iflag':iflag,'version':version,'byteorder':byteorder,
+              'offset':8+length,'record':8*ncol+8}
+    size = os.path.getsize(file)
+    if size < result['offset']+npoint*result['record']:
+        raise ValueError("header: file too short for %d rays of %d columns: %s"%(npoint,ncol,file))
+    return result
+
+def read(file,start=0,stop=None):
+    """
+    reads the rays of a beam file
+    :param file: file name
+    :param start: first ray (starting from 0)
+    :param stop: end of the range of rays (default: None, up to the last ray)
+    :return: a C contiguous (nrays,18) float64 array, as Beam.rays (the columns missing in a 12
+             or 13-column file are zero)
+    """
+    h = header(file)
+    start,stop,step = slice(start,stop).indices(h['npoint'])
+    stop = max(start,stop)
+    dtype = _recordDtype(h)
+    rays = numpy.zeros((stop-start,18))
+    with open(file,'rb') as f:
+        f.seek(h['offset']+start*h['record'])
+        for i in range(0,stop-start,BLOCK_RAYS):
+            records = numpy.fromfile(f,dtype=dtype,count=min(BLOCK_RAYS,stop-start-i))
+            if records.shape[0] != min(BLOCK_RAYS,stop-start-i) or \
+               (records['head'] != 8*h['ncol']).any() or (records['tail'] != 8*h['ncol']).any():
+                raise ValueError("read: wrong ray record in file: %s"%file)
+            rays[i:i+records.shape[0],:h['ncol']] = records['ray']
+    return rays
+
+def write(file,rays,ncol=18,version=None):
+    """
+    writes rays in a beam file, in the byte order of this machine
+    :param file: file name
+    :param rays: (nrays,18) array (Beam.rays, float64 or float32)
+    :param ncol: number of columns written: 18 (default), 13 or 12
+    :param version: version of the first record: None (default: 0, or 1 for more than 2**31-1
+                    rays), 0 or 1 (see the module documentation)
+    """
+    if ncol not in (12,13,18):
+        raise ValueError("write: the number of columns must be 12, 13 or 18, not %d"%ncol)
+    npoint = rays.shape[0]
+    if version is None:
+        version = 0 if npoint <= 2**31-1 else 1
+    if version == 0 and npoint > 2**31-1:
+        raise ValueError("write: %d rays need the version 1 of the file"%npoint)
+    if version == 0:
+        head = numpy.array([HEADER_LENGTH,ncol,npoint,0,HEADER_LENGTH],dtype=numpy.int32).tobytes()
+    elif version == 1:
+        head = numpy.array([HEADER_LENGTH_V1,ncol,-1,0,1],dtype=numpy.int32).tobytes()+ \
+               numpy.array([npoint],dtype=numpy.int64).tobytes()+ \
+               numpy.array([HEADER_LENGTH_V1],dtype=numpy.int32).tobytes()
+    else:
+        raise ValueError("write: unknown version %s"%version)
+    records = numpy.zeros(min(npoint,BLOCK_RAYS),dtype=_recordDtype({'byteorder':'=','ncol':ncol}))
+    records['head'] = records['tail'] = 8*ncol
+    with open(file,'wb') as f:
+        f.write(head)
+        for i in range(0,npoint,BLOCK_RAYS):
+            n = min(BLOCK_RAYS,npoint-i)
+            records['ray'][:n] = rays[i:i+n,:ncol]
+            records[:n].tofile(f)
+
+def _recordDtype(h):
+    """
+    returns the numpy dtype of a ray record of a file with header h
+    """
+    return numpy.dtype([('head',h['byteorder']+'i4'),('ray',h['byteorder']+'f8',(h['ncol'],)),
+                        ('tail',h['byteorder']+'i4')])
+
+def memmap(file,mode='r'):
+    """
+    maps the rays of a beam file in memory, without reading them
+    :param file: file name
+    :param mode: 'r' (read-only, default) or 'c' (copy-on-write: the rays can be changed, the
+                 changes stay in memory and are not written to the file)
+    :return: a numpy.memmap (npoint,ncol) view of the rays, in the file: its rows are not
+             contiguous (the record markers are between them)
+    """
+    if mode not in ('r','c'):
+        raise ValueError("memmap: mode must be 'r' or 'c', not %s"%mode)
+    h = header(file)
+    if h['npoint'] == 0:
+        return numpy.zeros((0,h['ncol']))
+    records = numpy.memmap(file,dtype=_recordDtype(h),mode=mode,offset=h['offset'],shape=(h['npoint'],))
+    if records['head'][0] != 8*h['ncol'] or records['tail'][-1] != 8*h['ncol']:
+        raise ValueError("memmap: wrong ray record in file: %s"%file)
+    return records['ray']
+
+def read_columns(file,cols,nolost=0,start=0,stop=None):
+    """
+    reads some columns of the rays of a beam file: the file is mapped (see memmap) and only the
+    columns asked for are computed in memory, the 18 columns of the rays are never read at once
+    :param file: file name
+    :param cols: a column or a list of columns (SHADOW convention, starting from 1, see
+                 Beam.getshonecol: the columns 19 to 33 are computed from the others)
+    :param nolost: 0=all rays (default), 1=good rays, 2=lost rays
+    :param start: first ray (starting from 0)
+    :param stop: end of the range of rays (default: None, up to the last ray). Only the part
+                 of the file with the rays start to stop-1 is read.
+    :return: a numpy array with the column, or a tuple of arrays for a list of columns
+    """
+    from Shadow.ShadowLibExtensions import Beam
+    rays = memmap(file)[start:stop]
+    if rays.shape[1] != 18:
+        # the columns missing in a 12 or 13-column file are zero, as in Beam.load
+        full = numpy.zeros((rays.shape[0],18))
+        full[:,:rays.shape[1]] = rays
+        rays = full
+    beam = Beam()
+    beam.rays = rays
+    if isinstance(cols,int):
+        return numpy.asarray(beam.getshonecol(cols,nolost=nolost))
+    return tuple([numpy.asarray(column) for column in beam.getshcol(cols,nolost=nolost)])
@@ -0,0 +1,223 @@
+"""
+Beams in HDF5 files (h5py), stored column by column in compressed chunks, with the parameters
+of the source and of the optical elements and the statistics of each chunk of rays.
+
+Layout of a file:
+
+    /rays/col01 .. /rays/col18   the 18 columns of the rays, float64 datasets of NPOINT values
+                                 in compressed chunks of chunk_rays values
+    /chunks/start, nrays, good,  a value per chunk written: its first ray, its ray counts, the
+           lost, skipped,        intensity of its good rays and the mean of its good rays and
+           intensity, mean, m2   the sum of their squared deviations from it for the
+                                 STATISTICS_COLUMNS (see Shadow.parallel.statistics)
+    /source                      attributes: the variables of the source (if given)
+    /oe01, /oe02, ..             attributes: the variables of the optical elements (if given)
+
+A range of rays is read without reading the rest of the file, and ranges can be read by
+several processes at a time (see load). The rays can be written chunk by chunk,
+as they are traced by Shadow.stream:
+
+    with Shadow.beamhdf5.Writer('star.h5',source=src,oes=[oe1,oe2]) as writer:
+        Shadow.stream(src,[oe1,oe2],total_rays=10**8,accumulators=[writer])
+    beam = Shadow.Beam()
+    beam.load_hdf5('star.h5',workers=4)
+"""
+from __future__ import print_function
+import numpy
+import h5py
+from Shadow.ShadowLibExtensions import Beam, OE, Source, SOURCE_CHUNK_SIZE
+from Shadow.parallel import STATISTICS_COLUMNS, statistics, _chunkSums
+
+# value of the attribute 'format' of the files, and version of the layout
+FORMAT = 'shadow3-beam'
+VERSION = 1
+
+class Writer(object):
+    """
+    writes the rays of a beam in an HDF5 file, chunk by chunk. It can be given to Shadow.stream
+    as an accumulator.
+    """
+    def __init__(self,file,source=None,oes=None,chunk_rays=SOURCE_CHUNK_SIZE,compression='gzip',
+                 compression_opts=4):
+        """
+        :param file: file name (an existing file is overwritten)
+        :param source: Shadow.Source whose variables are stored (default: None)
+        :param oes: Shadow.CompoundOE or list of Shadow.OE whose variables are stored (default: None)
+        :param chunk_rays: number of rays of the chunks of the datasets
+        :param compression: compression filter of h5py ('gzip', 'lzf' or None)
+        :param compression_opts: level of gzip (0 to 9)
+        """
+        self.file = h5py.File(file,'w')
+        self.file.attrs['format'] = FORMAT
+        self.file.attrs['version'] = VERSION
+        self.npoint = 0
+        self.sums = []
+        if compression != 'gzip':
+            compression_opts = None
+        rays = self.file.create_group('rays')
+        for col in range(1,19):
+            rays.create_dataset('col%02d'%col,shape=(0,),maxshape=(None,),dtype=numpy.float64,
+                                chunks=(max(1,int(chunk_rays)),),compression=compression,
+                                compression_opts=compression_opts,shuffle=compression is not None)
+        if source is not None:
+            _setAttributes(self.file.create_group('source'),source.to_dictionary())
+        if oes is not None:
+            if hasattr(oes,'list'):
+                oes = oes.list
+            for i,oe in enumerate(oes):
+                _setAttributes(self.file.create_group('oe%02d'%(i+1)),oe.to_dictionary())
+
+    def add(self,beam):
+        """
+        appends the rays of beam to the file
+        """
+        rays = beam.rays
+        n = rays.shape[0]
+        for col in range(1,19):
+            dataset = self.file['rays/col%02d'%col]
+            dataset.resize((self.npoint+n,))
+            dataset[self.npoint:] = rays[:,col-1]
+        sums = _chunkSums(beam)
+        sums['start'] = self.npoint
+        self.sums.append(sums)
+        self.npoint += n
+
+    def result(self):
+        """
+        writes the statistics of the chunks and closes the file
+        :return: the statistics of all the rays written (see Shadow.parallel.statistics)
+        """
+        if not self.file:
+            return statistics(self.sums)
+        chunks = self.file.create_group('chunks')
+        for key in ('start','nrays','good','lost','skipped'):
+            chunks.create_dataset(key,data=numpy.array([s[key] for s in self.sums],dtype=numpy.int64))
+        chunks.create_dataset('intensity',data=numpy.array([s['intensity'] for s in self.sums]))
+        chunks.attrs['columns'] = numpy.array(STATISTICS_COLUMNS)
+        for key in ('mean','m2'):
+            chunks.create_dataset(key,data=numpy.array([[s[key][col] for col in STATISTICS_COLUMNS]
+                                                        for s in self.sums]).reshape(-1,len(STATISTICS_COLUMNS)))
+        self.file.attrs['npoint'] = self.npoint
+        self.file.close()
+        return statistics(self.sums)
+
+    def close(self):
+        self.result()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+def write(file,beam,source=None,oes=None,chunk_rays=SOURCE_CHUNK_SIZE,compression='gzip',compression_opts=4):
+    """
+    writes a beam in an HDF5 file (see Writer for the parameters)
+    """
+    with Writer(file,source,oes,chunk_rays,compression,compression_opts) as writer:
+        for i in range(0,max(1,beam.rays.shape[0]),chunk_rays):
+            chunk = Beam()
+            chunk.rays = beam.rays[i:i+chunk_rays]
+            writer.add(chunk)
+
+def load(file,start=0,stop=None,workers=None):
+    """
+    reads the rays of an HDF5 file
+    :param file: file name
+    :param start: first ray (starting from 0)
+    :param stop: end of the range of rays (default: None, up to the last ray)
+    :param workers: number of processes reading (and decompressing) parts of the range at a time,
+                    split at the chunks of the file (default: None, read in this process)
+    :return: a numpy (nrays,18) float64 array
+    """
+    with h5py.File(file,'r') as f:
+        _check(f,file)
+        npoint = f['rays/col01'].shape[0]
+        chunk_rays = f['rays/col01'].chunks[0]
+    start,stop,step = slice(start,stop).indices(npoint)
+    if not workers or stop-start <= chunk_rays:
+        return _readRange(file,start,stop)
+    from concurrent.futures import ProcessPoolExecutor
+    # ranges of whole chunks of the file, a few per process
+    size = max(chunk_rays,-(-(stop-start)//(4*workers)//chunk_rays)*chunk_rays)
+    bounds = list(range(start,stop,size))+[stop]
+    rays = numpy.empty((stop-start,18))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for first,part in zip(bounds[:-1],executor.map(_readRange,[file]*(len(bounds)-1),bounds[:-1],bounds[1:])):
+            rays[first-start:first-start+part.shape[0]] = part
+    return rays
+
+def metadata(file):
+    """
+    reads the parameters and statistics stored in an HDF5 file
+    :param file: file name
+    :return: a dictionary with 'npoint', 'source' (Shadow.Source or None), 'oes' (list of
+             Shadow.OE), 'chunks' (dictionary of arrays with a value per chunk: start, nrays, good,
+             lost, skipped, intensity, and mean and m2 with a column per STATISTICS_COLUMNS) and
+             'statistics' (of all the rays, see Shadow.parallel.statistics)
+    """
+    with h5py.File(file,'r') as f:
+        _check(f,file)
+        result = {'npoint':f['rays/col01'].shape[0],'source':None,'oes':[],'chunks':{}}
+        if 'source' in f:
+            result['source'] = _getAttributes(f['source'],Source())
+        i = 1
+        while 'oe%02d'%i in f:
+            result['oes'].append(_getAttributes(f['oe%02d'%i],OE()))
+            i += 1
+        if 'chunks' in f:
+            for key,dataset in f['chunks'].items():
+                result['chunks'][key] = dataset[()]
+            columns = list(f['chunks'].attrs['columns'])
+    sums = []
+    chunks = result['chunks']
+    for i in range(len(chunks.get('start',[]))):
+        s = {}
+        for key in ('nrays','good','lost','skipped','intensity'):
+            s[key] = chunks[key][i]
+        for key in ('mean','m2'):
+            s[key] = dict(zip(columns,chunks[key][i]))
+        sums.append(s)
+    result['statistics'] = statistics(sums) if sums else None
+    return result
+
+def _readRange(file,start,stop):
+    """
+    reads the rays start to stop-1 of an HDF5 file, in a worker of load
+    """
+    rays = numpy.empty((stop-start,18))
+    with h5py.File(file,'r') as f:
+        for col in range(1,19):
+            rays[:,col-1] = f['rays/col%02d'%col][start:stop]
+    return rays
+
+def _check(f,file):
+    """
+    raises ValueError if the HDF5 file f is not a beam file
+    """
+    if f.attrs.get('format') not in (FORMAT,FORMAT.encode()) or 'rays' not in f:
+        raise ValueError("load: not a SHADOW beam HDF5 file: %s"%file)
+    if f.attrs['version'] > VERSION:
+        raise ValueError("load: version %d of the file is newer than %d: %s"%(f.attrs['version'],VERSION,file))
+
+def _setAttributes(group,dictionary):
+    """
+    stores the variables of a source or oe dictionary in the attributes of an HDF5 group
+    """
+    for name,value in dictionary.items():
+        group.attrs[name] = value
+
+def _getAttributes(group,obj):
+    """
+    sets the variables of a source or oe from the attributes of an HDF5 group, returns it
+    """
+    for name,value in group.attrs.items():
+        if isinstance(value,numpy.integer):
+            value = int(value)
+        elif isinstance(value,numpy.floating):
+            value = float(value)
+        elif isinstance(value,(str,numpy.bytes_)):
+            # h5py reads back the bytes of the file names as str
+            value = value.encode() if isinstance(value,str) else bytes(value)
+        setattr(obj,name,value)
+    return obj
@@ -0,0 +1,352 @@
+"""
+Traces a source through a system of optical elements on a pool of worker processes,
+in this machine or in remote ones.
+
+The NPOINT rays of the source are split in chunks. Each chunk is generated and traced
+through all the optical elements by one worker, with its own random substreams, and the
+chunks are gathered back in ray order together with the statistics of each optical element.
+Nothing is written to files (FWRITE=3), this replaces the file based trace3mpi program.
+
+Remote workers are started in each node with:
+
+    python -m Shadow.parallel serve --host node1 --port 6000 --workers 8 --authkey KEY
+
+and used with run(source,oes,remote=[('node1',6000),('node2',6000)],authkey=b'KEY'). An
+address may be given several times to send it several chunks at a time. A server listens to
+localhost only unless --host is given, and prints a random key if --authkey is not given.
+
+The jobs and their results are sent as pickles, and unpickling runs code: a client knowing
+the key can run any code in the worker server, and the server any code in the client. The
+key only authenticates the connections, which are not encrypted: keep it secret, and serve
+only to trusted hosts on a trusted network.
+
+Example (local processes):
+
+    import Shadow
+    import Shadow.parallel
+    ticket = Shadow.parallel.run(src,[oe1,oe2],workers=4)
+    ticket['beam'].write('star.02')
+"""
+from __future__ import print_function
+import os
+import sys
+import numpy
+import Shadow.ShadowLib as ShadowLib
+from Shadow.ShadowLibExtensions import Beam, OE, Source, CompoundOE, SOURCE_CHUNK_SIZE, _randomSeed, \
+    _genSourceChunk, _select
+
+# columns (x,z,x',z') with mean and standard deviation in the statistics
+STATISTICS_COLUMNS = (1,3,4,6)
+
+# default address of the worker servers
+ADDRESS = ('localhost',6000)
+
+def run(source,oes,workers=None,chunk_size=SOURCE_CHUNK_SIZE,seed=0,remote=None,authkey=None):
+    """
+    generates the rays of source and traces them through the oes, in chunks of rays
+    distributed to worker processes
+    :param source: Shadow.Source (only random sources, FGRID=0)
+    :param oes: Shadow.CompoundOE or list of Shadow.OE. They are not modified.
+    :param workers: number of local processes (default: None, one per cpu)
+    :param chunk_size: number of rays per chunk
+    :param seed: seed of the random streams (default=0: ISTAR1 of the source, or a random seed
+                 if ISTAR1=0). The result depends on seed and chunk_size, not on the workers.
+    :param remote: list of (host,port) addresses of worker servers (see serve). If given,
+                   the chunks are sent to them instead of to local processes.
+    :param authkey: authentication key of the worker servers (bytes), required with remote
+                    (see the module documentation)
+    :return: a dictionary with 'beam' (Shadow.Beam with the rays after the last oe),
+             'oe_list' (Shadow.CompoundOE with the oes after tracing, as the end.xx files)
+             and 'statistics' (a list with a dictionary for each oe, see statistics)
+    """
+    if source.FGRID != 0:
+        raise ValueError("run: only random sources (FGRID=0) can be traced in chunks")
+    if remote and not authkey:
+        raise ValueError("run: the authkey of the worker servers is required with remote")
+    if isinstance(oes,CompoundOE):
+        oes = oes.list
+    if seed == 0:
+        seed = source.ISTAR1
+    if seed == 0:
+        seed = _randomSeed()
+    src_dict = source.to_dictionary()
+    oe_list = [oe.to_dictionary() for oe in oes]
+    npoint = source.NPOINT
+    chunk_size = max(1,int(chunk_size))
+    jobs = [(src_dict,oe_list,seed,index,first,min(chunk_size,npoint-first))
+            for index,first in enumerate(range(0,npoint,chunk_size))]
+
+    if remote:
+        results = _runRemote(jobs,remote,authkey)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers or None) as executor:
+            results = list(executor.map(_runChunk,*zip(*jobs)))
+
+    beam = Beam()
+    # with no rays (NPOINT=0) there is no chunk: an empty beam, the oes as given
+    beam.rays = numpy.concatenate([numpy.zeros((0,18))]+[rays for rays,oe_end,sums in results])
+    oe_end = CompoundOE()
+    for oe_dict in (results[-1][1] if results else oe_list):
+        oe = OE()
+        for name,value in oe_dict.items():
+            setattr(oe,name,value)
+        oe_end.append(oe)
+    stats = []
+    for i in range(len(oe_list)):
+        stats.append(statistics([sums[i] for rays,oe_dict,sums in results]))
+    return {'beam':beam,'oe_list':oe_end,'statistics':stats}
+
+def statistics(sums):
+    """
+    combines the sums of the chunks into the statistics of an optical element
+    :param sums: list with the dictionary of sums of each chunk (see _chunkSums)
+    :return: a dictionary with 'nrays', 'good' and 'lost' (number of rays), 'skipped' (lost
+             rays not traced, with SHADOW_SKIP_LOST=1), 'intensity' (of the good rays) and
+             'mean' and 'std' (dictionaries with the mean and the standard deviation of the
+             good rays for the STATISTICS_COLUMNS)
+    """
+    total = {}
+    for key in ('nrays','good','lost','skipped','intensity'):
+        total[key] = sum([s[key] for s in sums])
+    total['mean'] = {}
+    total['std'] = {}
+    for col in STATISTICS_COLUMNS:
+        moments = (0,0.0,0.0)
+        for s in sums:
+            moments = _mergeMoments(moments,(s['good'],s['mean'][col],s['m2'][col]))
+        good,mean,m2 = moments
+        total['mean'][col] = mean
+        total['std'][col] = numpy.sqrt(m2/good) if good else 0.0
+    return total
+
+def _chunkSums(beam,skipped=0):
+    """
+    returns the ray counts and the moments needed by statistics of a chunk of rays: for each of
+    the STATISTICS_COLUMNS, the mean of the good rays ('mean') and the sum of their squared
+    deviations from it ('m2')
+    """
+    good = _select(beam.rays,1)
+    sums = {'nrays':beam.rays.shape[0],'good':int(good.sum()),'intensity':beam.intensity(nolost=1),
+            'skipped':skipped,'mean':{},'m2':{}}
+    sums['lost'] = sums['nrays']-sums['good']
+    for col in STATISTICS_COLUMNS:
+        column = beam.rays[good,col-1]
+        mean = column.mean() if column.shape[0] else 0.0
+        sums['mean'][col] = mean
+        sums['m2'][col] = ((column-mean)**2).sum()
+    return sums
+
+def _mergeMoments(a,b):
+    """
+    merges the moments (weight,mean,m2) of two sets of values, m2 being the weighted sum of the
+    squared deviations from the mean (Chan et al. pairwise update, no cancellation as with the
+    sums of the squares). mean and m2 may be arrays.
+    """
+    weight_a,mean_a,m2_a = a
+    weight_b,mean_b,m2_b = b
+    if not weight_b:
+        return a
+    if not weight_a:
+        return b
+    weight = weight_a+weight_b
+    delta = mean_b-mean_a
+    return weight,mean_a+delta*(weight_b/weight),m2_a+m2_b+delta*delta*(weight_a*weight_b/weight)
+
+def _runChunk(src_dict,oe_list,seed,index,first,npoint):
+    """
+    generates the chunk index of the source (npoint rays starting at ray first) and traces it
+    through the oes given as dictionaries, in a worker. Returns the rays, the oe dictionaries
+    after tracing and the sums of each oe.
+    """
+    src = Source()
+    for name,value in src_dict.items():
+        setattr(src,name,value)
+    src.NPOINT = npoint
+    beam = _genSourceChunk(src,seed,0,index,first)
+    oe_end = []
+    sums = []
+    ShadowLib.skippedRays()
+    for i,oe_dict in enumerate(oe_list):
+        oe = OE()
+        for name,value in oe_dict.items():
+            setattr(oe,name,value)
+        oe.FWRITE = 3
+        beam.traceOE(oe,i+1,seed,i+1,index)
+        oe_end.append(oe.to_dictionary())
+        sums.append(_chunkSums(beam,ShadowLib.skippedRays()))
+    return beam.rays,oe_end,sums
+
+def _runRemote(jobs,remote,authkey):
+    """
+    runs the jobs on the worker servers, each address taking one job at a time
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from multiprocessing.connection import Client
+    import threading
+
+    jobs = list(enumerate(jobs))
+    lock = threading.Lock()
+    results = [None]*len(jobs)
+
+    def client(address):
+        conn = Client(tuple(address),authkey=authkey)
+        try:
+            while True:
+                with lock:
+                    if not jobs:
+                        return
+                    index,job = jobs.pop(0)
+                conn.send(job)
+                ok,result = conn.recv()
+                if not ok:
+                    raise result
+                results[index] = result
+        finally:
+            conn.close()
+
+    with ThreadPoolExecutor(max_workers=len(remote)) as executor:
+        for future in [executor.submit(client,address) for address in remote]:
+            future.result()
+    return results
+
+class WorkerServer(object):
+    """
+    server running the chunks sent by run(...,remote=...) on a pool of processes
+    """
+    def __init__(self,address=ADDRESS,workers=None,authkey=None):
+        """
+        :param address: (host,port) to listen to (default: port 6000 of localhost; port 0: any
+                        free port, see address)
+        :param workers: number of processes (default: None, one per cpu)
+        :param authkey: authentication key, the same as in run (default: None, a random key,
+                        see the attribute authkey)
+        """
+        from multiprocessing.connection import Listener
+        if not authkey:
+            authkey = _randomKey()
+        self.authkey = authkey
+        self.listener = Listener(tuple(address),authkey=authkey)
+        self.workers = workers
+        self.closed = False
+
+    @property
+    def address(self):
+        return self.listener.address
+
+    def serve_forever(self):
+        """
+        accepts connections, each one served by a thread, until close is called
+        """
+        from concurrent.futures import ProcessPoolExecutor
+        import threading
+        with ProcessPoolExecutor(max_workers=self.workers or None) as executor:
+            while True:
+                try:
+                    conn = self.listener.accept()
+                except Exception:
+                    if self.closed:
+                        return
+                    print("WorkerServer: connection refused: %s"%sys.exc_info()[1])
+                    continue
+                thread = threading.Thread(target=self._serve,args=(conn,executor))
+                thread.daemon = True
+                thread.start()
+
+    def _serve(self,conn,executor):
+        try:
+            while True:
+                try:
+                    job = conn.recv()
+                except EOFError:
+                    return
+                try:
+                    conn.send((True,executor.submit(_runChunk,*job).result()))
+                except Exception as e:
+                    conn.send((False,e))
+        finally:
+            conn.close()
+
+    def close(self):
+        """
+        stops serve_forever, waking up its accept with a connection
+        """
+        import socket
+        self.closed = True
+        host,port = self.address
+        try:
+            socket.create_connection((host if host not in ('','0.0.0.0') else 'localhost',port),1).close()
+        except Exception:
+            pass
+        self.listener.close()
+
+def serve(address=ADDRESS,workers=None,authkey=None):
+    """
+    runs a worker server for run(...,remote=...) until interrupted
+    :param address: (host,port) to listen to (default: port 6000 of localhost)
+    :param workers: number of processes (default: None, one per cpu)
+    :param authkey: authentication key, the same as in run (default: None, a random key, printed)
+    """
+    server = WorkerServer(address,workers,authkey)
+    print("Shadow.parallel: serving on %s:%d"%server.address)
+    if not authkey:
+        print("Shadow.parallel: authkey %s"%server.authkey.decode())
+    try:
+        server.serve_forever()
+    finally:
+        server.close()
+
+def _randomKey():
+    """
+    returns a random authentication key, printable (32 hexadecimal digits)
+    """
+    import binascii
+    return binascii.hexlify(os.urandom(16))
+
+def main(argv=None):
+    """
+    command line: "serve" runs a worker server, "trace" traces start.00 and the start.xx files
+    listed in systemfile.dat (as trace3mpi) and writes the final star.xx and the end.xx files
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m Shadow.parallel')
+    parser.add_argument('command',choices=('serve','trace'))
+    parser.add_argument('--host',default=ADDRESS[0],
+                        help='address to listen to (default: localhost; 0.0.0.0: all interfaces)')
+    parser.add_argument('--port',type=int,default=ADDRESS[1])
+    parser.add_argument('--workers',type=int,default=None)
+    parser.add_argument('--chunk-size',type=int,default=SOURCE_CHUNK_SIZE)
+    parser.add_argument('--remote',action='append',default=None,
+                        help='host:port of a worker server (may be repeated)')
+    parser.add_argument('--authkey',default=None,
+                        help='key of the worker servers (serve: default, a random key, printed)')
+    args = parser.parse_args(argv)
+    if args.remote and not args.authkey:
+        parser.error('--remote needs the --authkey of the worker servers')
+    authkey = args.authkey.encode() if args.authkey else None
+
+    if args.command == 'serve':
+        serve((args.host,args.port),args.workers,authkey)
+        return
+
+    src = Source()
+    src.load('start.00')
+    oes = []
+    with open('systemfile.dat') as f:
+        for line in f:
+            if line.strip():
+                oe = OE()
+                oe.load(line.strip())
+                oes.append(oe)
+    remote = None
+    if args.remote:
+        remote = [(r.rsplit(':',1)[0],int(r.rsplit(':',1)[1])) for r in args.remote]
+    ticket = run(src,oes,workers=args.workers,chunk_size=args.chunk_size,remote=remote,authkey=authkey)
+    for i,oe in enumerate(ticket['oe_list'].list):
+        oe.write("end.%02d"%(i+1))
+        stats = ticket['statistics'][i]
+        print("oe %d: %d good rays, %d lost, intensity %g"%(i+1,stats['good'],stats['lost'],stats['intensity']))
+    ticket['beam'].write("star.%02d"%len(oes))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+"""
+Traces any number of rays with a bounded memory: the rays of the source are generated in
+chunks, each chunk is traced through all the optical elements, its final rays are fed to
+accumulators (histograms, moments) and the chunk is thrown away. The memory used depends on
+the chunk size (and the number of worker processes), not on the total number of rays.
+
+The chunks use the random streams of Shadow.parallel.run (chunk i of the source with the
+substream i, oe j with the stream j), so the accumulated results are those of the beam of
+run(source,oes,chunk_size=chunk_rays,seed=seed).
+
+Example:
+
+    import Shadow
+    h = Shadow.streaming.Histo1(1,xrange=[-0.01,0.01],nbins=100,nolost=1,ref=23)
+    m = Shadow.streaming.Moments((1,3,4,6),nolost=1,ref=23)
+    ticket = Shadow.stream(src,[oe1,oe2],total_rays=10**9,accumulators=[h,m])
+    ticket['results'][0]['histogram'], ticket['statistics'][-1]['lost']
+"""
+from __future__ import print_function
+import numpy
+from Shadow.ShadowLibExtensions import Beam, OE, CompoundOE, SOURCE_CHUNK_SIZE, _randomSeed, _select
+from Shadow.parallel import statistics, _runChunk, _mergeMoments
+
+def stream(source,oes,total_rays=None,chunk_rays=SOURCE_CHUNK_SIZE,accumulators=(),seed=0,workers=None,\
+           verbose=0):
+    """
+    generates total_rays rays of source in chunks of chunk_rays, traces each chunk through the
+    oes and feeds the rays after the last oe to the accumulators
+    :param source: Shadow.Source (only random sources, FGRID=0). It is not modified.
+    :param oes: Shadow.CompoundOE or list of Shadow.OE. They are not modified.
+    :param total_rays: number of rays (default: None, NPOINT of the source)
+    :param chunk_rays: number of rays per chunk
+    :param accumulators: list of accumulators (Histo1, Histo2, Moments, or any object with
+                         add(beam) and result()). They are fed in ray order.
+    :param seed: seed of the random streams (default=0: ISTAR1 of the source, or a random seed
+                 if ISTAR1=0). The result depends on seed and chunk_rays, not on workers.
+    :param workers: number of processes tracing chunks ahead, at most two chunks per process
+                    (default: None, the chunks are traced in this process)
+    :param verbose: 1=print a line for each chunk traced, 0=silent (default)
+    :return: a dictionary with 'results' (the result of each accumulator), 'statistics' (a list
+             with the ray counts, losses and moments of each oe, see Shadow.parallel.statistics)
+             and 'oe_list' (Shadow.CompoundOE with the oes after tracing, as the end.xx files)
+    """
+    if source.FGRID != 0:
+        raise ValueError("stream: only random sources (FGRID=0) can be traced in chunks")
+    if isinstance(oes,CompoundOE):
+        oes = oes.list
+    if total_rays is None:
+        total_rays = source.NPOINT
+    if seed == 0:
+        seed = source.ISTAR1
+    if seed == 0:
+        seed = _randomSeed()
+    src_dict = source.to_dictionary()
+    oe_list = [oe.to_dictionary() for oe in oes]
+    chunk_rays = max(1,int(chunk_rays))
+    # the oes are set up again for each chunk, as in parallel.run: SHADOW changes the values of
+    # an oe when tracing it, so a traced oe cannot be traced again
+    jobs = ((src_dict,oe_list,seed,index,first,min(chunk_rays,total_rays-first))
+            for index,first in enumerate(range(0,total_rays,chunk_rays)))
+
+    sums = [[] for oe in oe_list]
+    oe_end = oe_list
+    traced = 0
+    for rays,oe_end,chunk_sums in _runChunks(jobs,workers):
+        beam = Beam()
+        beam.rays = rays
+        for accumulator in accumulators:
+            accumulator.add(beam)
+        for i,s in enumerate(chunk_sums):
+            sums[i].append(s)
+        traced += rays.shape[0]
+        if verbose:
+            print("stream: %d rays traced from %d"%(traced,total_rays))
+    oe_compound = CompoundOE()
+    for oe_dict in oe_end:
+        oe = OE()
+        for name,value in oe_dict.items():
+            setattr(oe,name,value)
+        oe_compound.append(oe)
+    return {'results':[accumulator.result() for accumulator in accumulators],
+            'statistics':[statistics(s) for s in sums],
+            'oe_list':oe_compound}
+
+def _runChunks(jobs,workers):
+    """
+    runs the jobs of _runChunk in this process or in a pool of processes, keeping at most two
+    chunks per process in memory, and returns their results in order
+    """
+    if not workers:
+        for job in jobs:
+            yield _runChunk(*job)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    import collections
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for job in jobs:
+            pending.append(executor.submit(_runChunk,*job))
+            if len(pending) >= 2*workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+class Histo1(object):
+    """
+    accumulates the histogram of a column, as Beam.histo1 (the range must be given)
+    """
+    def __init__(self,col,xrange,nbins=50,nolost=0,ref=0):
+        """
+        :param col: column (SHADOW convention, starting from 1)
+        :param xrange: [min,max] of the histogram
+        :param nbins: number of bins
+        :param nolost: 0=all rays, 1=good rays, 2=lost rays
+        :param ref: 0=count the rays, 1 or 23=weight with the intensity, other: weight with that column
+        """
+        if ref == 1:
+            ref = 23
+        self.col = col
+        self.xrange = list(xrange)
+        self.nbins = nbins
+        self.nolost = nolost
+        self.ref = ref or 0
+        self.histogram = numpy.zeros(nbins)
+        self.histogram2 = numpy.zeros(nbins)
+        self.bins = numpy.histogram([],bins=nbins,range=self.xrange)[1]
+        self.count = 0
+        self.intensity = 0.0
+        self.nrays = 0
+        self.good_rays = 0
+
+    def add(self,beam):
+        """
+        adds the rays of a chunk
+        """
+        selected = _select(beam.rays,self.nolost)
+        x = beam.getshonecol(self.col)[selected]
+        if self.ref == 0:
+            w = numpy.ones(len(x))
+        else:
+            w = beam.getshonecol(self.ref)[selected]
+        self.histogram += numpy.histogram(x,bins=self.nbins,range=self.xrange,weights=w)[0]
+        self.histogram2 += numpy.histogram(x,bins=self.nbins,range=self.xrange,weights=w*w)[0]
+        self.count += len(w)
+        self.intensity += w.sum()
+        self.nrays += beam.rays.shape[0]
+        self.good_rays += int(_select(beam.rays,1).sum())
+
+    def result(self):
+        """
+        :return: a dictionary with the keys of Beam.histo1: histogram, histogram_sigma, bins,
+                 bin_center, bin_left, bin_right, xrange, intensity, nrays, good_rays, fwhm
+        """
+        h = self.histogram
+        bins = self.bins
+        ticket = {'error':0,'col':self.col,'nolost':self.nolost,'nbins':self.nbins,'ref':self.ref}
+        ticket['histogram'] = h.copy()
+        ticket['bins'] = bins
+        ticket['histogram_sigma'] = numpy.sqrt(self.histogram2-h*h/float(max(self.count,1)))
+        ticket['bin_center'] = bins[:-1]+(bins[1]-bins[0])*0.5
+        ticket['bin_left'] = bins[:-1]
+        ticket['bin_right'] = bins[:-1]+(bins[1]-bins[0])
+        ticket['xrange'] = self.xrange
+        ticket['intensity'] = self.intensity
+        ticket['nrays'] = self.nrays
+        ticket['good_rays'] = self.good_rays
+        ticket['fwhm'] = None
+        tt = numpy.where(h>=h.max()*0.5)
+        if h[tt].size > 1:
+            ticket['fwhm'] = (bins[1]-bins[0])*(tt[0][-1]-tt[0][0])
+            ticket['fwhm_coordinates'] = (ticket['bin_center'][tt[0][0]],ticket['bin_center'][tt[0][-1]])
+        return ticket
+
+class Histo2(object):
+    """
+    accumulates the 2D histogram of two columns, as Beam.histo2 (the ranges must be given)
+    """
+    def __init__(self,col_h,col_v,xrange,yrange,nbins=25,ref=23,nbins_h=None,nbins_v=None,nolost=0):
+        """
+        :param col_h: the horizontal column
+        :param col_v: the vertical column
+        :param xrange: range for H
+        :param yrange: range for V
+        :param nbins: number of bins
+        :param ref: 0=count the rays, 1 or 23=weight with the intensity, other: weight with that column
+        :param nbins_h: number of bins in H (default: nbins)
+        :param nbins_v: number of bins in V (default: nbins)
+        :param nolost: 0=all rays, 1=good rays, 2=lost rays
+        """
+        if ref == 1:
+            ref = 23
+        self.col_h = col_h
+        self.col_v = col_v
+        self.xrange = list(xrange)
+        self.yrange = list(yrange)
+        self.nbins_h = nbins_h or nbins
+        self.nbins_v = nbins_v or nbins
+        self.ref = ref or 0
+        self.nolost = nolost
+        self.histogram = numpy.zeros((self.nbins_h,self.nbins_v))
+        self.intensity = 0.0
+        self.nrays = 0
+        self.good_rays = 0
+
+    def add(self,beam):
+        """
+        adds the rays of a chunk
+        """
+        selected = _select(beam.rays,self.nolost)
+        x = beam.getshonecol(self.col_h)[selected]
+        y = beam.getshonecol(self.col_v)[selected]
+        intensity = beam.getshonecol(23)[selected]
+        if self.ref == 0:
+            w = None
+        elif self.ref == 23:
+            w = intensity
+        else:
+            w = beam.getshonecol(self.ref)[selected]
+        self.histogram += numpy.histogram2d(x,y,bins=[self.nbins_h,self.nbins_v],
+                                            range=[self.xrange,self.yrange],weights=w)[0]
+        self.intensity += intensity.sum()
+        self.nrays += beam.rays.shape[0]
+        self.good_rays += int(_select(beam.rays,1).sum())
+
+    def result(self):
+        """
+        :return: a dictionary with the keys of Beam.histo2: histogram, histogram_h, histogram_v,
+                 bin_h_edges, bin_v_edges, bin_h_center, bin_v_center, intensity, nrays, good_rays,
+                 fwhm_h, fwhm_v
+        """
+        xx = numpy.linspace(self.xrange[0],self.xrange[1],self.nbins_h+1)
+        yy = numpy.linspace(self.yrange[0],self.yrange[1],self.nbins_v+1)
+        hh = self.histogram.copy()
+        ticket = {'error':0,'col_h':self.col_h,'col_v':self.col_v,'nolost':self.nolost,
+                  'nbins_h':self.nbins_h,'nbins_v':self.nbins_v,'ref':self.ref}
+        ticket['xrange'] = self.xrange
+        ticket['yrange'] = self.yrange
+        ticket['bin_h_edges'] = xx
+        ticket['bin_v_edges'] = yy
+        ticket['bin_h_left'] = numpy.delete(xx,-1)
+        ticket['bin_v_left'] = numpy.delete(yy,-1)
+        ticket['bin_h_right'] = numpy.delete(xx,0)
+        ticket['bin_v_right'] = numpy.delete(yy,0)
+        ticket['bin_h_center'] = 0.5*(ticket['bin_h_left']+ticket['bin_h_right'])
+        ticket['bin_v_center'] = 0.5*(ticket['bin_v_left']+ticket['bin_v_right'])
+        ticket['histogram'] = hh
+        ticket['histogram_h'] = hh.sum(axis=1)
+        ticket['histogram_v'] = hh.sum(axis=0)
+        ticket['intensity'] = self.intensity
+        ticket['nrays'] = self.nrays
+        ticket['good_rays'] = self.good_rays
+        for hv in ('h','v'):
+            h = ticket['histogram_'+hv]
+            center = ticket['bin_'+hv+'_center']
+            tt = numpy.where(h>=h.max()*0.5)
+            ticket['fwhm_'+hv] = None
+            if h[tt].size > 1:
+                ticket['fwhm_'+hv] = (center[1]-center[0])*(tt[0][-1]-tt[0][0])
+                ticket['fwhm_coordinates_'+hv] = (center[tt[0][0]],center[tt[0][-1]])
+        return ticket
+
+class Moments(object):
+    """
+    accumulates the mean, standard deviation, minimum and maximum of columns
+    """
+    def __init__(self,cols=(1,3,4,6),nolost=1,ref=0):
+        """
+        :param cols: columns (SHADOW convention, starting from 1)
+        :param nolost: 0=all rays, 1=good rays, 2=lost rays
+        :param ref: 0=no weight, 1 or 23=weight with the intensity, other: weight with that column
+        """
+        if ref == 1:
+            ref = 23
+        self.cols = tuple(cols)
+        self.nolost = nolost
+        self.ref = ref or 0
+        self.weight = 0.0
+        self.nrays = 0
+        self.mean = numpy.zeros(len(self.cols))
+        # weighted sums of the squared deviations from the mean, merged chunk by chunk
+        self.m2 = numpy.zeros(len(self.cols))
+        self.min = numpy.zeros(len(self.cols))+numpy.inf
+        self.max = numpy.zeros(len(self.cols))-numpy.inf
+
+    def add(self,beam):
+        """
+        adds the rays of a chunk
+        """
+        selected = _select(beam.rays,self.nolost)
+        if not selected.any():
+            return
+        w = beam.getshonecol(self.ref)[selected] if self.ref else numpy.ones(int(selected.sum()))
+        self.nrays += int(selected.sum())
+        weight = w.sum()
+        mean = numpy.zeros(len(self.cols))
+        m2 = numpy.zeros(len(self.cols))
+        for i,col in enumerate(self.cols):
+            x = beam.getshonecol(col)[selected]
+            if weight:
+                mean[i] = (x*w).sum()/weight
+                m2[i] = (w*(x-mean[i])**2).sum()
+            self.min[i] = min(self.min[i],x.min())
+            self.max[i] = max(self.max[i],x.max())
+        self.weight,self.mean,self.m2 = _mergeMoments((self.weight,self.mean,self.m2),(weight,mean,m2))
+
+    def result(self):
+        """
+        :return: a dictionary with 'nrays' (number of rays selected), 'weight' (sum of the weights)
+                 and 'mean', 'std', 'min' and 'max' (dictionaries with a value per column)
+        """
+        mean = self.mean
+        std = numpy.sqrt(self.m2/self.weight) if self.weight else numpy.zeros(len(self.cols))
+        ticket = {'nrays':self.nrays,'weight':self.weight}
+        for name,values in (('mean',mean),('std',std),('min',self.min),('max',self.max)):
+            ticket[name] = dict(zip(self.cols,values))
+        return ticket
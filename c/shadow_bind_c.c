@@ -130,6 +130,30 @@ void CShadowTraceOE ( poolOE* Oe, double* Ray, int nPoint, int iCount )
   BindShadowTraceOE ( Oe, Ray, &nPoint, &iCount );
 }
 
+/*
+ *  CShadowTraceOEPrepared(poolOE*,double*,int,int) traces as CShadowTraceOE, but the
+ *  setup of the oe is kept by the kernel (of the calling thread) and reused by the next
+ *  call while the oe, iCount and the number of columns do not change.
+ */
+void CShadowTraceOEPrepared ( poolOE* Oe, double* Ray, int nPoint, int iCount )
+{
+  FixPoolOEForFortran ( Oe );
+  BindShadowTraceOEPrepared ( Oe, Ray, &nPoint, &iCount );
+}
+
+/*
+ *  CShadowTraceCompoundOE(poolOE*,int,...) traces the rays through the array of nOE
+ *  oe's in a single kernel call, the first one with number iCount. If Seed != 0, oe
+ *  number i uses the random stream (Seed,i,SubStream). Verbose prints a line per oe.
+ */
+void CShadowTraceCompoundOE ( poolOE* Oe, int nOE, double* Ray, int nPoint, int iCount, int Verbose, int Seed, int SubStream )
+{
+  int i;
+  for ( i=0; i<nOE; i++ )
+    FixPoolOEForFortran ( Oe+i );
+  BindShadowTraceCompoundOE ( Oe, &nOE, Ray, &nPoint, &iCount, &Verbose, &Seed, &SubStream );
+}
+
 void CShadowBeamGetDim ( int* nCol, int* nPoint, char* FileDat )
 {
   BindShadowBeamgetDim ( FileDat, strlen ( FileDat ), nPoint, nCol );
@@ -149,6 +173,69 @@ void CShadowBeamWrite ( double* Ray, int nCol, int nPoint, char* FileDat )
   BindShadowBeamWrite ( Ray, &nPoint, &nCol, FileDat, strlen ( FileDat ) );
 }
 
+/*
+ *  CShadowReentrant() returns 1 if the kernel keeps a context per thread, i.e.
+ *  CShadowTraceOE, CShadowSourceGeom and the beam i/o can be called from several
+ *  threads at the same time (as long as each one works on its own pool and rays).
+ *  CShadowSourceSync is never reentrant.
+ */
+int CShadowReentrant ( void )
+{
+  return BindShadowReentrant ( );
+}
+
+/*
+ *  CShadowRandomStream(int,int,int) selects the random stream of the calling thread:
+ *  substream SubStream of stream Stream of the seed Seed, from its first number.
+ *  The next CShadowSourceGeom/CShadowSourceSync/CShadowTraceOE use it instead of ISTAR1.
+ */
+void CShadowRandomStream ( int Seed, int Stream, int SubStream )
+{
+  BindShadowRandomStream ( &Seed, &Stream, &SubStream );
+}
+
+/*
+ *  CShadowLoadTable(int,char*,int) reads the table file FileName of type Kind
+ *  (1: prerefl, 2: pre_mlayer, 3: bragg, 4: presurface, 5: screen_external) in the table
+ *  cache of the kernel, shared by all the threads. The next traces use the cached values while the file is not
+ *  modified. If Pin != 0 the table is kept until CShadowClearTables.
+ */
+void CShadowLoadTable ( int Kind, char* FileName, int Pin )
+{
+  BindShadowLoadTable ( &Kind, FileName, strlen ( FileName ), &Pin );
+}
+
+/*
+ *  CShadowClearTables() empties the table cache of the kernel
+ */
+void CShadowClearTables ( void )
+{
+  BindShadowClearTables ( );
+}
+
+/*
+ *  CShadowPresurfaceEval(char*,int,double*,double*,double*,int*) evaluates the spline of
+ *  the presurface file FileName (cached as CShadowLoadTable) at the nPoint points (X,Y).
+ *  Pds gets 6 values per point (z, dz/dx, dz/dy, d2z/dxdy, d2z/dx2, d2z/dy2) and Ier is
+ *  not 0 for the points out of the mesh. Returns 0, or -1000 if the file is not valid.
+ */
+int CShadowPresurfaceEval ( char* FileName, int nPoint, double* X, double* Y, double* Pds, int* Ier )
+{
+  int Status;
+  BindShadowPresurfaceEval ( FileName, strlen ( FileName ), &nPoint, X, Y, Pds, Ier, &Status );
+  return Status;
+}
+
+/*
+ *  CShadowSkippedRays(int) returns the number of lost rays that the traces of the calling
+ *  thread did not trace (with SHADOW_SKIP_LOST=1 in the environment), counted since the
+ *  previous call with Reset != 0.
+ */
+int CShadowSkippedRays ( int Reset )
+{
+  return BindShadowSkippedRays ( &Reset );
+}
+
 /*
  *  void CShadowFFresnel2D(double*, int, double, double_Complex*, int, double, double)
  *  purpose is to perform a 2D Fresnel image
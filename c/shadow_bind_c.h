@@ -49,10 +49,18 @@ extern void BindShadowPoolOEWrite ( poolOE*, char*, int );
 extern void BindShadowSourceGeom ( poolSource*, double*, int* );
 extern void BindShadowSourceSync ( poolSource*, double*, int* );
 extern void BindShadowTraceOE ( poolOE*, double*, int*, int* );
+extern void BindShadowTraceOEPrepared ( poolOE*, double*, int*, int* );
+extern void BindShadowTraceCompoundOE ( poolOE*, int*, double*, int*, int*, int*, int*, int* );
 extern void BindShadowBeamWrite ( double*, int*, int*, char*, int );
 extern void BindShadowBeamgetDim ( char*, int, int*, int* );
 extern void BindShadowBeamLoad ( double*, int*, int*, char*, int );
 extern void BindShadowFFresnel2D ( double*, int*, double*, dComplex*, pixel*, pixel* );
+extern int BindShadowReentrant ( void );
+extern void BindShadowRandomStream ( int*, int*, int* );
+extern void BindShadowLoadTable ( int*, char*, int, int* );
+extern void BindShadowClearTables ( void );
+extern void BindShadowPresurfaceEval ( char*, int, int*, double*, double*, double*, int*, int* );
+extern int BindShadowSkippedRays ( int* );
 //END INTERFACE libshadow
 
 
@@ -68,7 +76,15 @@ void CShadowBeamWrite ( double*, int, int, char* );
 void CShadowSourceGeom ( poolSource*, double* );
 void CShadowSourceSync ( poolSource*, double* );
 void CShadowTraceOE ( poolOE*, double*, int, int );
+void CShadowTraceOEPrepared ( poolOE*, double*, int, int );
+void CShadowTraceCompoundOE ( poolOE*, int, double*, int, int, int, int, int );
 void CShadowFFresnel2D ( double*, int, double, dComplex*, pixel*, pixel* );
+int CShadowReentrant ( void );
+void CShadowRandomStream ( int, int, int );
+void CShadowLoadTable ( int, char*, int );
+void CShadowClearTables ( void );
+int CShadowPresurfaceEval ( char*, int, double*, double*, double*, int* );
+int CShadowSkippedRays ( int );
 void CShadowSetupDefaultSource ( poolSource* );
 void CShadowSetupDefaultOE ( poolOE* );
 
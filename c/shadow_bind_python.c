@@ -4,8 +4,37 @@
 #include <math.h>
 #include <emmintrin.h>
 #include <string.h>
+#include <pythread.h>
 //#include <intrin.h>
 
+/***************************************************************************
+ *         Kernel lock
+ *
+ * The calls below drop the GIL while they run in the kernel, so that other
+ * python threads (plotting, file writing, ...) can go on while a beam is
+ * traced.
+ *
+ * If the kernel is reentrant (built with OpenMP, see CShadowReentrant) every
+ * thread works on its own kernel context: the context is set up from the
+ * poolOE/poolSource owned by the python object and lives for the duration
+ * of the call. Otherwise the kernel state is global and calls serialize
+ * on kernelLock. The synchrotron sources (shadow_synchrotron keeps its own
+ * state) and the OEs writing star/mirr/screen files (FWRITE != 3, the file
+ * names are shared by all threads) always take the lock.
+ *
+ ***************************************************************************/
+
+static PyThread_type_lock kernelLock = NULL;
+static int kernelReentrant = 0;
+
+#define SHADOW_BEGIN_KERNEL(locked) \
+  Py_BEGIN_ALLOW_THREADS \
+  if ( locked ) PyThread_acquire_lock ( kernelLock, WAIT_LOCK );
+
+#define SHADOW_END_KERNEL(locked) \
+  if ( locked ) PyThread_release_lock ( kernelLock ); \
+  Py_END_ALLOW_THREADS
+
 /***************************************************************************
  *         Shadow_Source Python Object
  *
@@ -62,6 +91,7 @@ static PyObject* Source_genBeam ( Shadow_Source* self )
   Shadow_Beam *bm = (Shadow_Beam*) PyObject_CallObject((PyObject *) &ShadowBeamType, NULL);
   npy_intp dims[2];
   npy_intp strides[2];
+  int sync, locked;
   strides[0] = 18*sizeof ( double );
   strides[1] = sizeof( double );
   dims[0] = self->pl.NPOINT;
@@ -69,12 +99,18 @@ static PyObject* Source_genBeam ( Shadow_Source* self )
   if ( bm->rays!=NULL )
     Py_DECREF ( bm->rays );
   bm->rays = ( PyArrayObject* ) PyArray_New ( &PyArray_Type, 2, dims, NPY_FLOAT64, strides, NULL, sizeof ( double ), NPY_CARRAY|NPY_OWNDATA, NULL );
-  if ( ( self->pl.FDISTR==4 ) || ( self->pl.FSOURCE_DEPTH==4 ) || ( self->pl.F_WIGGLER>0 ) ) {
+  sync = ( self->pl.FDISTR==4 ) || ( self->pl.FSOURCE_DEPTH==4 ) || ( self->pl.F_WIGGLER>0 );
+  locked = sync || !kernelReentrant;
+  Py_INCREF ( self );
+  SHADOW_BEGIN_KERNEL ( locked )
+  if ( sync ) {
     CShadowSourceSync ( &(self->pl), ( double* ) ( bm->rays->data ) );
   }
   else {
     CShadowSourceGeom ( &(self->pl), ( double* ) ( bm->rays->data ) );
   }
+  SHADOW_END_KERNEL ( locked )
+  Py_DECREF ( self );
   return (PyObject*) bm;
 }
 
@@ -273,6 +309,7 @@ static int OE_init ( Shadow_OE* self, PyObject* args, PyObject* kwds )
 #define EXPAND_OE_ARRAYS(ctype,ftype,fkind,pytype,name,cformat,fformat,arrdim,defvalue) for(i=0;i<arrdim;i++) self->pl.name[i]=defvalue;
 #define EXPAND_OE_ARRSTR(ctype,ftype,fkind,pytype,name,cformat,fformat,arrdim,length,defvalue) memset(self->pl.name, 0, arrdim*length);
 #include "shadow_oe.def"
+  self->prepared = 0;
   return 0;
 }
 
@@ -300,25 +337,54 @@ static PyObject* OE_write ( Shadow_OE* self, PyObject* args )
   Py_RETURN_NONE;
 }
 
+static PyObject* OE_prepare ( Shadow_OE* self, PyObject* args )
+{
+  int prepared = 1;
+  if ( !PyArg_ParseTuple ( args, "|i", &prepared ) ) {
+    PyErr_SetString ( PyExc_TypeError, "argument should be an integer!" );
+    return NULL;
+  }
+  self->prepared = prepared != 0;
+  Py_INCREF ( self );
+  return (PyObject*) self;
+}
+
+static int Beam_kernelRays ( Shadow_Beam* self );
+
 static PyObject* OE_trace ( Shadow_OE* self, PyObject* args )
 {
   Shadow_Beam * bm = NULL;
+  PyArrayObject* rays;
   int nPoint;
   int iCount;
-  if ( !PyArg_ParseTuple ( args, "Oi", &bm, &iCount ) ) {
+  int locked;
+  int seed = 0, stream = 0, subStream = 0;
+  if ( !PyArg_ParseTuple ( args, "Oi|iii", &bm, &iCount, &seed, &stream, &subStream ) ) {
     PyErr_SetString ( PyExc_TypeError, "argument should be a python object!" );
     return NULL;
   }
   if ( !PyObject_TypeCheck ( bm, &ShadowBeamType ) ) {
     PyErr_SetString ( PyExc_TypeError, "the argument has to be a Shadow.Beam instance" );
-    Py_RETURN_NONE;
-  }
-  if ( bm->rays==NULL ) {
-    PyErr_SetString ( PyExc_TypeError, "rays is empty" );
-    Py_RETURN_NONE;
+    return NULL;
   }
+  if ( !Beam_kernelRays ( bm ) )
+    return NULL;
   nPoint = bm->rays->dimensions[0];
-  CShadowTraceOE ( &(self->pl), ( double* ) ( bm->rays->data ), nPoint, iCount );
+  rays = bm->rays;
+  Py_INCREF ( rays );
+  Py_INCREF ( self );
+  locked = !kernelReentrant || self->pl.FWRITE != 3;
+  SHADOW_BEGIN_KERNEL ( locked )
+  if ( seed != 0 )
+    CShadowRandomStream ( seed, stream, subStream );
+  if ( self->prepared )
+    CShadowTraceOEPrepared ( &(self->pl), ( double* ) ( rays->data ), nPoint, iCount );
+  else
+    CShadowTraceOE ( &(self->pl), ( double* ) ( rays->data ), nPoint, iCount );
+  SHADOW_END_KERNEL ( locked )
+  Py_DECREF ( self );
+  Py_DECREF ( rays );
+  Py_INCREF ( bm );
   return (PyObject*) bm;
 }
 
@@ -471,13 +537,15 @@ static PyMemberDef OE_members[] = {
 #define EXPAND_OE_ARRAYS(ctype,ftype,fkind,pytype,name,cformat,fformat,arrdim,defvalue)
 #define EXPAND_OE_ARRSTR(ctype,ftype,fkind,pytype,name,cformat,fformat,arrdim,length,defvalue)
 #include "shadow_oe.def"
+  {"prepared",T_INT,offsetof(Shadow_OE,prepared),READONLY,"1 if the setup is reused by the next traces (see prepare)"},
   {NULL}                                             /* Sentinel          */
 };
 
 static PyMethodDef OE_methods[] = {
   {"load" , ( PyCFunction ) OE_load , METH_VARARGS, "load Shadow.OE from a file"},
   {"write", ( PyCFunction ) OE_write, METH_VARARGS, "write Shadow.OE on a file" },
-  {"trace", ( PyCFunction ) OE_trace, METH_VARARGS, "trace Shadow.Beam through the opticacl element"},
+  {"prepare", ( PyCFunction ) OE_prepare, METH_VARARGS, "keep the setup of the OE in the kernel and reuse it in the next traces while the OE is not changed (optional 0: do not reuse it), returns the OE"},
+  {"trace", ( PyCFunction ) OE_trace, METH_VARARGS, "trace Shadow.Beam through the opticacl element (optional seed, stream, substream: random stream to use)"},
   {NULL}                                             /* Sentinel          */
 };
 
@@ -607,9 +675,31 @@ static int Beam_init ( Shadow_Beam* self, PyObject* args, PyObject* kwds )
   return 0;
 }
 
+/*
+ * 1 if the rays can be passed to the kernel (a C contiguous float64 array with
+ * 18 columns), else sets the exception and returns 0
+ */
+static int Beam_kernelRays ( Shadow_Beam* self )
+{
+  PyObject* rays = ( PyObject* ) self->rays;
+
+  if ( rays==NULL ) {
+    PyErr_SetString ( PyExc_TypeError, "rays is empty" );
+    return 0;
+  }
+  if ( !PyArray_Check ( rays ) || PyArray_TYPE ( ( PyArrayObject* ) rays )!=NPY_FLOAT64 ||
+       PyArray_NDIM ( ( PyArrayObject* ) rays )!=2 || PyArray_DIMS ( ( PyArrayObject* ) rays )[1]!=18 ||
+       !PyArray_ISCARRAY ( ( PyArrayObject* ) rays ) ) {
+    PyErr_SetString ( PyExc_TypeError, "rays should be a C contiguous float64 array with 18 columns" );
+    return 0;
+  }
+  return 1;
+}
+
 static PyObject* Beam_load ( Shadow_Beam* self, PyObject* args )
 {
   int nCol, nPoint;
+  PyArrayObject* rays;
   npy_intp dims[2];
   const char *FileName;
   FILE* TestFile;
@@ -627,15 +717,26 @@ static PyObject* Beam_load ( Shadow_Beam* self, PyObject* args )
   fclose ( TestFile );
 
   // file is conform test?
+  SHADOW_BEGIN_KERNEL ( !kernelReentrant )
   CShadowBeamGetDim ( &nCol, &nPoint, ( char* ) FileName );
+  SHADOW_END_KERNEL ( !kernelReentrant )
+  // NPOINT=-1: version 1 header of Shadow.beamfile, for more than 2**31-1 rays
+  if ( nPoint<0 || ( nCol!=12 && nCol!=13 && nCol!=18 ) ) {
+    PyErr_Format ( PyExc_ValueError, "%s: not a beam file, or more than 2**31-1 rays (NPOINT=-1): read it with Shadow.beamfile", FileName );
+    return NULL;
+  }
 
   dims[0] = nPoint;
   dims[1] = 18;
 
+  rays = ( PyArrayObject* ) PyArray_ZEROS(2, dims, NPY_FLOAT64, 0);
+  SHADOW_BEGIN_KERNEL ( !kernelReentrant )
+  CShadowBeamLoad ( ( double* ) ( rays->data ), nCol, nPoint, ( char* ) FileName );
+  SHADOW_END_KERNEL ( !kernelReentrant )
+
   if ( self->rays!=NULL )
     Py_DECREF ( self->rays );
-  self->rays = ( PyArrayObject* ) PyArray_ZEROS(2, dims, NPY_FLOAT64, 0);
-  CShadowBeamLoad ( ( double* ) ( self->rays->data ), nCol, nPoint, ( char* ) FileName );
+  self->rays = rays;
   Py_RETURN_NONE;
 }
 
@@ -657,20 +758,24 @@ static PyObject* beam_SetRayZeros(Shadow_Beam* self, PyObject* args)
 static PyObject* Beam_write ( Shadow_Beam* self, PyObject* args )
 {
   int nPoint, nCol;
+  PyArrayObject* rays;
   const char* FileName;
   if ( !PyArg_ParseTuple ( args, "s", &FileName ) ) {
     PyErr_SetString ( PyExc_TypeError, "argument should be a string!" );
     return NULL;
   }
 
-  if ( self->rays==NULL ) {
-    PyErr_SetString ( PyExc_TypeError, "rays is not set yet" );
-    Py_RETURN_NONE;
-  }
+  if ( !Beam_kernelRays ( self ) )
+    return NULL;
 
   nPoint = self->rays->dimensions[0];
   nCol = 18;
-  CShadowBeamWrite ( ( double* ) ( self->rays->data ), nCol, nPoint, ( char* ) FileName );
+  rays = self->rays;
+  Py_INCREF ( rays );
+  SHADOW_BEGIN_KERNEL ( !kernelReentrant )
+  CShadowBeamWrite ( ( double* ) ( rays->data ), nCol, nPoint, ( char* ) FileName );
+  SHADOW_END_KERNEL ( !kernelReentrant )
+  Py_DECREF ( rays );
 
   Py_RETURN_NONE;
 }
@@ -678,10 +783,13 @@ static PyObject* Beam_write ( Shadow_Beam* self, PyObject* args )
 static PyObject* Beam_genSource ( Shadow_Beam* self, PyObject* args )
 {
   Shadow_Source* pySrc = NULL;
+  PyArrayObject* rays;
+  int sync, locked;
+  int seed = 0, stream = 0, subStream = 0;
   npy_intp dims[2];
   npy_intp strides[2];
 
-  if ( !PyArg_ParseTuple ( args, "O", &pySrc ) ) {
+  if ( !PyArg_ParseTuple ( args, "O|iii", &pySrc, &seed, &stream, &subStream ) ) {
     PyErr_SetString ( PyExc_TypeError, "Error passing argument" );
     return NULL;
   }
@@ -695,16 +803,26 @@ static PyObject* Beam_genSource ( Shadow_Beam* self, PyObject* args )
   dims[0] = pySrc->pl.NPOINT;
   dims[1] = 18;
 
-  if ( self->rays!=NULL )
-    Py_DECREF ( self->rays );
-  self->rays = ( PyArrayObject* ) PyArray_New ( &PyArray_Type, 2, dims, NPY_FLOAT64, strides, NULL, sizeof ( double ), NPY_CARRAY|NPY_OWNDATA, NULL );
+  rays = ( PyArrayObject* ) PyArray_New ( &PyArray_Type, 2, dims, NPY_FLOAT64, strides, NULL, sizeof ( double ), NPY_CARRAY|NPY_OWNDATA, NULL );
 
-  if ( ( pySrc->pl.FDISTR==4 ) || ( pySrc->pl.FSOURCE_DEPTH==4 ) || ( pySrc->pl.F_WIGGLER>0 ) ) {
-    CShadowSourceSync ( &(pySrc->pl), ( double* ) ( self->rays->data ) );
+  sync = ( pySrc->pl.FDISTR==4 ) || ( pySrc->pl.FSOURCE_DEPTH==4 ) || ( pySrc->pl.F_WIGGLER>0 );
+  locked = sync || !kernelReentrant;
+  Py_INCREF ( pySrc );
+  SHADOW_BEGIN_KERNEL ( locked )
+  if ( seed != 0 )
+    CShadowRandomStream ( seed, stream, subStream );
+  if ( sync ) {
+    CShadowSourceSync ( &(pySrc->pl), ( double* ) ( rays->data ) );
   }
   else {
-    CShadowSourceGeom ( &(pySrc->pl), ( double* ) ( self->rays->data ) );
+    CShadowSourceGeom ( &(pySrc->pl), ( double* ) ( rays->data ) );
   }
+  SHADOW_END_KERNEL ( locked )
+  Py_DECREF ( pySrc );
+
+  if ( self->rays!=NULL )
+    Py_DECREF ( self->rays );
+  self->rays = rays;
 
   Py_RETURN_NONE;
 }
@@ -713,9 +831,12 @@ static PyObject* Beam_traceOE ( Shadow_Beam* self, PyObject* args )
 {
   int nPoint;
   int iCount;
+  int locked;
+  int seed = 0, stream = 0, subStream = 0;
   Shadow_OE* pyOe = NULL;
+  PyArrayObject* rays;
 
-  if ( !PyArg_ParseTuple ( args, "Oi", &pyOe, &iCount ) ) {
+  if ( !PyArg_ParseTuple ( args, "Oi|iii", &pyOe, &iCount, &seed, &stream, &subStream ) ) {
     PyErr_SetString ( PyExc_TypeError, "Error passing argument" );
     Py_RETURN_NONE;
   }
@@ -724,12 +845,84 @@ static PyObject* Beam_traceOE ( Shadow_Beam* self, PyObject* args )
     Py_RETURN_NONE;
   }
 
-  if ( self->rays==NULL ) {
-    PyErr_SetString ( PyExc_TypeError, "rays is empty" );
+  if ( !Beam_kernelRays ( self ) )
+    return NULL;
+  nPoint = self->rays->dimensions[0];
+  rays = self->rays;
+  Py_INCREF ( rays );
+  Py_INCREF ( pyOe );
+  locked = !kernelReentrant || pyOe->pl.FWRITE != 3;
+  SHADOW_BEGIN_KERNEL ( locked )
+  if ( seed != 0 )
+    CShadowRandomStream ( seed, stream, subStream );
+  if ( pyOe->prepared )
+    CShadowTraceOEPrepared ( &(pyOe->pl), ( double* ) ( rays->data ), nPoint, iCount );
+  else
+    CShadowTraceOE ( &(pyOe->pl), ( double* ) ( rays->data ), nPoint, iCount );
+  SHADOW_END_KERNEL ( locked )
+  Py_DECREF ( pyOe );
+  Py_DECREF ( rays );
+
+  Py_RETURN_NONE;
+}
+
+
+static PyObject* Beam_traceOEList ( Shadow_Beam* self, PyObject* args )
+{
+  int nPoint, nOE, i;
+  int iCount;
+  int locked;
+  int verbose = 1, seed = 0, subStream = 0;
+  PyObject* pyList = NULL;
+  PyObject* seq;
+  PyArrayObject* rays;
+  poolOE* oes;
+
+  if ( !PyArg_ParseTuple ( args, "Oi|iii", &pyList, &iCount, &verbose, &seed, &subStream ) ) {
+    PyErr_SetString ( PyExc_TypeError, "Error passing argument" );
+    return NULL;
+  }
+  seq = PySequence_Fast ( pyList, "the first argument has to be a list of Shadow.OE instances" );
+  if ( seq==NULL )
+    return NULL;
+  nOE = PySequence_Fast_GET_SIZE ( seq );
+  for ( i=0; i<nOE; i++ ) {
+    if ( !PyObject_TypeCheck ( PySequence_Fast_GET_ITEM ( seq, i ), &ShadowOEType ) ) {
+      Py_DECREF ( seq );
+      PyErr_SetString ( PyExc_TypeError, "the first argument has to be a list of Shadow.OE instances" );
+      return NULL;
+    }
+  }
+  if ( !Beam_kernelRays ( self ) ) {
+    Py_DECREF ( seq );
+    return NULL;
+  }
+  if ( nOE==0 ) {
+    Py_DECREF ( seq );
     Py_RETURN_NONE;
   }
+  oes = ( poolOE* ) malloc ( nOE*sizeof ( poolOE ) );
+  if ( oes==NULL ) {
+    Py_DECREF ( seq );
+    return PyErr_NoMemory ( );
+  }
+  locked = !kernelReentrant;
+  for ( i=0; i<nOE; i++ ) {
+    oes[i] = ( ( Shadow_OE* ) PySequence_Fast_GET_ITEM ( seq, i ) )->pl;
+    if ( oes[i].FWRITE != 3 )
+      locked = 1;
+  }
   nPoint = self->rays->dimensions[0];
-  CShadowTraceOE ( &(pyOe->pl), ( double* ) ( self->rays->data ), nPoint, iCount );
+  rays = self->rays;
+  Py_INCREF ( rays );
+  SHADOW_BEGIN_KERNEL ( locked )
+  CShadowTraceCompoundOE ( oes, nOE, ( double* ) ( rays->data ), nPoint, iCount, verbose, seed, subStream );
+  SHADOW_END_KERNEL ( locked )
+  Py_DECREF ( rays );
+  for ( i=0; i<nOE; i++ )
+    ( ( Shadow_OE* ) PySequence_Fast_GET_ITEM ( seq, i ) )->pl = oes[i];
+  free ( oes );
+  Py_DECREF ( seq );
 
   Py_RETURN_NONE;
 }
@@ -743,8 +936,9 @@ static PyMemberDef Beam_members[] = {
 static PyMethodDef Beam_methods[] = {
   {"load" , ( PyCFunction ) Beam_load , METH_VARARGS, "load Shadow.Beam from a file"},
   {"write", ( PyCFunction ) Beam_write, METH_VARARGS, "write Shadow.Beam on a file" },
-  {"genSource", ( PyCFunction ) Beam_genSource, METH_VARARGS, "generate rays from Source"},
-  {"traceOE", ( PyCFunction ) Beam_traceOE, METH_VARARGS, "trace rays according to a given OE"},
+  {"genSource", ( PyCFunction ) Beam_genSource, METH_VARARGS, "generate rays from Source (optional seed, stream, substream: random stream to use)"},
+  {"traceOE", ( PyCFunction ) Beam_traceOE, METH_VARARGS, "trace rays according to a given OE (optional seed, stream, substream: random stream to use)"},
+  {"traceOEList", ( PyCFunction ) Beam_traceOEList, METH_VARARGS, "trace rays through a list of OEs in a single call (iCount of the first one; optional verbose, seed, substream: oe i uses the random stream (seed,i,substream))"},
   {"SetRayZeros", ( PyCFunction ) beam_SetRayZeros, METH_VARARGS, "set member rays to zeros"},
   {NULL}                                             /* Sentinel          */
 };
@@ -1139,10 +1333,133 @@ static PyObject* FastCDFfromTwoIndex(PyObject *self, PyObject *args){
 
 
 
+static PyObject* loadTable ( PyObject* self, PyObject* args )
+{
+  static const char* kinds[] = { "prerefl", "pre_mlayer", "bragg", "presurface", "screen_external", NULL };
+  const char *Kind, *FileName;
+  int i, pin = 1;
+  FILE* TestFile;
+
+  if ( !PyArg_ParseTuple ( args, "ss|i", &Kind, &FileName, &pin ) ) {
+    PyErr_SetString ( PyExc_TypeError, "arguments should be the kind and the file name!" );
+    return NULL;
+  }
+  for ( i=0; kinds[i]!=NULL && strcmp ( kinds[i], Kind ); i++ );
+  if ( kinds[i]==NULL ) {
+    PyErr_SetString ( PyExc_ValueError, "kind should be prerefl, pre_mlayer, bragg, presurface or screen_external" );
+    return NULL;
+  }
+  TestFile = fopen ( ( char* ) FileName,"r" );
+  if ( TestFile==NULL ) {
+    PyErr_SetString ( PyExc_IOError, "file cannot be opened!" );
+    return NULL;
+  }
+  fclose ( TestFile );
+
+  SHADOW_BEGIN_KERNEL ( !kernelReentrant )
+  CShadowLoadTable ( i+1, ( char* ) FileName, pin );
+  SHADOW_END_KERNEL ( !kernelReentrant )
+  Py_RETURN_NONE;
+}
+
+static PyObject* clearTables ( PyObject* self, PyObject* args )
+{
+  SHADOW_BEGIN_KERNEL ( !kernelReentrant )
+  CShadowClearTables ( );
+  SHADOW_END_KERNEL ( !kernelReentrant )
+  Py_RETURN_NONE;
+}
+
+static PyObject* presurfaceEval ( PyObject* self, PyObject* args )
+{
+  const char* FileName;
+  PyObject *xObj, *yObj, *result = NULL;
+  PyArrayObject *x = NULL, *y = NULL, *out[3] = { NULL, NULL, NULL };
+  double *pds = NULL;
+  int *ier = NULL;
+  int i, k, n, status;
+  FILE* TestFile;
+
+  if ( !PyArg_ParseTuple ( args, "sOO", &FileName, &xObj, &yObj ) ) {
+    PyErr_SetString ( PyExc_TypeError, "arguments should be the file name and the x and y arrays!" );
+    return NULL;
+  }
+  TestFile = fopen ( ( char* ) FileName,"r" );
+  if ( TestFile==NULL ) {
+    PyErr_SetString ( PyExc_IOError, "file cannot be opened!" );
+    return NULL;
+  }
+  fclose ( TestFile );
+  x = ( PyArrayObject* ) PyArray_ContiguousFromAny ( xObj, NPY_FLOAT64, 0, 0 );
+  y = ( PyArrayObject* ) PyArray_ContiguousFromAny ( yObj, NPY_FLOAT64, 0, 0 );
+  if ( x==NULL || y==NULL )
+    goto done;
+  n = PyArray_SIZE ( x );
+  if ( PyArray_SIZE ( y )!=n ) {
+    PyErr_SetString ( PyExc_ValueError, "x and y should have the same size" );
+    goto done;
+  }
+  for ( k=0; k<3; k++ )
+    if ( ( out[k] = ( PyArrayObject* ) PyArray_SimpleNew ( PyArray_NDIM ( x ), PyArray_DIMS ( x ), NPY_FLOAT64 ) )==NULL )
+      goto done;
+  pds = ( double* ) malloc ( 6*sizeof ( double )*( n>0 ? n : 1 ) );
+  ier = ( int* ) malloc ( sizeof ( int )*( n>0 ? n : 1 ) );
+  if ( pds==NULL || ier==NULL ) {
+    PyErr_NoMemory ( );
+    goto done;
+  }
+
+  SHADOW_BEGIN_KERNEL ( !kernelReentrant )
+  status = CShadowPresurfaceEval ( ( char* ) FileName, n, ( double* ) PyArray_DATA ( x ), ( double* ) PyArray_DATA ( y ), pds, ier );
+  SHADOW_END_KERNEL ( !kernelReentrant )
+  if ( status!=0 ) {
+    PyErr_SetString ( PyExc_ValueError, "not a valid presurface file" );
+    goto done;
+  }
+  for ( k=0; k<3; k++ )
+    for ( i=0; i<n; i++ )
+      ( ( double* ) PyArray_DATA ( out[k] ) )[i] = ier[i] ? NAN : pds[6*i+k];
+  result = Py_BuildValue ( "(OOO)", out[0], out[1], out[2] );
+
+done:
+  free ( pds );
+  free ( ier );
+  for ( k=0; k<3; k++ )
+    Py_XDECREF ( out[k] );
+  Py_XDECREF ( x );
+  Py_XDECREF ( y );
+  return result;
+}
+
+static PyObject* skippedRays ( PyObject* self, PyObject* args )
+{
+  int reset = 1;
+  int n;
+
+  if ( !PyArg_ParseTuple ( args, "|i", &reset ) ) {
+    PyErr_SetString ( PyExc_TypeError, "Error passing argument" );
+    return NULL;
+  }
+  SHADOW_BEGIN_KERNEL ( !kernelReentrant )
+  n = CShadowSkippedRays ( reset );
+  SHADOW_END_KERNEL ( !kernelReentrant )
+  return PyLong_FromLong ( n );
+}
+
+static PyObject* isReentrant ( PyObject* self, PyObject* args )
+{
+  return PyBool_FromLong ( kernelReentrant );
+}
+
 /*  Shadow methods none  */
 
 static PyMethodDef Shadow_methods[] = {
   {"saveBeam" ,            ( PyCFunction ) saveBeam,             METH_VARARGS, "save Beam in a new instance Shadow.Beam"},
+  {"isReentrant",          ( PyCFunction ) isReentrant,          METH_NOARGS,  "True if several threads can trace at the same time"},
+  {"loadTable",            ( PyCFunction ) loadTable,            METH_VARARGS, "read a table file (kind: prerefl, pre_mlayer, bragg, presurface or screen_external) once for all the traces of the process, while it is not modified (optional pin, default 1: keep it until clearTables)"},
+  {"clearTables",          ( PyCFunction ) clearTables,          METH_NOARGS,  "forget the table files read by the traces and loadTable"},
+  {"presurfaceEval",       ( PyCFunction ) presurfaceEval,       METH_VARARGS, "evaluate the spline of a presurface file (as used for F_G_S=2) at the points (x,y) at once, returns the arrays z, dz/dx and dz/dy (nan out of the mesh); the normal is (-dz/dx,-dz/dy,1)"},
+  {"skippedRays",          ( PyCFunction ) skippedRays,          METH_VARARGS, "number of lost rays not traced by MIRROR, SCREEN and IMAGE in this thread with SHADOW_SKIP_LOST=1 (optional reset, default 1: count again from 0)"},
   {"vecRotate",            ( PyCFunction ) vecRotate,            METH_VARARGS, NULL},
   {"FastCDFfromZeroIndex", ( PyCFunction ) FastCDFfromZeroIndex, METH_VARARGS, NULL},
   {"FastCDFfromOneIndex",  ( PyCFunction ) FastCDFfromOneIndex,  METH_VARARGS, NULL},
@@ -1175,6 +1492,8 @@ PyInit_ShadowLib( void ){
   if ( PyType_Ready ( &ShadowSourceType ) < 0 ){ printf("failed to load Source"); return NULL; }
   if ( PyType_Ready ( &ShadowOEType ) < 0 ){ printf("failed to load OE"); return NULL; }
   if ( PyType_Ready ( &ShadowBeamType ) < 0 ){ printf("failed to load Beam"); return NULL; }
+  if ( kernelLock==NULL && ( kernelLock = PyThread_allocate_lock() )==NULL ){ printf("failed to allocate kernel lock"); return NULL; }
+  kernelReentrant = CShadowReentrant ( );
   m = PyModule_Create(&shadowModule);
   Py_INCREF ( &ShadowSourceType );
   PyModule_AddObject ( m, "Source", ( PyObject * ) &ShadowSourceType );
@@ -1199,6 +1518,8 @@ initShadowLib ( void )
   if ( PyType_Ready ( &ShadowSourceType ) < 0 ){ printf("failed to load Source"); return; }
   if ( PyType_Ready ( &ShadowOEType ) < 0 ){ printf("failed to load OE"); return; }
   if ( PyType_Ready ( &ShadowBeamType ) < 0 ){ printf("failed to load Beam"); return; }
+  if ( kernelLock==NULL && ( kernelLock = PyThread_allocate_lock() )==NULL ){ printf("failed to allocate kernel lock"); return; }
+  kernelReentrant = CShadowReentrant ( );
 
   m = Py_InitModule3 ( "Shadow.ShadowLib", Shadow_methods, "Extension Module for Ray Tracing Sofware SHADOW" );
 
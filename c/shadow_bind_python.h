@@ -56,6 +56,7 @@ typedef struct {
 typedef struct {
   PyObject_HEAD
   poolOE pl;
+  int prepared;
 } Shadow_OE;
 
 
@@ -85,6 +85,10 @@ int main ( int argc, char** argv )
 
   if ( use_trc && !use_src ) {    
     CShadowBeamGetDim ( &nCol, &nPoint, "begin.dat" );
+    if ( nPoint<0 ) {
+      printf ( "begin.dat has more than 2**31-1 rays (NPOINT=-1)\n" );
+      return 1;
+    }
     ray = CShadowAllocateBeam (nPoint, ray);
     CShadowBeamLoad ( ray, nCol, nPoint, "begin.dat" );
     CShadowBeamWrite( ray, nCol, nPoint, "debug.dat" );
@@ -479,8 +479,7 @@ contains
           	g1%fileName=fileName
        	end if
 
-       	lun = 33
-       	open (unit=lun, file=trim(g1%fileName), status="old", action="read", iostat=iErr)
+       	open (newunit=lun, file=trim(g1%fileName), status="old", action="read", iostat=iErr)
 
        	if (iErr /= 0 ) then
           	print *,"GfFileLoad: Error opening the file: "//trim(g1%fileName)
@@ -542,8 +541,7 @@ contains
 
        	iOut = .false.
 
-		lun = 22
-       	open (unit=lun, file=trim(fileName), status="replace", action="write", iostat=iErr)
+       	open (newunit=lun, file=trim(fileName), status="replace", action="write", iostat=iErr)
        	if (iErr /= 0 ) then
           	print *,"GfFileWrite: Error opening the file: "//trim(fileName)
           	print *,"             Failed writing file."
@@ -56,13 +56,10 @@ contains
        	npoint = 0
        	iflag = 0
     
-       	lun = 21
-    
-       	open(unit=lun, file=fname, status="old", action="read", form="unformatted", iostat=iErr)
+       	open(newunit=lun, file=fname, status="old", action="read", form="unformatted", iostat=iErr)
        	if (iErr /= 0 ) then
         	print *,"beamGetDim: Error opening file: : "//trim(fName)
          	iErr = 1
-       	        close (unit=lun)
          	return
        	end if
     
@@ -73,6 +70,15 @@ contains
        	        close (unit=lun)
             return
        	end if
+
+        ! NPOINT=-1: version 1 header (more than 2**31-1 rays), read by Shadow.beamfile only
+       	if (npoint < 0) then
+        	print *, "beamGetDim: file with more than 2**31-1 rays (NPOINT=-1), "// &
+                     "read it with Shadow.beamfile: "//trim(fname)
+            iErr = 3
+       	        close (unit=lun)
+            return
+       	end if
     
        	close (unit=lun)
        	return
@@ -126,9 +132,7 @@ contains
         ncol = size(ray,1)
         npoint = size(ray,2)
 
-        lun = 21
-
-        open(unit=lun, file=fname, status="old", action="read", form="unformatted", iostat=iErr)
+        open(newunit=lun, file=fname, status="old", action="read", form="unformatted", iostat=iErr)
 
         if (iErr /= 0 ) then
         	print *,"RBEAM Error opening file: "//trim(fName)
@@ -257,8 +261,7 @@ contains
      	integer(kind=ski)     :: 	lun, i, j, k, l
      	integer(kind=ski)     :: 	npoint1, iflag1, ierr1
 
-        lun = 21
-        open(unit=lun,file=fname,status="old",action="read",form="unformatted", iostat=iErr)
+        open(newunit=lun,file=fname,status="old",action="read",form="unformatted", iostat=iErr)
 
         if (iErr /= 0 ) then
           	print *,"beamLoad Error opening file: "//trim(fName)
@@ -357,7 +360,7 @@ integer(kind=ski),             intent(inout)    :: npoint
 integer(kind=ski),             intent(in)       :: iFlag, iForm
 integer(kind=ski),             intent(out)      :: iErr
 
-integer(kind=ski), parameter  :: iounit=20
+integer(kind=ski)             :: iounit
 character(len=80)             :: fformat
 integer(kind=ski)             :: i, j, k, l
 integer(kind=ski)             :: write_only_good_rays,npointOut
@@ -405,7 +408,7 @@ end if
 !! for the VMS version.
 !!
 
-open (unit=iounit, file=fname, status='unknown', form=fformat, iostat=iErr)
+open (newunit=iounit, file=fname, status='unknown', form=fformat, iostat=iErr)
 
 if (iErr /= 0 ) then
     print *,"BEAMIO-WRITE_OFF Error opening file: "//trim(fName)
@@ -534,7 +537,7 @@ integer(kind=ski),intent(in)    :: npoint
 real(kind=skr), dimension(18,npoint),    intent(in)    :: ray
 integer(kind=ski),intent(out)   :: iErr
 
-integer(kind=ski), parameter    :: iounit=20
+integer(kind=ski)               :: iounit
 integer(kind=ski)               :: i, j, k, l
 integer(kind=ski)               :: iform, iflag
 character(len=80)               :: fformat
@@ -555,7 +558,7 @@ else
     fformat = 'FORMATTED'
 end if
 
-open (unit=iounit, file=fname, status='unknown', form=fformat, iostat=iErr)
+open (newunit=iounit, file=fname, status='unknown', form=fformat, iostat=iErr)
 
 if (iErr /= 0 ) then
     print *,"beamWrite Error opening file: "//trim(fName)
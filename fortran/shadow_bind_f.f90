@@ -14,6 +14,8 @@ module shadow_bind_f
     use shadow_beamio
     use shadow_variables
     use shadow_kernel
+    use shadow_math, only : wran_stream
+    use shadow_crl, only : TraceCRL
     use shadow_synchrotron
     use shadow_postprocessors
 
@@ -29,9 +31,12 @@ module shadow_bind_f
 
     public  :: BindShadowPoolSourceLoad, BindShadowPoolSourceWrite
     public  :: BindShadowPoolOELoad, BindShadowPoolOEWrite
-    public  :: BindShadowSourceGeom, BindShadowSourceSync, BindShadowTraceOE
+    public  :: BindShadowSourceGeom, BindShadowSourceSync, BindShadowTraceOE, BindShadowTraceCompoundOE
+    public  :: BindShadowTraceOEPrepared
     public  :: BindShadowBeamWrite, BindShadowBeamgetDim, BindShadowBeamLoad
-    public  :: BindShadowFFresnel2d
+    public  :: BindShadowFFresnel2d, BindShadowReentrant, BindShadowRandomStream
+    public  :: BindShadowLoadTable, BindShadowClearTables, BindShadowPresurfaceEval
+    public  :: BindShadowSkippedRays
 
 contains
 
@@ -122,6 +127,34 @@ contains
 	end subroutine BindShadowTraceOE
 
 
+	!
+	! traces an oe reusing the setup of the previous call (see TraceOE_Prepared)
+	!
+	subroutine BindShadowTraceOEPrepared(oe, ray, nPoint, iCount) bind (C,name="BindShadowTraceOEPrepared")
+        type (poolOE), intent(inout)                        :: oe
+        integer(kind=C_INT), intent(in)                       :: nPoint, iCount
+        real(kind=C_DOUBLE), dimension(18,nPoint), intent(inout) :: ray
+
+        call TraceOE_Prepared(oe, ray, npoint, iCount)
+	end subroutine BindShadowTraceOEPrepared
+
+
+	!
+	! traces the rays through nOE oe's in a single call (see TraceCRL)
+	!
+	subroutine BindShadowTraceCompoundOE(oe, nOE, ray, nPoint, iCount, verbose, seed, substream) bind (C,name="BindShadowTraceCompoundOE")
+        integer(kind=C_INT), intent(in)                       :: nOE, nPoint, iCount
+        integer(kind=C_INT), intent(in)                       :: verbose, seed, substream
+        type (poolOE), dimension(nOE), intent(inout)          :: oe
+        real(kind=C_DOUBLE), dimension(18,nPoint), intent(inout) :: ray
+
+        integer(kind=ski)                                     :: i
+
+        i = iCount
+        call TraceCRL(oe, ray, i, verbose, seed, substream)
+	end subroutine BindShadowTraceCompoundOE
+
+
 	subroutine BindShadowBeamWrite(ray, nPoint, nCol, file, length) bind (C,name="BindShadowBeamWrite")
         integer(kind=C_INT), intent(in)                       :: nPoint, nCol
         real(kind=C_DOUBLE), dimension(18,nPoint), intent(inout) :: ray
@@ -168,6 +201,85 @@ contains
 	end subroutine BindShadowBeamLoad
 
 
+	!
+	! returns 1 if the kernel keeps a separate context per thread
+	! (compiled with OpenMP, see shadow_kernel), so that TraceOE and
+	! SourceGeom can be called concurrently from several threads.
+	!
+	function BindShadowReentrant() bind (C,name="BindShadowReentrant") result(reentrant)
+        integer(kind=C_INT)                                   :: reentrant
+#ifdef _OPENMP
+        reentrant = 1
+#else
+        reentrant = 0
+#endif
+	end function BindShadowReentrant
+
+
+	!
+	! selects the random stream of the calling thread (see WRAN_STREAM)
+	!
+	subroutine BindShadowRandomStream(seed, stream, substream) bind (C,name="BindShadowRandomStream")
+        integer(kind=C_INT), intent(in)                       :: seed, stream, substream
+
+        call wran_stream(seed, stream, substream)
+	end subroutine BindShadowRandomStream
+
+
+	!
+	! reads a table file (kind: see TableLoad) in the table cache of the kernel,
+	! pinned there if pin != 0
+	!
+	subroutine BindShadowLoadTable(kind, file, length, pin) bind (C,name="BindShadowLoadTable")
+        integer(kind=C_INT), intent(in)                       :: kind, pin
+        character(kind=C_CHAR), intent(in)                     :: file(*)
+        integer(kind=C_INT), value, intent(in)                :: length
+
+        character(kind=C_CHAR, len=length)                     :: fname
+        integer(kind=ski), dimension(:), allocatable           :: ivalues
+        real(kind=skr), dimension(:), allocatable              :: rvalues
+
+        call CstringToFstring(file,fname, length)
+        call TableLoad(kind, fname, ivalues, rvalues, pin.ne.0)
+	end subroutine BindShadowLoadTable
+
+
+	subroutine BindShadowClearTables() bind (C,name="BindShadowClearTables")
+        call TableClear()
+	end subroutine BindShadowClearTables
+
+
+	!
+	! evaluates the spline of a presurface file at nPoint points (see PresurfaceEval)
+	!
+	subroutine BindShadowPresurfaceEval(file, length, nPoint, x, y, pds, ier, status) bind (C,name="BindShadowPresurfaceEval")
+        character(kind=C_CHAR), intent(in)                     :: file(*)
+        integer(kind=C_INT), value, intent(in)                :: length
+        integer(kind=C_INT), intent(in)                       :: nPoint
+        real(kind=C_DOUBLE), dimension(nPoint), intent(in)       :: x, y
+        real(kind=C_DOUBLE), dimension(6,nPoint), intent(out)    :: pds
+        integer(kind=C_INT), dimension(nPoint), intent(out)      :: ier
+        integer(kind=C_INT), intent(out)                      :: status
+
+        character(kind=C_CHAR, len=length)                     :: fname
+
+        call CstringToFstring(file,fname, length)
+        call PresurfaceEval(fname, nPoint, x, y, pds, ier, status)
+	end subroutine BindShadowPresurfaceEval
+
+
+	!
+	! returns the number of lost rays skipped by the traces of the calling
+	! thread (SHADOW_SKIP_LOST=1), and sets it to 0 if reset != 0 (see SkippedRays)
+	!
+	function BindShadowSkippedRays(reset) bind (C,name="BindShadowSkippedRays") result(n)
+        integer(kind=C_INT), intent(in)                       :: reset
+        integer(kind=C_INT)                                   :: n
+
+        n = SkippedRays(reset.ne.0)
+	end function BindShadowSkippedRays
+
+
 	subroutine BindShadowFFresnel2D(ray, nPoint, dist, EField, px, pz) bind (C,name="BindShadowFFresnel2D")
         real(kind=C_DOUBLE), dimension(18,nPoint), intent(in)    :: ray
         integer(kind=C_INT), intent(in)                       :: nPoint
@@ -8,11 +8,12 @@ Module shadow_crl !compound refractive lenses
   Use gfile
   Use shadow_variables
   Use shadow_kernel
+  Use shadow_math, only : wran_stream
 
   Implicit None
 
-  Public :: precrl , runcrl, pretransfocator
-  Private :: TraceCRL, ReadCRL
+  Public :: precrl , runcrl, pretransfocator, TraceCRL
+  Private :: ReadCRL
   
   Contains
 
@@ -789,21 +790,33 @@ subroutine runcrl(idefault)
 End SUbroutine runcrl
 
   !
-  ! Private 
+  ! traces the rays through the array of oe's in a single call (a whole
+  ! compound oe). icount is the number of the first oe and is returned
+  ! incremented by the number of oe's. Optional:
+  !   verbose: print a line for each oe (default: yes)
+  !   seed,substream: if seed /= 0, oe number icount uses the random
+  !                   stream (seed,icount,substream) (see WRAN_STREAM)
   !
-  Subroutine TraceCRL(arrOE,ray18,icount)
+  Subroutine TraceCRL(arrOE,ray18,icount,verbose,seed,substream)
     Type(poolOE), dimension(:), intent(inout) :: arrOE
     Real(kind=skr), dimension(:,:), intent(in out) :: ray18
     Integer(kind=ski), intent(inout) :: icount
+    Integer(kind=ski), optional, intent(in) :: verbose, seed, substream
 
     Integer(kind=ski) :: nOE, nPoint
 
     Integer(kind=ski) :: i
+    Logical :: verb
 
+    verb = .true.
+    If (present(verbose)) verb = verbose /= 0
     nOE = size(arrOE)
     nPoint = size(ray18,2)
     Do i=1, nOE
-      print *,'>> TraceCRL: tracing surface ',iCount
+      If (verb) print *,'>> TraceCRL: tracing surface ',iCount
+      If (present(seed)) Then
+        If (seed /= 0) Call WRAN_STREAM (seed,iCount,substream)
+      End If
       Call TraceOE (arrOE(i),ray18,nPoint,iCount)
       iCount = iCount+1
     End Do
@@ -33,6 +33,9 @@ Module shadow_kernel
   	use shadow_variables
   	use shadow_roughness
 	use shadow_globaldefinitions !, only : ski, skr, skc
+#ifdef _OPENMP
+	use omp_lib
+#endif
 
   	implicit none
   
@@ -48,6 +51,9 @@ Module shadow_kernel
   	parameter (i101=101)
   	parameter (i201=201)
   	parameter (i501=501)
+
+	! minimum number of rays per thread in the parallel ray loop
+	integer (kind=ski), parameter :: TRACE_MIN_RAYS = 1000
   
   	!---- Variables ----!
 
@@ -378,6 +384,94 @@ Module shadow_kernel
     real(kind=skr),dimension(500)  :: t_oe, gratio, mlroughness1, mlroughness2
     real(kind=skr)                 :: delo, beto, dele, bete, dels, bets
 
+    !
+    ! Kernel context. When compiled with OpenMP all the variables above
+    ! (and the SAVEd ones in the routines used by traceOE/sourceGeom) are
+    ! threadprivate: each thread that enters the kernel works on its own
+    ! copy, so several OEs can be traced at the same time from different
+    ! threads. Without OpenMP the directives are comments and the kernel
+    ! is the usual single-context one (see BindShadowReentrant).
+    !
+#define EXPAND_STATE_SCALAR(ftype,fkind,name) !$omp threadprivate(name)
+#define EXPAND_STATE_STRING(name,length) !$omp threadprivate(name)
+#define EXPAND_STATE_ARRAYS(ftype,fkind,name,arrdim) !$omp threadprivate(name)
+#include "shadow_kernel_state.def"
+
+#define EXPAND_SOURCE_SCALAR(ctype,ftype,fkind,pytype,name,cformat,fformat,defvalue) !$omp threadprivate(name)
+#define EXPAND_SOURCE_STRING(ctype,ftype,fkind,pytype,name,cformat,fformat,length,defvalue) !$omp threadprivate(name)
+#include "shadow_source.def"
+#define EXPAND_OE_SCALAR(ctype,ftype,fkind,pytype,name,cformat,fformat,defvalue) !$omp threadprivate(name)
+#define EXPAND_OE_STRING(ctype,ftype,fkind,pytype,name,cformat,fformat,length,defvalue) !$omp threadprivate(name)
+#define EXPAND_OE_ARRAYS(ctype,ftype,fkind,pytype,name,cformat,fformat,arrdim,defvalue) !$omp threadprivate(name)
+#define EXPAND_OE_ARRSTR(ctype,ftype,fkind,pytype,name,cformat,fformat,arrdim,length,defvalue) !$omp threadprivate(name)
+#include "shadow_oe_without_repetitions.def"
+
+    !
+    ! Setup cache of TraceOE_Prepared: the kernel variables after the
+    ! setup of the last prepared oe (KernelState, the variables listed in
+    ! shadow_kernel_state.def), the oe before and after tracing (to
+    ! recognize it) and the values used in the setup.
+    !
+    type :: KernelState
+#define EXPAND_STATE_SCALAR(ftype,fkind,name) ftype(kind=fkind) :: name
+#define EXPAND_STATE_STRING(name,length) character(len=length) :: name
+#define EXPAND_STATE_ARRAYS(ftype,fkind,name,arrdim) ftype(kind=fkind), dimension arrdim :: name
+#include "shadow_kernel_state.def"
+    end type KernelState
+
+    type (KernelState)   :: prepared_state
+    type (poolSource)    :: prepared_src
+    type (poolOE)        :: prepared_oe, prepared_in, prepared_end
+    integer(kind=ski)    :: prepared_ncol = 0, prepared_icount = 0
+    logical              :: prepared_valid = .false.
+!$omp threadprivate(prepared_state, prepared_src, prepared_oe, prepared_in, prepared_end)
+!$omp threadprivate(prepared_ncol, prepared_icount, prepared_valid)
+
+    !
+    ! Cache of the tables read by REFLEC, CRYSTAL and GET_REFRACTION_INDEX
+    ! (see TableLoad). It is shared by all the threads of the process, and
+    ! only used inside the critical section shadow_tables.
+    !
+    integer(kind=ski),parameter :: TABLE_PREREFL=1, TABLE_PRE_MLAYER=2, TABLE_BRAGG=3, &
+                                   TABLE_PRESURFACE=4, TABLE_SCREEN_EXTERNAL=5
+    integer(kind=ski),parameter :: TABLE_CACHE_SIZE=64
+    integer,parameter           :: TABLE_HASH_INT = selected_int_kind(18)
+
+    type :: TableEntry
+      integer(kind=ski)                          :: kind = 0
+      character(len=sklen)                       :: path
+      integer(kind=ski)                          :: fsize, used
+      integer(kind=TABLE_HASH_INT),dimension(2)  :: hash
+      logical                                    :: pinned
+      integer(kind=ski),dimension(:),allocatable :: ivalues
+      real(kind=skr),dimension(:),allocatable    :: rvalues
+    end type TableEntry
+
+    type (TableEntry),dimension(TABLE_CACHE_SIZE) :: table_cache
+    integer(kind=ski)                             :: table_clock = 0
+
+    !
+    ! Frames of the facets of a faceted mirror (F_FACET=1) hit by the rays
+    ! (see FacetLookup), emptied by MSETUP. facet_keys(:,i) = IFAC_X, IFAC_Y
+    ! and 0 (empty), 1 (facet) or 2 (no intercept with the baseline);
+    ! facet_frames(:,i) = PF_CENT, PF_NOR, PF_BNOR, PF_TAU.
+    !
+    integer(kind=ski),dimension(:,:),allocatable :: facet_keys
+    real(kind=skr),dimension(:,:),allocatable    :: facet_frames
+    integer(kind=ski)                            :: facet_count = 0
+    logical                                      :: facet_reference = .false.
+!$omp threadprivate(facet_keys, facet_frames, facet_count, facet_reference)
+
+    !
+    ! Rays already lost (RAY(10) < 0) are not traced by MIRROR1, SCREEN
+    ! and IMAGE1 when SHADOW_SKIP_LOST=1 (skip_lost, see TraceOE_Rays): they
+    ! stay as they were when lost. skipped_rays counts them (see
+    ! SkippedRays).
+    !
+    logical                                      :: skip_lost = .false.
+    integer(kind=ski)                            :: skipped_rays = 0
+!$omp threadprivate(skip_lost, skipped_rays)
+
 
   
   !---- Everything FROM HERE is private unless explicitly made public ----!
@@ -394,6 +488,10 @@ Module shadow_kernel
         public :: PoolOEToGlobal,PoolSourceToGlobal
         public :: GlobalToPoolOE,GlobalToPoolSource
         public :: traceoe,Shadow3Trace
+        public :: TraceOE_Prepared, TraceOE_Release
+        public :: TableLoad, TableClear, PresurfaceEval, SkippedRays
+        public :: TABLE_PREREFL, TABLE_PRE_MLAYER, TABLE_BRAGG, TABLE_PRESURFACE
+        public :: TABLE_SCREEN_EXTERNAL
         ! these routines should be moved to shadow_postprocessors
         public :: presurface_translate, prerefl_test, pre_mlayer_scan
   
@@ -623,7 +721,7 @@ Contains
     real(kind=skr)  :: XMIN, YMIN, ZMIN, XS, X1S, YS, Y1S, ZS, Z1S
     real(kind=skr)  :: X1MIN, Y1MIN, Z1MIN
     integer(kind=ski) :: NX, NX1, NY, NY1, NZ, NZ1
-    integer(kind=ski) :: ierr,i,j,jx,j1x,jy,j1y,jx1,jy1,jz,jz1
+    integer(kind=ski) :: ierr,i,j,jx,j1x,jy,j1y,jx1,jy1,jz,jz1,iunit
     real(kind=skr)  :: distSlit, h_min, h_max, v_min, v_max
     real(kind=skr)  :: rdist, posSlitH, posSlitV
 
@@ -632,6 +730,9 @@ Contains
          XS, X1S, YS, Y1S, ZS, Z1S, &
          X1MIN, Y1MIN, Z1MIN, &
          distSlit, h_min, h_max, v_min, v_max
+!$omp threadprivate(IX, IY, IZ, XMIN, YMIN, ZMIN, NX, NX1, NY, NY1, NZ, NZ1, &
+!$omp&   XS, X1S, YS, Y1S, ZS, Z1S, X1MIN, Y1MIN, Z1MIN, &
+!$omp&   distSlit, h_min, h_max, v_min, v_max)
     !C 	
     !C  checks for initialization
     !C 
@@ -639,41 +740,41 @@ Contains
        IF (F_BOUND_SOUR .eq. 1) THEN !  histo3 method
          !OPEN (30, FILE=FILE_BOUND, STATUS='OLD', FORM='UNFORMATTED', IOSTAT=IERR)
          ! changed to formatted, srio@esrf.eu 20120525
-         OPEN (30, FILE=FILE_BOUND, STATUS='OLD', FORM='FORMATTED', IOSTAT=IERR)
+         OPEN (NEWUNIT=iunit, FILE=FILE_BOUND, STATUS='OLD', FORM='FORMATTED', IOSTAT=IERR)
          IF (IERR.NE.0) THEN
             WRITE(6,*)'Error opening file: '//trim(FILE_BOUND)
             STOP 'Fatal error. Aborted'
          END IF
-         READ (30,*,ERR=101)    NX, XMIN, XS
-         READ (30,*,ERR=101)    NX1, X1MIN, X1S
-         READ (30,*,ERR=101)    NY, YMIN, YS
-         READ (30,*,ERR=101)    NY1, Y1MIN, Y1S
-         READ (30,*,ERR=101)    NZ, ZMIN, ZS
-         READ (30,*,ERR=101)    NZ1, Z1MIN, Z1S
+         READ (iunit,*,ERR=101)    NX, XMIN, XS
+         READ (iunit,*,ERR=101)    NX1, X1MIN, X1S
+         READ (iunit,*,ERR=101)    NY, YMIN, YS
+         READ (iunit,*,ERR=101)    NY1, Y1MIN, Y1S
+         READ (iunit,*,ERR=101)    NZ, ZMIN, ZS
+         READ (iunit,*,ERR=101)    NZ1, Z1MIN, Z1S
          !DO 11 I=1,NX
          DO I=1,NX
-            READ (30,*,ERR=101)    (IX(I,J),J=1,NX1)
+            READ (iunit,*,ERR=101)    (IX(I,J),J=1,NX1)
 !11       CONTINUE
          END DO
          !DO 21 I=1,NY
          DO I=1,NY
-            READ (30,*,ERR=101)    (IY(I,J),J=1,NY1)
+            READ (iunit,*,ERR=101)    (IY(I,J),J=1,NY1)
 !21       CONTINUE
          END DO
          !DO 31 I=1,NZ
          DO I=1,NZ
-            READ (30,*,ERR=101)    (IZ(I,J),J=1,NZ1)
+            READ (iunit,*,ERR=101)    (IZ(I,J),J=1,NZ1)
 !31       CONTINUE
          END DO
          WRITE(6,*)'Phase space boundaries file read succesfully.'
        ELSE ! method 2, slit
-         OPEN (30, FILE=FILE_BOUND, STATUS='OLD', FORM='FORMATTED', IOSTAT=IERR)
+         OPEN (NEWUNIT=iunit, FILE=FILE_BOUND, STATUS='OLD', FORM='FORMATTED', IOSTAT=IERR)
          IF (IERR.NE.0) THEN
             WRITE(6,*)'Error opening file: '//trim(FILE_BOUND)
             STOP 'Fatal error. Aborted'
          END IF
 !!print *,'Reding file....'
-         READ (30,*,ERR=101)    distSlit,h_min,h_max,v_min,v_max
+         READ (iunit,*,ERR=101)    distSlit,h_min,h_max,v_min,v_max
          !READ (30,*,ERR=101)    distSlit
          !READ (30,ERR=101)    distSlit,h_min,h_max,v_min,v_max
          !READ (30,ERR=101)    distSlit,h_min,h_max,v_min,v_max
@@ -683,7 +784,7 @@ Contains
          WRITE(6,*)'File with slit boundaries read succesfully.'
        END IF
 
-       CLOSE (30)
+       CLOSE (iunit)
        RETURN
 101    WRITE(6,*)'Error reading from file '//trim(FILE_BOUND)
        STOP
@@ -824,6 +925,8 @@ Contains
     COMPLEX*16	br_c1,br_c2                         !laue&perfect
     REAL(KIND=skr)		CA(3),CB(3),FOA,F1A,F2A,FOB,F1B,F2B
     INTEGER(KIND=ski)	ATNUM_A,ATNUM_B
+    INTEGER(KIND=ski),DIMENSION(:),ALLOCATABLE :: IVALUES
+    REAL(KIND=skr),DIMENSION(:),ALLOCATABLE    :: RVALUES
     ! C
     ! C SAVE the variables that need to be saved across subsequent invocations
     ! C of this subroutine. Note: D_SPACING is not included in the SAVE block
@@ -834,31 +937,34 @@ Contains
          GA,GA_BAR,GB,GB_BAR, &
          CA,CB, &
          NREFL, ENERGY, FP_A, FPP_A, FP_B, FPP_B
+!$omp threadprivate(I_LATT, RN, ATNUM_A, ATNUM_B, TEMPER, GA, GA_BAR, GB, GB_BAR, &
+!$omp&   CA, CB, NREFL, ENERGY, FP_A, FPP_A, FP_B, FPP_B)
     ! C
     CI	= (0.0D0,1.0D0)
     ! C
     ! C If flag is < 0, reads in the reflectivity data
     ! C
     IF (KWHAT.LT.0) THEN
-       OPEN (25,FILE=FILE_REFL,STATUS='OLD', FORM='FORMATTED', IOSTAT=iErr)
-        ! srio added test
-        if (iErr /= 0 ) then
-          print *,"MIRROR: File not found: "//trim(file_refl)
-          stop 'File not found. Aborted.'
-        end if
-       READ (25,*) I_LATT,RN,D_SPACING
-       READ (25,*) ATNUM_A,ATNUM_B,TEMPER
-       READ (25,*) GA
-       READ (25,*) GA_BAR
-       READ (25,*) GB
-       READ (25,*) GB_BAR
-       READ (25,*) CA(1),CA(2),CA(3)
-       READ (25,*) CB(1),CB(2),CB(3)
-       READ (25,*) NREFL
-       DO 199 I = 1, NREFL
-          READ (25,*) ENERGY(I), FP_A(I), FPP_A(I)
-199    READ (25,*)    FP_B(I), FPP_B(I)
-       CLOSE (25)
+       ! the file is read once per process (see TableReadBragg)
+       CALL TableLoad (TABLE_BRAGG,FILE_REFL,IVALUES,RVALUES)
+       I_LATT    = IVALUES(1)
+       ATNUM_A   = IVALUES(2)
+       ATNUM_B   = IVALUES(3)
+       NREFL     = IVALUES(4)
+       RN        = RVALUES(1)
+       D_SPACING = RVALUES(2)
+       TEMPER    = RVALUES(3)
+       GA        = CMPLX(RVALUES(4),RVALUES(5),KIND=skr)
+       GA_BAR    = CMPLX(RVALUES(6),RVALUES(7),KIND=skr)
+       GB        = CMPLX(RVALUES(8),RVALUES(9),KIND=skr)
+       GB_BAR    = CMPLX(RVALUES(10),RVALUES(11),KIND=skr)
+       CA        = RVALUES(12:14)
+       CB        = RVALUES(15:17)
+       ENERGY(1:NREFL) = RVALUES(18:17+NREFL)
+       FP_A(1:NREFL)   = RVALUES(18+NREFL:17+2*NREFL)
+       FPP_A(1:NREFL)  = RVALUES(18+2*NREFL:17+3*NREFL)
+       FP_B(1:NREFL)   = RVALUES(18+3*NREFL:17+4*NREFL)
+       FPP_B(1:NREFL)  = RVALUES(18+4*NREFL:17+5*NREFL)
        RETURN
     ELSE
        ! C
@@ -1375,29 +1481,29 @@ Contains
     CALL	DOT	(VTAN,HYPER1,ADJUST)
     RULING	=   ADJUST*1.0D8/HOLO_W
     
-    OPEN  (24,FILE='RULING',STATUS='UNKNOWN')
-    REWIND (24)
+    OPEN  (NEWUNIT=iunit,FILE='RULING',STATUS='UNKNOWN')
+    REWIND (iunit)
     
     IF (F_VIRTUAL.EQ.0) THEN
-       WRITE (24,*) 'Source:	REAL,		Exit:	REAL'
+       WRITE (iunit,*) 'Source:	REAL,		Exit:	REAL'
     ELSE IF (F_VIRTUAL.EQ.1) THEN
-       WRITE (24,*) 'Source:	REAL,		Exit:	VIRTUAL'
+       WRITE (iunit,*) 'Source:	REAL,		Exit:	VIRTUAL'
     ELSE IF (F_VIRTUAL.EQ.2) THEN
-       WRITE (24,*) 'Source:	VIRTUAL,	Exit:	REAL'
+       WRITE (iunit,*) 'Source:	VIRTUAL,	Exit:	REAL'
     ELSE IF (F_VIRTUAL.EQ.3) THEN
-       WRITE (24,*) 'Source:	VIRTUAL,	Exit:	VIRTUAL'
+       WRITE (iunit,*) 'Source:	VIRTUAL,	Exit:	VIRTUAL'
     END IF
-    WRITE (24,1010) HOLO_DEL
-    WRITE (24,1020) HOLO_R1
-    WRITE (24,1030) HOLO_GAM
-    WRITE (24,1040) HOLO_R2
-    WRITE (24,1200) HOLO1(1),HOLO1(2),HOLO1(3)
-    WRITE (24,1210) HOLO2(1),HOLO2(2),HOLO2(3)
-    WRITE (24,1220) VTAN(1),VTAN(2),VTAN(3)
-    WRITE (24,1000)
-    WRITE (24,*)	RULING
-    WRITE (24,1100)
-    CLOSE (24)
+    WRITE (iunit,1010) HOLO_DEL
+    WRITE (iunit,1020) HOLO_R1
+    WRITE (iunit,1030) HOLO_GAM
+    WRITE (iunit,1040) HOLO_R2
+    WRITE (iunit,1200) HOLO1(1),HOLO1(2),HOLO1(3)
+    WRITE (iunit,1210) HOLO2(1),HOLO2(2),HOLO2(3)
+    WRITE (iunit,1220) VTAN(1),VTAN(2),VTAN(3)
+    WRITE (iunit,1000)
+    WRITE (iunit,*)	RULING
+    WRITE (iunit,1100)
+    CLOSE (iunit)
     RETURN
 1000 FORMAT (1X,'The ruling density at the origin is : ')
 1010 FORMAT (1X,'Entrance slit side incidence angle : ',G19.12)
@@ -1482,6 +1588,11 @@ Contains
        
        ! ** Checks if the ray has been reflected by the mirror.
        
+       IF (skip_lost.AND.RAY(10,J).LT.0.0D0) THEN
+          skipped_rays = skipped_rays + 1
+          IF (N_PLATES.GT.0) RAY_STORE(1:6,J) = RAY(1:6,J)
+          GO TO 100
+       END IF
        IF (RAY(10,J).LT.-1.0D6)  THEN
           GO TO 100
        END IF
@@ -1613,6 +1724,7 @@ Contains
        SLTILT= TORAD*SLTILT
        
        DO 200 ICHECK=1,NPOINT
+          IF (skip_lost.AND.RAY(10,ICHECK).LT.0.0D0) GO TO 200
           XNEW = RAY(1,ICHECK)*COS(SLTILT) + &
                RAY(3,ICHECK)*SIN(SLTILT)
           ZNEW = RAY(3,ICHECK)*COS(SLTILT) - &
@@ -1897,7 +2009,7 @@ Contains
     integer(kind=ski)            :: kount,iwhich,i_write,j
 
     character(len=sklen)         :: stmp
-    integer(kind=ski)            :: eof,itmp
+    integer(kind=ski)            :: eof,itmp,iunit,iunit2
     real(kind=skr),dimension(24) :: central_old
 
     WRITE(6,*)'Call to OPTAXIS'
@@ -2073,8 +2185,8 @@ Contains
     ! srio@esrf.eu 20110412 avoid writing optax.xx if FWRITE=3
     IF (FWRITE.NE.3) THEN 
 
-    OPEN (UNIT=23,FILE= FFILE,STATUS='UNKNOWN')
-    REWIND (23)
+    OPEN (NEWUNIT=iunit,FILE= FFILE,STATUS='UNKNOWN')
+    REWIND (iunit)
 
 !    ! method 1
 !    DO I_WRITE=1,I_MIRROR
@@ -2094,25 +2206,27 @@ Contains
        IF (I_MIRROR.GT.1) THEN 
          itmp = I_MIRROR-1
          CALL  FNAME (FFILE,'optax',itmp,izero)
-         OPEN (UNIT=24,FILE= FFILE,STATUS='UNKNOWN',IOSTAT=eof)
-         REWIND (24)
-         DO WHILE (eof == 0)
-            read(24,'(a)', IOSTAT=eof) stmp
-            if (eof == 0) write(23,'(a)') trim(stmp)
-         END DO
-         CLOSE(24)
+         OPEN (NEWUNIT=iunit2,FILE= FFILE,STATUS='UNKNOWN',IOSTAT=eof)
+         IF (eof == 0) THEN
+           REWIND (iunit2)
+           DO WHILE (eof == 0)
+              read(iunit2,'(a)', IOSTAT=eof) stmp
+              if (eof == 0) write(iunit,'(a)') trim(stmp)
+           END DO
+           CLOSE(iunit2)
+         END IF
        END IF
        !I_WRITE=I_MIRROR
-       WRITE (23,*) I_MIRROR
-       WRITE (23,*) ( CENTRAL(J), J =  1,3)
-       WRITE (23,*) ( CENTRAL(J), J =  4,6)
-       WRITE (23,*) ( CENTRAL(J), J =  7,9)
-       WRITE (23,*) ( CENTRAL(J), J =10,12)
-       WRITE (23,*) ( CENTRAL(J), J =13,15)
-       WRITE (23,*) ( CENTRAL(J), J =16,18)
-       WRITE (23,*) ( CENTRAL(J), J =19,21)
-       WRITE (23,*) ( CENTRAL(J), J =22,24)
-    CLOSE (23)
+       WRITE (iunit,*) I_MIRROR
+       WRITE (iunit,*) ( CENTRAL(J), J =  1,3)
+       WRITE (iunit,*) ( CENTRAL(J), J =  4,6)
+       WRITE (iunit,*) ( CENTRAL(J), J =  7,9)
+       WRITE (iunit,*) ( CENTRAL(J), J =10,12)
+       WRITE (iunit,*) ( CENTRAL(J), J =13,15)
+       WRITE (iunit,*) ( CENTRAL(J), J =16,18)
+       WRITE (iunit,*) ( CENTRAL(J), J =19,21)
+       WRITE (iunit,*) ( CENTRAL(J), J =22,24)
+    CLOSE (iunit)
     END IF
     WRITE(6,*)'Exit from OPTAXIS'
   End Subroutine optaxis
@@ -2296,51 +2410,16 @@ Contains
     real(kind=skr),dimension(8)  :: h_output88
     equivalence (h_output88(1), H_OUTPUT(1))
     
-    DIMENSION	XIN(3),P(3),V(3),COEFF(5),TEST1(4),TEST2(4)
+    DIMENSION	XIN(3),P(3),V(3),COEFF(5),TEST1(4),ROOTS(4)
     ANSWER	=   0.0D0
     P(1)	= XIN(1)
     P(2)	= XIN(2)
     ! C
     ! C move the ref. frame to the torus one.
     ! C
-    IF (F_TORUS.EQ.0) THEN
-       P(3)	= XIN(3) - R_MAJ - R_MIN   
-    ELSE IF (F_TORUS.EQ.1) THEN
-       P(3)	= XIN(3) - R_MAJ + R_MIN   
-    ELSE IF (F_TORUS.EQ.2) THEN
-       P(3)	= XIN(3) + R_MAJ - R_MIN   
-    ELSE IF (F_TORUS.EQ.3) THEN
-       P(3)	= XIN(3) + R_MAJ + R_MIN   
-    END IF
+    P(3)	= QuarticZ(XIN(3))
     ! ** Evaluates the quartic coefficients **
-    A	= R_MAJ**2 - R_MIN**2
-    B	= - (R_MAJ**2 + R_MIN**2)
-    AA	= P(1)*V(1)**3 + P(2)*V(2)**3 + P(3)*V(3)**3 + &
-         V(1)*V(2)**2*P(1) + V(1)**2*V(2)*P(2) + &
-         V(1)*V(3)**2*P(1) + V(1)**2*V(3)*P(3) + &
-         V(2)*V(3)**2*P(2) + V(2)**2*V(3)*P(3)
-    AA	= 4*AA
-    BB	= 3*P(1)**2*V(1)**2 + 3*P(2)**2*V(2)**2 +  &
-         3*P(3)**2*V(3)**2 + &
-         V(2)**2*P(1)**2 + V(1)**2*P(2)**2 +  &
-         V(3)**2*P(1)**2 + V(1)**2*P(3)**2 + &
-         V(3)**2*P(2)**2 + V(2)**2*P(3)**2 + &
-         A*V(1)**2 + B*V(2)**2 + B*V(3)**2 + &
-         4*V(1)*V(2)*P(1)*P(2) +  &
-         4*V(1)*V(3)*P(1)*P(3) +  &
-         4*V(2)*V(3)*P(2)*P(3)
-    BB	= 2*BB
-    CC	= P(1)**3*V(1) + P(2)**3*V(2) + P(3)**3*V(3) + &
-         P(2)*P(1)**2*V(2) + P(1)*P(2)**2*V(1) + &
-         P(3)*P(1)**2*V(3) + P(1)*P(3)**2*V(1) + &
-         P(3)*P(2)**2*V(3) + P(2)*P(3)**2*V(2) + &
-         A*V(1)*P(1) + B*V(2)*P(2) + B*V(3)*P(3)
-    CC	= 4*CC
-    DD	= P(1)**4 + P(2)**4 + P(3)**4 + &
-         2*P(1)**2*P(2)**2 + 2*P(1)**2*P(3)**2 + &
-         2*P(2)**2*P(3)**2 + &
-         2*A*P(1)**2 + 2*B*P(2)**2 + 2*B*P(3)**2 + &
-         A**2
+    CALL QuarticCoeff (P(1),P(2),P(3),V(1),V(2),V(3),AA,BB,CC,DD)
     ! D	WRITE(6,*)' AA ',AA
     ! D	WRITE(6,*)' BB ',BB
     ! D	WRITE(6,*)' CC ',CC
@@ -2357,9 +2436,92 @@ Contains
     IF (IER.NE.0) WRITE(6,*)'Watch out: error in ZRPOLY',IER
     DO 91 I = 1,4
        TEST1(I)	= DIMAG( H_OUTPUT(I) )
+       ROOTS(I)	= DREAL( H_OUTPUT(I) )
 91  CONTINUE
-    CHECK 	= TEST1(1)*TEST1(2)*TEST1(3)*TEST1(4)
-    IF (CHECK.NE.0.0D0) THEN
+    CALL QuarticPick (ROOTS, TEST1.EQ.0.0D0, ANSWER, I_RES)
+  End Subroutine quartic
+
+  !
+  ! z of a point of the mirror frame in the torus frame (see QUARTIC)
+  !
+  Elemental Function QuarticZ (Z) result(ZT)
+    implicit none
+    real(kind=skr),intent(in) :: Z
+    real(kind=skr)            :: ZT
+
+    ZT = Z
+    IF (F_TORUS.EQ.0) THEN
+       ZT	= Z - R_MAJ - R_MIN   
+    ELSE IF (F_TORUS.EQ.1) THEN
+       ZT	= Z - R_MAJ + R_MIN   
+    ELSE IF (F_TORUS.EQ.2) THEN
+       ZT	= Z + R_MAJ - R_MIN   
+    ELSE IF (F_TORUS.EQ.3) THEN
+       ZT	= Z + R_MAJ + R_MIN   
+    END IF
+  End Function QuarticZ
+
+  !
+  ! coefficients of the quartic t**4+AA*t**3+BB*t**2+CC*t+DD of the intercepts
+  ! of the ray P+t*V with the torus (P in the torus frame). Elemental, so the
+  ! coefficients of many rays are computed at once by QUARTIC_BATCH.
+  !
+  Elemental Subroutine QuarticCoeff (P1,P2,P3,V1,V2,V3,AA,BB,CC,DD)
+    implicit none
+    real(kind=skr),intent(in)  :: P1,P2,P3,V1,V2,V3
+    real(kind=skr),intent(out) :: AA,BB,CC,DD
+    real(kind=skr)             :: A,B
+
+    A	= R_MAJ**2 - R_MIN**2
+    B	= - (R_MAJ**2 + R_MIN**2)
+    AA	= P1*V1**3 + P2*V2**3 + P3*V3**3 + &
+         V1*V2**2*P1 + V1**2*V2*P2 + &
+         V1*V3**2*P1 + V1**2*V3*P3 + &
+         V2*V3**2*P2 + V2**2*V3*P3
+    AA	= 4*AA
+    BB	= 3*P1**2*V1**2 + 3*P2**2*V2**2 +  &
+         3*P3**2*V3**2 + &
+         V2**2*P1**2 + V1**2*P2**2 +  &
+         V3**2*P1**2 + V1**2*P3**2 + &
+         V3**2*P2**2 + V2**2*P3**2 + &
+         A*V1**2 + B*V2**2 + B*V3**2 + &
+         4*V1*V2*P1*P2 +  &
+         4*V1*V3*P1*P3 +  &
+         4*V2*V3*P2*P3
+    BB	= 2*BB
+    CC	= P1**3*V1 + P2**3*V2 + P3**3*V3 + &
+         P2*P1**2*V2 + P1*P2**2*V1 + &
+         P3*P1**2*V3 + P1*P3**2*V1 + &
+         P3*P2**2*V3 + P2*P3**2*V2 + &
+         A*V1*P1 + B*V2*P2 + B*V3*P3
+    CC	= 4*CC
+    DD	= P1**4 + P2**4 + P3**4 + &
+         2*P1**2*P2**2 + 2*P1**2*P3**2 + &
+         2*P2**2*P3**2 + &
+         2*A*P1**2 + 2*B*P2**2 + 2*B*P3**2 + &
+         A**2
+  End Subroutine QuarticCoeff
+
+  ! C+++
+  ! C	SUBROUTINE	QUARTICPICK
+  ! C
+  ! C	PURPOSE		Picks the intercept on the torus among the roots
+  ! C			of the quartic (ISREAL for the real ones), as
+  ! C			described in QUARTIC.
+  ! C---
+  Subroutine QuarticPick (ROOTS, ISREAL, ANSWER, I_RES)
+    implicit none
+    real(kind=skr),dimension(4),intent(in) :: ROOTS
+    logical,dimension(4),intent(in)        :: ISREAL
+    real(kind=skr),intent(out)             :: ANSWER
+    integer(kind=ski),intent(in out)       :: I_RES
+
+    real(kind=skr),dimension(4) :: TEST2
+    real(kind=skr)              :: TEMP, AMIN, XTEMP
+    integer(kind=ski)           :: I, J, IMIN, N_TEST
+
+    ANSWER	=   0.0D0
+    IF (.NOT.ANY(ISREAL)) THEN
        ! C all the solutions are complex; the beam is completely out of
        ! C of the mirror.
        I_RES	= -1
@@ -2372,9 +2534,9 @@ Contains
        ! C
        ANSWER	= 1.0D+20
        DO 11 I = 1,4 
-          IF (TEST1(I).EQ.0.0D0) THEN
-             IF (ABS(DREAL(H_OUTPUT(I))).LT.ABS(ANSWER)) &
-                  ANSWER = DREAL( H_OUTPUT(I) )
+          IF (ISREAL(I)) THEN
+             IF (ABS(ROOTS(I)).LT.ABS(ANSWER)) &
+                  ANSWER = ROOTS(I)
           END IF
 11     CONTINUE
     ELSE
@@ -2383,8 +2545,8 @@ Contains
        ! C
        N_TEST	= 0
        DO 21 I = 1, 4
-          TEMP=DREAL(H_OUTPUT(I))
-          IF (TEST1(I).EQ.0.0D0) THEN
+          TEMP=ROOTS(I)
+          IF (ISREAL(I)) THEN
              ! C
              ! C In the facet calculation, we only consider the positive
              ! C intercepted length while in the Shadow we consider both the
@@ -2456,7 +2618,201 @@ Contains
     !   I_RES	= - 1
     !   RETURN
     !END IF
-  End Subroutine quartic
+  End Subroutine QuarticPick
+
+  ! C+++
+  ! C	SUBROUTINE	QUARTIC_BATCH
+  ! C
+  ! C	PURPOSE		To compute the intercepts on the torus of all the
+  ! C			rays at once, as INTERCEPT (IFLAG=1) does for each.
+  ! C
+  ! C	INPUT		RAY	the beam (in the mirror frame)
+  ! C			N	number of rays
+  ! C
+  ! C	OUTPUT		TPAR	distance from the start of each ray to its
+  ! C				intercept (see QUARTIC)
+  ! C			IFLAG	0 success, -1 no intercept
+  ! C
+  ! C	ALGORITHM	The start point of each ray is moved to its point
+  ! C			closest to the torus center, which keeps the
+  ! C			coefficients of the quartic well conditioned.
+  ! C			The quartics of all the rays are solved in closed
+  ! C			form (QuarticFerrari), array by array. The rays
+  ! C			for which this is not reliable (tangent rays,
+  ! C			double roots) are solved by QUARTIC (ZRPOLY).
+  ! C			The rays lost before the mirror are skipped.
+  ! C---
+  Subroutine QUARTIC_BATCH (RAY, N, TPAR, IFLAG)
+    implicit none
+    real(kind=skr),dimension(:,:),intent(in)     :: RAY
+    integer(kind=ski),intent(in)                 :: N
+    real(kind=skr),dimension(N),intent(out)      :: TPAR
+    integer(kind=ski),dimension(N),intent(out)   :: IFLAG
+
+    real(kind=skr),dimension(:),allocatable    :: S,VV,P1,P2,P3,C3,C2,C1,C0,R1,R2,R3,R4
+    integer(kind=ski),dimension(:),allocatable :: NREAL
+    logical,dimension(:),allocatable           :: OK
+    real(kind=skr),dimension(3)                :: XIN,V
+    integer(kind=ski)                          :: I,K,IRES
+
+    ALLOCATE (S(N),VV(N),P1(N),P2(N),P3(N),C3(N),C2(N),C1(N),C0(N))
+    ALLOCATE (R1(N),R2(N),R3(N),R4(N),NREAL(N),OK(N))
+    ! C
+    ! C start points in the torus frame, moved along the rays
+    ! C
+    P3 = QuarticZ(RAY(3,1:N))
+    VV = RAY(4,1:N)**2 + RAY(5,1:N)**2 + RAY(6,1:N)**2
+    WHERE (VV.GT.0.0D0)
+       S = -(RAY(1,1:N)*RAY(4,1:N) + RAY(2,1:N)*RAY(5,1:N) + P3*RAY(6,1:N))/VV
+    ELSEWHERE
+       S = 0.0D0
+    END WHERE
+    P1 = RAY(1,1:N) + S*RAY(4,1:N)
+    P2 = RAY(2,1:N) + S*RAY(5,1:N)
+    P3 = P3 + S*RAY(6,1:N)
+    CALL QuarticCoeff (P1,P2,P3,RAY(4,1:N),RAY(5,1:N),RAY(6,1:N),C3,C2,C1,C0)
+    CALL QuarticFerrari (C3,C2,C1,C0,R1,R2,R3,R4,NREAL,OK)
+    ! C
+    ! C pick the intercepts (or solve with ZRPOLY)
+    ! C
+    DO I=1,N
+       TPAR(I) = 0.0D0
+       IFLAG(I) = -1
+       IF (RAY(10,I).LT.-1.0D6) CYCLE
+       IF (skip_lost.AND.RAY(10,I).LT.0.0D0) CYCLE
+       IRES = 1
+       IF (OK(I)) THEN
+          CALL QuarticPick ((/ R1(I),R2(I),R3(I),R4(I) /) + S(I), &
+                            (/ (K.LE.NREAL(I), K=1,4) /), TPAR(I), IRES)
+       ELSE
+          XIN = RAY(1:3,I)
+          V = RAY(4:6,I)
+          CALL QUARTIC (XIN, V, TPAR(I), IRES)
+       END IF
+       IF (IRES.GE.0) IFLAG(I) = 0
+    END DO
+  End Subroutine QUARTIC_BATCH
+
+  ! C+++
+  ! C	SUBROUTINE	QUARTICFERRARI
+  ! C
+  ! C	PURPOSE		Real roots of the quartic t**4+A*t**3+B*t**2+C*t+D
+  ! C			by the Ferrari method: the largest root M of the
+  ! C			resolvent cubic factors the depressed quartic in
+  ! C			two quadratics. M and the roots are polished with
+  ! C			Newton iterations.
+  ! C
+  ! C	OUTPUT		R1..R4	the real roots (the first NREAL)
+  ! C			NREAL	number of real roots (0, 2 or 4)
+  ! C			OK	.false. if the roots cannot be trusted
+  ! C				(double or nearly double roots, M = 0, no
+  ! C				convergence), to be solved by ZRPOLY
+  ! C---
+  Elemental Subroutine QuarticFerrari (A,B,C,D,R1,R2,R3,R4,NREAL,OK)
+    implicit none
+    real(kind=skr),intent(in)    :: A,B,C,D
+    real(kind=skr),intent(out)   :: R1,R2,R3,R4
+    integer(kind=ski),intent(out):: NREAL
+    logical,intent(out)          :: OK
+
+    real(kind=skr),dimension(4) :: Y
+    real(kind=skr)              :: SH,P,Q,R,A2,A1,A0,PP,QQ,DISC,U,M,F,DF,S2,BQ,CQ,T,DT
+    integer(kind=ski)           :: K,L,IT
+
+    OK = .false.
+    NREAL = 0
+    R1 = 0.0D0
+    R2 = 0.0D0
+    R3 = 0.0D0
+    R4 = 0.0D0
+    ! C
+    ! C depressed quartic y**4+P*y**2+Q*y+R, t = y-A/4
+    ! C
+    SH = A/4
+    P = B - 6*SH*SH
+    Q = C - 2*B*SH + 8*SH**3
+    R = D - C*SH + B*SH*SH - 3*SH**4
+    ! C
+    ! C largest root of the resolvent cubic m**3+P*m**2+(P**2/4-R)*m-Q**2/8
+    ! C
+    A2 = P
+    A1 = P*P/4 - R
+    A0 = -Q*Q/8
+    PP = A1 - A2*A2/3
+    QQ = 2*A2**3/27 - A2*A1/3 + A0
+    DISC = (QQ/2)**2 + (PP/3)**3
+    IF (DISC.GT.0.0D0) THEN
+       U = -QQ/2 - SIGN(SQRT(DISC),QQ)
+       U = SIGN(ABS(U)**(1.0D0/3.0D0),U)
+       M = U
+       IF (U.NE.0.0D0) M = U - PP/(3*U)
+    ELSE IF (PP.LT.0.0D0) THEN
+       M = 2*SQRT(-PP/3)*COS(ACOS(MAX(-1.0D0,MIN(1.0D0,3*QQ/(2*PP)*SQRT(-3/PP))))/3)
+    ELSE
+       M = 0.0D0
+    END IF
+    M = M - A2/3
+    DO IT=1,3
+       F = ((M + A2)*M + A1)*M + A0
+       DF = (3*M + 2*A2)*M + A1
+       IF (DF.EQ.0.0D0) EXIT
+       M = M - F/DF
+    END DO
+    ! biquadratic (Q = 0) or not a number
+    IF (.NOT.(M.GT.0.0D0)) RETURN
+    ! C
+    ! C (y**2+S2*y+P/2+M-Q/(2*S2)) * (y**2-S2*y+P/2+M+Q/(2*S2))
+    ! C
+    S2 = SQRT(2*M)
+    DO K=1,2
+       IF (K.EQ.1) THEN
+          BQ = S2
+          CQ = P/2 + M - Q/(2*S2)
+       ELSE
+          BQ = -S2
+          CQ = P/2 + M + Q/(2*S2)
+       END IF
+       DISC = BQ*BQ - 4*CQ
+       ! a (nearly) double root: it may be real or not
+       IF (ABS(DISC).LE.1.0D-8*(BQ*BQ + 4*ABS(CQ))) RETURN
+       IF (DISC.GT.0.0D0) THEN
+          T = -(BQ + SIGN(SQRT(DISC),BQ))/2
+          Y(NREAL+1) = T - SH
+          Y(NREAL+2) = CQ/T - SH
+          NREAL = NREAL + 2
+       END IF
+    END DO
+    ! C
+    ! C polish the roots on the quartic
+    ! C
+    DO K=1,NREAL
+       T = Y(K)
+       DT = 0.0D0
+       DO IT=1,3
+          F = (((T + A)*T + B)*T + C)*T + D
+          DF = ((4*T + 3*A)*T + 2*B)*T + C
+          IF (DF.EQ.0.0D0) RETURN
+          DT = F/DF
+          T = T - DT
+       END DO
+       IF (.NOT.(ABS(DT).LE.1.0D-6*(1.0D0 + ABS(T)))) RETURN
+       Y(K) = T
+    END DO
+    DO K=1,NREAL
+       DO L=K+1,NREAL
+          IF (ABS(Y(K) - Y(L)).LE.1.0D-9*(1.0D0 + ABS(Y(K)))) RETURN
+       END DO
+    END DO
+    IF (NREAL.GE.2) THEN
+       R1 = Y(1)
+       R2 = Y(2)
+    END IF
+    IF (NREAL.EQ.4) THEN
+       R3 = Y(3)
+       R4 = Y(4)
+    END IF
+    OK = .true.
+  End Subroutine QuarticFerrari
   
   
   ! C+++
@@ -3436,15 +3792,15 @@ SUBROUTINE READPOLY (INFILE, IERR)
 31	    CONTINUE
 21	  CONTINUE
 11	CONTINUE
-     	OPEN (20, FILE=INFILE, STATUS='OLD')
-     	  READ (20,*,ERR=10,END=10)	NDEG
+     	OPEN (NEWUNIT=iunit, FILE=INFILE, STATUS='OLD')
+     	  READ (iunit,*,ERR=10,END=10)	NDEG
           I = 0
 41     	 IF (I.GE.0) THEN
-     	   READ (20,*,IOSTAT=IERR) 	I,J,K, PCOEFF(I,J,K)
+     	   READ (iunit,*,IOSTAT=IERR) 	I,J,K, PCOEFF(I,J,K)
        	   IF (I.EQ.-1) GO TO 10
 		 GOTO 41
      	 END IF
-10	CLOSE (20)
+10	CLOSE (iunit)
        	IERR = 0
        	RETURN
       End Subroutine readpoly
@@ -3490,6 +3846,7 @@ SUBROUTINE READPOLY (INFILE, IERR)
 	  CALL	READPOLY(FILE_FAC,IERR)
 	  IF (IERR.NE.0) CALL LEAVE &
      		('MSETUP','Error from READPOLY in Facet',IERR)
+	  CALL	FacetReset
 	END IF
 
 ! C
@@ -3896,7 +4253,7 @@ IF (FMIRR.NE.10) CCC=0.0D0
 ! C CHECK/FIXME: Replace OPEN calls with library routine FOPENR()
 ! C	CALL FOPENR (20, FILE_RIP, 'FORMATTED', IFERR, IOSTAT)
 ! C
-	OPEN (20,FILE=FILE_RIP,STATUS='OLD',IOSTAT=IOSTAT)
+	OPEN (NEWUNIT=iunit,FILE=FILE_RIP,STATUS='OLD',IOSTAT=IOSTAT)
 ! C
 	IF (IOSTAT.NE.0) THEN
 	  CALL LEAVE ('MSETUP', &
@@ -3904,26 +4261,26 @@ IF (FMIRR.NE.10) CCC=0.0D0
      		      FILE_RIP(1:IBLANK(FILE_RIP)) // '".', &
      		      IOSTAT)
 	END IF
-     	READ (20,*)	N_RIP
-	READ (20,*)	F_R_RAN
-	READ (20,*)	IG_SEED
+     	READ (iunit,*)	N_RIP
+	READ (iunit,*)	F_R_RAN
+	READ (iunit,*)	IG_SEED
      	  DO 300 I=1,N_RIP
      	 IF (F_R_RAN.NE.1) THEN
-     	READ (20,*)	X_GR(I)
-     	READ (20,*)	Y_GR(I)
-     	READ (20,*)	AMPLI(I)
-     	READ (20,*)	SIG_X(I)
-     	READ (20,*)	SIG_Y(I)
-     	READ (20,*)	SIGNUM(I)
+     	READ (iunit,*)	X_GR(I)
+     	READ (iunit,*)	Y_GR(I)
+     	READ (iunit,*)	AMPLI(I)
+     	READ (iunit,*)	SIG_X(I)
+     	READ (iunit,*)	SIG_Y(I)
+     	READ (iunit,*)	SIGNUM(I)
      	 ELSE
-     	READ (20,*)	AMPL_IN(I)
-     	READ (20,*)	SIG_XMIN(I)
-     	READ (20,*)	SIG_XMAX(I)
-     	READ (20,*)	SIG_YMIN(I)
-     	READ (20,*)	SIG_YMAX(I)
+     	READ (iunit,*)	AMPL_IN(I)
+     	READ (iunit,*)	SIG_XMIN(I)
+     	READ (iunit,*)	SIG_XMAX(I)
+     	READ (iunit,*)	SIG_YMIN(I)
+     	READ (iunit,*)	SIG_YMAX(I)
          END IF
 300	  CONTINUE
-     	CLOSE (20)
+     	CLOSE (iunit)
 
      	  IF (F_R_RAN.EQ.1) THEN
      		DO 1000 I=1,N_RIP
@@ -3947,26 +4304,26 @@ IF (FMIRR.NE.10) CCC=0.0D0
 ! C CHECK/FIXME: Replace OPEN calls with library routine FOPENR()
 ! C	CALL FOPENW (22, 'SURFACE_ERRORS', 'FORMATTED', IFERR, IOSTAT)
 ! C
-	OPEN (22,STATUS='UNKNOWN',FILE='SURFACE_ERRORS',IOSTAT=IOSTAT)
-	REWIND (22)
+	OPEN (NEWUNIT=iunit,STATUS='UNKNOWN',FILE='SURFACE_ERRORS',IOSTAT=IOSTAT)
 	IF (IOSTAT.NE.0) THEN
 	  CALL LEAVE ('MSETUP', &
      		      'Error opening output file "SURFACE_ERRORS".', &
      		      IOSTAT)
 	END IF
-	WRITE (22,*) 	X_GR
-	WRITE (22,*)    Y_GR
-	WRITE (22,*)	AMPLI
-	WRITE (22,*)	SIG_X
-	WRITE (22,*)	SIG_Y
-	WRITE (22,*)	SIGNUM
-	WRITE (22,*)	'RANDOM'
-	WRITE (22,*)	AMPL_IN
-	WRITE (22,*)	SIG_XMIN
-	WRITE (22,*)	SIG_XMAX
-	WRITE (22,*)	SIG_YMIN
-	WRITE (22,*)	SIG_YMAX
-	CLOSE (22)
+	REWIND (iunit)
+	WRITE (iunit,*) 	X_GR
+	WRITE (iunit,*)    Y_GR
+	WRITE (iunit,*)	AMPLI
+	WRITE (iunit,*)	SIG_X
+	WRITE (iunit,*)	SIG_Y
+	WRITE (iunit,*)	SIGNUM
+	WRITE (iunit,*)	'RANDOM'
+	WRITE (iunit,*)	AMPL_IN
+	WRITE (iunit,*)	SIG_XMIN
+	WRITE (iunit,*)	SIG_XMAX
+	WRITE (iunit,*)	SIG_YMIN
+	WRITE (iunit,*)	SIG_YMAX
+	CLOSE (iunit)
 
      	  ELSE IF (F_G_S.EQ.2) THEN
 ! C
@@ -4001,29 +4358,29 @@ IF (FMIRR.NE.10) CCC=0.0D0
 ! C SET FDEBUG = 1 if you want debugging -- MK.
 ! C
      	IF (FDEBUG.EQ.1) THEN
-	OPEN(UNIT=20, FILE=FFILE, STATUS='UNKNOWN')
-	REWIND (20)
-     	WRITE (20,1110) IWHICH,FMIRR,FCYL
-     	WRITE (20,1110) FHIT_C,FSHAPE,F_CONVEX,F_EXT
-	WRITE (20,1112) 'Mirror radius ',RMIRR
-	WRITE (20,1112) 'Major axis ',AXMAJ
-	WRITE (20,1112) 'Minor axis ',AXMIN
-	WRITE (20,1112) 'Eccentricity',ECCENT
-	WRITE (20,1112) 'Major radius (optical)',R_MAJ+R_MIN
-	WRITE (20,1112) 'Minor radius',R_MIN
-	WRITE (20,1112) 'Parameter',PARAM
-     	WRITE (20,1112) 'Cone angle',CONE_A
-	WRITE (20,1112) 'Image edge ',RLEN1
-	WRITE (20,1112) 'Source edge',RLEN2
-	WRITE (20,1112) 'Right width',RWIDX1
-	WRITE (20,1112) 'Left width',RWIDX2
-	WRITE (20,1112) 'Upper V. div',VDIV1
-	WRITE (20,1112) 'Lower V. div',VDIV2
-	WRITE (20,1112) 'Right H.div',HDIV1
-	WRITE (20,1112) 'Left H. div',HDIV2
-	WRITE (20,1114) 'Quadric coefficients'
-	WRITE (20,1115) (CCC(I), I=1,10)
- 	CLOSE (20)
+	OPEN(NEWUNIT=iunit, FILE=FFILE, STATUS='UNKNOWN')
+	REWIND (iunit)
+     	WRITE (iunit,1110) IWHICH,FMIRR,FCYL
+     	WRITE (iunit,1110) FHIT_C,FSHAPE,F_CONVEX,F_EXT
+	WRITE (iunit,1112) 'Mirror radius ',RMIRR
+	WRITE (iunit,1112) 'Major axis ',AXMAJ
+	WRITE (iunit,1112) 'Minor axis ',AXMIN
+	WRITE (iunit,1112) 'Eccentricity',ECCENT
+	WRITE (iunit,1112) 'Major radius (optical)',R_MAJ+R_MIN
+	WRITE (iunit,1112) 'Minor radius',R_MIN
+	WRITE (iunit,1112) 'Parameter',PARAM
+     	WRITE (iunit,1112) 'Cone angle',CONE_A
+	WRITE (iunit,1112) 'Image edge ',RLEN1
+	WRITE (iunit,1112) 'Source edge',RLEN2
+	WRITE (iunit,1112) 'Right width',RWIDX1
+	WRITE (iunit,1112) 'Left width',RWIDX2
+	WRITE (iunit,1112) 'Upper V. div',VDIV1
+	WRITE (iunit,1112) 'Lower V. div',VDIV2
+	WRITE (iunit,1112) 'Right H.div',HDIV1
+	WRITE (iunit,1112) 'Left H. div',HDIV2
+	WRITE (iunit,1114) 'Quadric coefficients'
+	WRITE (iunit,1115) (CCC(I), I=1,10)
+ 	CLOSE (iunit)
      	END IF
 1110	FORMAT (1X,4(2X,I4))
 1112	FORMAT (1X,A15,T17,G20.13)
@@ -4344,7 +4701,7 @@ End Subroutine mosaic
 SUBROUTINE READ_AXIS (I_MIRROR)
 
    integer(kind=ski), intent(in) :: i_mirror
-   integer(kind=ski)             :: i, j, i_dumm
+   integer(kind=ski)             :: i, j, i_dumm, iunit
  
 ! C
 ! C Find out the name
@@ -4353,10 +4710,10 @@ SUBROUTINE READ_AXIS (I_MIRROR)
 ! C
 ! C Open and read the file
 ! C
-    OPEN (UNIT=20, FILE= FFILE, STATUS='OLD')
+    OPEN (NEWUNIT=iunit, FILE= FFILE, STATUS='OLD')
 
     DO I=1,I_MIRROR
-       READ (20,*) I_DUMM
+       READ (iunit,*) I_DUMM
        !READ (20,*) ( CENTRAL(I,J), J =  1,3)
        !READ (20,*) ( CENTRAL(I,J), J =  4,6)
        !READ (20,*) ( CENTRAL(I,J), J =  7,9)
@@ -4365,226 +4722,336 @@ SUBROUTINE READ_AXIS (I_MIRROR)
        !READ (20,*) ( CENTRAL(I,J), J =16,18)
        !READ (20,*) ( CENTRAL(I,J), J =19,21)
        !READ (20,*) ( CENTRAL(I,J), J =22,24)
-       READ (20,*) ( CENTRAL(J), J =  1,3)
-       READ (20,*) ( CENTRAL(J), J =  4,6)
-       READ (20,*) ( CENTRAL(J), J =  7,9)
-       READ (20,*) ( CENTRAL(J), J =10,12)
-       READ (20,*) ( CENTRAL(J), J =13,15)
-       READ (20,*) ( CENTRAL(J), J =16,18)
-       READ (20,*) ( CENTRAL(J), J =19,21)
-       READ (20,*) ( CENTRAL(J), J =22,24)
+       READ (iunit,*) ( CENTRAL(J), J =  1,3)
+       READ (iunit,*) ( CENTRAL(J), J =  4,6)
+       READ (iunit,*) ( CENTRAL(J), J =  7,9)
+       READ (iunit,*) ( CENTRAL(J), J =10,12)
+       READ (iunit,*) ( CENTRAL(J), J =13,15)
+       READ (iunit,*) ( CENTRAL(J), J =16,18)
+       READ (iunit,*) ( CENTRAL(J), J =19,21)
+       READ (iunit,*) ( CENTRAL(J), J =22,24)
     END DO
 !100 CONTINUE
-     CLOSE (20)
+     CLOSE (iunit)
 End Subroutine read_axis
     !
     !
     !
 
 ! C+++
-! C	SUBROUTINE	REFLEC
-! C
-! C	PURPOSE		To compute the local reflectivity of a mirror or
-! C                     multilayer. Also compute filter transmittivity.
+! C	SUBROUTINE	TABLELOAD
+! C
+! C	PURPOSE		Returns the values of a table file read by
+! C			TableReadPrerefl (kind1 = TABLE_PREREFL),
+! C			TableReadPreMlayer (TABLE_PRE_MLAYER),
+! C			TableReadBragg (TABLE_BRAGG),
+! C			TableReadPresurface (TABLE_PRESURFACE) or
+! C			TableReadScreenExternal (TABLE_SCREEN_EXTERNAL).
+! C			The tables are kept in a cache shared by all the
+! C			threads, keyed by the path, size and content hash
+! C			of the file (see TableFileHash), so each file is
+! C			parsed once per process while it is not changed. When the cache is full the least
+! C			recently used table is dropped, except the pinned
+! C			ones (pin=.true.), that are kept until TableClear.
 ! C
-! C	FLAGS		k_what:  .eq. 0 --> initialization call. Reads
-! C					in data file.
-! C			         .gt. 0 --> performs computations.
-! C			(see below)
+! C---
+SUBROUTINE TableLoad (kind1,file,ivalues,rvalues,pin)
+
+	implicit none
+
+        integer(kind=ski),                        intent(in)  :: kind1
+        character(len=*),                         intent(in)  :: file
+        integer(kind=ski),dimension(:),allocatable,intent(out) :: ivalues
+        real(kind=skr),dimension(:),allocatable,  intent(out) :: rvalues
+        logical,optional,                         intent(in)  :: pin
+
+        character(len=sklen)   :: path
+        integer(kind=ski)      :: fsize, i, slot
+        integer(kind=TABLE_HASH_INT),dimension(2) :: hash
+
+        path = adjustl(file)
+        CALL TableFileHash (path,fsize,hash)
+!$omp critical (shadow_tables)
+        slot = 0
+        DO i=1,TABLE_CACHE_SIZE
+          IF (table_cache(i)%kind.EQ.kind1.AND.table_cache(i)%path.EQ.path) THEN
+            slot = i
+            EXIT
+          END IF
+        END DO
+        IF (slot.NE.0) THEN
+          IF (table_cache(slot)%fsize.NE.fsize.OR.any(table_cache(slot)%hash.NE.hash)) THEN
+            ! the file changed
+            table_cache(slot)%kind = 0
+            IF (.NOT.table_cache(slot)%pinned) slot = 0
+          END IF
+        END IF
+        IF (slot.EQ.0.AND.fsize.GE.0) slot = TableFreeSlot()
+        IF (slot.EQ.0) THEN
+          ! not cacheable (file not found or all the tables pinned)
+          CALL TableRead (kind1,path,ivalues,rvalues)
+        ELSE
+          IF (table_cache(slot)%kind.EQ.0) THEN
+            CALL TableRead (kind1,path,table_cache(slot)%ivalues,table_cache(slot)%rvalues)
+            table_cache(slot)%kind = kind1
+            table_cache(slot)%path = path
+            table_cache(slot)%fsize = fsize
+            table_cache(slot)%hash = hash
+          END IF
+          table_clock = table_clock + 1
+          table_cache(slot)%used = table_clock
+          IF (present(pin)) THEN
+            IF (pin) table_cache(slot)%pinned = .true.
+          END IF
+          ivalues = table_cache(slot)%ivalues
+          rvalues = table_cache(slot)%rvalues
+        END IF
+!$omp end critical (shadow_tables)
+
+End Subroutine TableLoad
+
+! C+++
+! C	SUBROUTINE	TABLECLEAR
 ! C
-! C	ARGUMENTS	[ I ] PIN	: (x,y,z) of the intercept
-! C			[ I ] wnum 	: wavenumber (cm-1) 
-! C			[ I ] sin_ref	: sine of angle from surface
-! C			[ I ] cos_pole  : cosine of angle of normal from pole
-! C			[ O ] R_P 	: p-pol reflection coefficient
-! C			[ O ] R_S 	: s-pol    "  "
-! C			[ I ] ABSOR	: film thickness
-! C			[ O ] ABSOR	: absorption coefficient
+! C	PURPOSE		Empties the cache of TableLoad, including the
+! C			pinned tables.
 ! C
 ! C---
-SUBROUTINE REFLEC (PIN,WNUM,SIN_REF,COS_POLE,R_P,R_S,PHASEP,PHASES,ABSOR,K_WHAT)
+SUBROUTINE TableClear
 
-implicit none
-!IMPLICIT REAL(kind=skr) (A-E,G-H,O-Z)
-!IMPLICIT INTEGER(kind=ski)        (F,I-N)
+	implicit none
 
-real(kind=skr),dimension(3),intent(in)   :: pin
-real(kind=skr),             intent(in)   :: wnum,sin_ref,cos_pole
-integer(kind=ski),          intent(in)   :: k_what
-real(kind=skr),             intent(inout):: absor
-real(kind=skr),             intent(out)  :: r_s,r_p,phases,phasep
+        integer(kind=ski)      :: i
 
-integer(kind=ski), parameter  :: dimMLenergy=300
+!$omp critical (shadow_tables)
+        DO i=1,TABLE_CACHE_SIZE
+          table_cache(i)%kind = 0
+          table_cache(i)%pinned = .false.
+          IF (allocated(table_cache(i)%ivalues)) DEALLOCATE (table_cache(i)%ivalues)
+          IF (allocated(table_cache(i)%rvalues)) DEALLOCATE (table_cache(i)%rvalues)
+        END DO
+!$omp end critical (shadow_tables)
 
-real(kind=skr),dimension(1000)   :: zf1,zf2
-real(kind=skr),dimension(dimMLenergy)    :: ener, &
-            delta_s,beta_s,delta_e,beta_e,delta_o,beta_o
+End Subroutine TableClear
 
-logical,dimension(5)    ::  ele,elo,els
-character(len=sklen)    ::  file_grade
+!
+! returns an empty slot of the table cache, emptying the least recently
+! used one not pinned if needed, or 0 if all of them are pinned
+!
+Function TableFreeSlot () result(slot)
 
-real(kind=skr),dimension(2,101,2,101) :: tspl,gspl
-real(kind=skr),dimension(101)         :: tx,ty,gx,gy
-real(kind=skr),dimension(6)           :: pds
+	implicit none
 
-real(kind=skr)   :: lateral_grade_constant=1D0 !initialization avoids save
-real(kind=skr)   :: lateral_grade_slope=0D0 
-real(kind=skr)   :: lateral_grade_quadratic=0D0 
-integer(kind=ski):: i_grade=0
+        integer(kind=ski)      :: slot, i
 
-real(kind=skr)   :: ab_coeff, cos_ref, del_x, depth0, elfactor, gfact
-real(kind=skr)   :: qmin, qmax, qstep, ratio, phot_ener, ratio1, ratio2
-real(kind=skr)   :: rho, rs1, rs2, tfact, tfilm, wnum0, xin, xlam, yin, gamma1
-integer(kind=ski):: i,j,nrefl,ierr,ier,index1,iunit
-integer(kind=ski):: ngx, ngy, ntx, nty, nin, npair
+        slot = 0
+        DO i=1,TABLE_CACHE_SIZE
+          IF (table_cache(i)%kind.EQ.0.AND..NOT.table_cache(i)%pinned) THEN
+            slot = i
+            RETURN
+          END IF
+          IF (.NOT.table_cache(i)%pinned) THEN
+            IF (slot.EQ.0) THEN
+              slot = i
+            ELSE IF (table_cache(i)%used.LT.table_cache(slot)%used) THEN
+              slot = i
+            END IF
+          END IF
+        END DO
+        IF (slot.NE.0) table_cache(slot)%kind = 0
 
-!dimension	tspl (2,101,2,101),tx(101),ty(101),pds(6)
-!dimension	gspl (2,101,2,101),gx(101),gy(101)
-!external	dbcevl
+End Function TableFreeSlot
 
-! srio danger commented these commons, put in shadow_variables...
-!        common /aaa/ 	t_oe,gratio
-!        common /bbb/ 	delo,beto,dele,bete,dels,bets
+!
+! size (-1 if the file cannot be read) and content hash of a file: two
+! 32-bit FNV-1a hashes of its bytes with different multipliers. The
+! modification time is only known to the second, so a file rewritten
+! with the same size in the same second is only seen by its contents.
+!
+Subroutine TableFileHash (file,fsize,hash)
 
+	implicit none
+
+        character(len=*),                          intent(in)  :: file
+        integer(kind=ski),                         intent(out) :: fsize
+        integer(kind=TABLE_HASH_INT),dimension(2), intent(out) :: hash
+
+        integer(kind=1),dimension(:),allocatable  :: bytes
+        integer(kind=TABLE_HASH_INT)              :: b
+        integer                                   :: iunit, iErr, length, i
+
+        fsize = -1
+        hash = 0
+        OPEN (NEWUNIT=iunit,FILE=trim(file),STATUS='OLD',ACTION='READ',FORM='UNFORMATTED', &
+              ACCESS='STREAM',IOSTAT=iErr)
+        IF (iErr.NE.0) RETURN
+        INQUIRE (UNIT=iunit,SIZE=length)
+        IF (length.LT.0) THEN
+          CLOSE (iunit)
+          RETURN
+        END IF
+        ALLOCATE (bytes(length))
+        IF (length.GT.0) READ (iunit,IOSTAT=iErr) bytes
+        CLOSE (iunit)
+        IF (iErr.NE.0) RETURN
+        hash(1) = 2166136261_TABLE_HASH_INT
+        hash(2) = 2166136261_TABLE_HASH_INT
+        DO i=1,length
+          b = iand(int(bytes(i),TABLE_HASH_INT),255_TABLE_HASH_INT)
+          hash(1) = mod(ieor(hash(1),b)*16777619_TABLE_HASH_INT,4294967296_TABLE_HASH_INT)
+          hash(2) = mod(ieor(hash(2),b)*1103515245_TABLE_HASH_INT,4294967296_TABLE_HASH_INT)
+        END DO
+        fsize = length
+
+End Subroutine TableFileHash
+
+!
+! reads a table file of type kind1 (see TableLoad)
+!
+Subroutine TableRead (kind1,file,ivalues,rvalues)
+
+	implicit none
+
+        integer(kind=ski),                        intent(in)  :: kind1
+        character(len=*),                         intent(in)  :: file
+        integer(kind=ski),dimension(:),allocatable,intent(out) :: ivalues
+        real(kind=skr),dimension(:),allocatable,  intent(out) :: rvalues
+
+        SELECT CASE (kind1)
+        CASE (TABLE_PREREFL)
+          CALL TableReadPrerefl (file,ivalues,rvalues)
+        CASE (TABLE_PRE_MLAYER)
+          CALL TableReadPreMlayer (file,ivalues,rvalues)
+        CASE (TABLE_BRAGG)
+          CALL TableReadBragg (file,ivalues,rvalues)
+        CASE (TABLE_PRESURFACE)
+          CALL TableReadPresurface (file,ivalues,rvalues)
+        CASE (TABLE_SCREEN_EXTERNAL)
+          CALL TableReadScreenExternal (file,ivalues,rvalues)
+        END SELECT
+
+End Subroutine TableRead
+
+! C+++
+! C	SUBROUTINE	TABLEREADPREREFL
 ! C
-! C SAVE the variables that need to be saved across subsequent invocations
-! C of this subroutine.
-! C
-SAVE        QMIN, QMAX, QSTEP, DEPTH0, NREFL, TFILM, &
-            ZF1, ZF2, &
-            NIN, ENER,  &
-            DELTA_S, BETA_S,  &
-            NPAIR, &
-            DELTA_E,BETA_E, &
-            DELTA_O,BETA_O, &
-            TSPL,TX,TY,PDS, &
-            GSPL,GX,GY, &
-            NTX, NTY, NGX, NGY  ! added srio@esrf.eu 20130917
-! C
-! C Initialization call. The ZF1,ZF2 values do NOT correspond to the F1,F2
-! C atomic scattering factors, as they contain a more complex form:
-! C		ZFi = Fi*RADIUS*4*PI*ATOMS
-! C WNUM is the WAVENUMBER (cm-1) of the ray.
-! C ALFA and GAMMA are the complex dielectric function
-! C		EPSILON	  = 1 - ALFA + i*GAMMA		[ i=sqrt(-1) ]
-! C and are dependent ONLY on the material, while the reflectivities
-! C depend of course on the geometry too.
-! C ALFA and GAMMA may be generated by PREREF.EXE in [CERRINA.ABS],
-! C which is based on B.Henke data (see program header for complete reference).
-! C
-! C Two flags control the execution.
-! C 	F_REFL = 0	ZF1,ZF2 are read in as arrays
-! C	       = 1	ALFA and GAMMA are defined in the I/O session
-! C			and thus wavelength independent
-! C	       = 2      d-spacings and optical constants for multilayer
-! C			are read in 
-! C 	K_WHAT = 0	Initialization
-! C		 1	Reflection case
-! C		 2	Absorption case
+! C	PURPOSE		Reads a prerefl file (binary or ascii).
+! C			ivalues = (NREFL)
+! C			rvalues = (QMIN,QMAX,QSTEP,DEPTH0,ZF1(NREFL),ZF2(NREFL))
 ! C
+! C---
+Subroutine TableReadPrerefl (file,ivalues,rvalues)
 
-!todo: compute phases for the usual Fresnel reflection (mirrors). They 
-!      are set to zero here to avoid NaN in Macs. srio@esrf.eu 20150310
-phases = 0.0
-phasep = 0.0
+	implicit none
+
+        character(len=*),                         intent(in)  :: file
+        integer(kind=ski),dimension(:),allocatable,intent(out) :: ivalues
+        real(kind=skr),dimension(:),allocatable,  intent(out) :: rvalues
+
+        real(kind=skr),dimension(4) :: q
+        integer(kind=ski)           :: nrefl, iunit, iErr
 
-IF (K_WHAT.EQ.0) THEN
-    IF (F_REFL.EQ.0) THEN  !mirror
        !
        ! srio@esrf.eu 2012/09/28 change the prerefl file from bin to ascii
        ! (for compatibility with pre_mlayer and bragg, and for allowing 
        ! other codes to create it).
        ! Note: the old binary format is also accepted when reading 
        !  
-        OPEN  (23,FILE=FILE_REFL,STATUS='OLD', &
+        OPEN  (NEWUNIT=iunit,FILE=file,STATUS='OLD', &
                       FORM='UNFORMATTED', IOSTAT=iErr)
         IF (ierr /= 0 ) then
-             PRINT *,"CRYSTAL: Error: File not found: "//TRIM(file_refl)
+             PRINT *,"REFLEC: Error: File not found: "//TRIM(file)
              STOP ' Fatal error: aborted'
         END IF
-
-        READ (23,ERR=222) QMIN,QMAX,QSTEP,DEPTH0
-        READ (23,IOSTAT=iErr) NREFL
-        IF (iErr.NE.0) GOTO 222
-        READ (23,IOSTAT=iErr) (ZF1(I),I=1,NREFL)
-        IF (iErr.NE.0) GOTO 222
-        READ (23,IOSTAT=iErr) (ZF2(I),I=1,NREFL)
-        IF (iErr.NE.0) GOTO 222
-        CLOSE (23)
-        TFILM = ABSOR
-        RETURN
-! this part is for new ascii format
-222     continue
-        close(23)
-        OPEN  (23,FILE=FILE_REFL,STATUS='OLD', &
+        READ (iunit,IOSTAT=iErr) q
+        IF (iErr.EQ.0) READ (iunit,IOSTAT=iErr) nrefl
+        IF (iErr.EQ.0.AND.nrefl.LT.1) iErr = 1
+        IF (iErr.EQ.0) ALLOCATE (rvalues(4+2*nrefl),STAT=iErr)
+        IF (iErr.EQ.0) READ (iunit,IOSTAT=iErr) rvalues(5:4+nrefl)
+        IF (iErr.EQ.0) READ (iunit,IOSTAT=iErr) rvalues(5+nrefl:4+2*nrefl)
+        CLOSE (iunit)
+        IF (iErr.NE.0) THEN
+          ! this part is for new ascii format
+          IF (allocated(rvalues)) DEALLOCATE (rvalues)
+          OPEN  (NEWUNIT=iunit,FILE=file,STATUS='OLD', &
                       FORM='FORMATTED', IOSTAT=iErr)
-        ! srio added test
-        IF (ierr /= 0 ) then
-             PRINT *,"CRYSTAL: Error: File not found: "//TRIM(file_refl)
-             STOP ' Fatal error: aborted'
+          READ (iunit,*) q
+          READ (iunit,*) nrefl
+          ALLOCATE (rvalues(4+2*nrefl))
+          READ (iunit,*) rvalues(5:4+nrefl)
+          READ (iunit,*) rvalues(5+nrefl:4+2*nrefl)
+          CLOSE (iunit)
         END IF
-        READ (23,*) QMIN,QMAX,QSTEP,DEPTH0
-        READ (23,*) NREFL
-        READ (23,*) (ZF1(I),I=1,NREFL)
-        READ (23,*) (ZF2(I),I=1,NREFL)
-        CLOSE (23)
-        TFILM = ABSOR
-        RETURN
-    ELSE IF (F_REFL.EQ.2) THEN  !multilayer
-        ! C
-        ! C  this version allows specification of the individual
-        ! C  layer thicknesses.
-        ! C
-        ! C  input parameters:
-        ! C  npair = no. of layer pairs (npair=0 means an ordinary mirror, 
-        ! C          elo is the mirror
-        ! C  xlam = wavelength (angstroms)
-        ! C  elo = odd layer material
-        ! C  ele = even layer material
-        ! C  els = substrate material
-        ! C  1.0 - delo - i*beto = complex refractive index (odd)
-        ! C  1.0 - dele - i*bete = complex refractive index (even)
-        ! C  t_oe   = thickness t(odd)+t(even) in Angstroms of each layer pair
-        ! C  gratio = gamma ratio t(even)/(t(odd)+t(even))  of each layer pair
-        ! C  phr = grazing angle in radians
-        ! C
-        ! C
-        iunit = 23
-        ! WARNING: I got sometimes segmentation fault around this point. 
-        !          Problem not identified....  srio@esrf.eu 2010-08-26
-        open(unit=iunit,FILE=FILE_REFL,status='OLD',IOSTAT=iErr)
-        ! srio added test
-        if (iErr /= 0 ) then
-            print *,"MIRROR: File not found: "//trim(file_refl)
-            stop 'File not found. Aborted.'
-        end if
-        READ(iunit,*) NIN
-        IF (NIN > dimMLenergy) THEN 
-            print *,'REFLEC: Error: In file: '//trim(file_refl)
-            print *,'               Maximum number of energy points is',dimMLenergy
+        rvalues(1:4) = q
+        ivalues = (/ nrefl /)
+
+End Subroutine TableReadPrerefl
+
+! C+++
+! C	SUBROUTINE	TABLEREADPREMLAYER
+! C
+! C	PURPOSE		Reads a pre_mlayer file (and the spline file of the
+! C			graded multilayer, if any).
+! C			ivalues = (NIN,NPAIR,I_GRADE,NTX,NTY,NGX,NGY)
+! C			rvalues = (ENER,DELTA_S,BETA_S,DELTA_E,BETA_E,DELTA_O,
+! C				  BETA_O (NIN each),T_OE,GRATIO,MLROUGHNESS1,
+! C				  MLROUGHNESS2 (NPAIR each), and TX,TY,TSPL,
+! C				  GX,GY,GSPL if I_GRADE=1 or the three lateral
+! C				  grade coefficients if I_GRADE=2)
+! C
+! C---
+Subroutine TableReadPreMlayer (file,ivalues,rvalues)
+
+	implicit none
+
+        character(len=*),                         intent(in)  :: file
+        integer(kind=ski),dimension(:),allocatable,intent(out) :: ivalues
+        real(kind=skr),dimension(:),allocatable,  intent(out) :: rvalues
+
+        integer(kind=ski), parameter  :: dimMLenergy=300
+
+        real(kind=skr),dimension(:,:),allocatable       :: layers, pairs
+        real(kind=skr),dimension(:,:,:,:),allocatable   :: tspl, gspl
+        real(kind=skr),dimension(101)                   :: tx,ty,gx,gy
+        real(kind=skr),dimension(3)                     :: lateral
+        character(len=sklen)                            :: file_grade
+        integer(kind=ski)  :: nin, npair, i_grade, ntx, nty, ngx, ngy
+        integer(kind=ski)  :: i, j, k, iunit, iunit2, iErr
+
+        ! WARNING: I got sometimes segmentation fault around this point. 
+        !          Problem not identified....  srio@esrf.eu 2010-08-26
+        open(newunit=iunit,FILE=file,status='OLD',IOSTAT=iErr)
+        ! srio added test
+        if (iErr /= 0 ) then
+            print *,"MIRROR: File not found: "//trim(file)
+            stop 'File not found. Aborted.'
+        end if
+        READ(iunit,*) NIN
+        IF (NIN > dimMLenergy) THEN 
+            print *,'REFLEC: Error: In file: '//trim(file)
+            print *,'               Maximum number of energy points is',dimMLenergy
             print *,'               Using number of energy points',NIN
             stop 'Error reaing file. Aborted.'
         END IF 
-        READ(iunit,*) (ENER(I), I = 1, NIN)
-        DO 13 I=1,NIN
-            READ(iunit,*) DELTA_S(I),BETA_S(I)
-13      CONTINUE
-        DO 23 I=1,NIN
-            READ(iunit,*)  DELTA_E(I),BETA_E(I)
-23      CONTINUE
-        DO 33 I=1,NIN
-            READ(iunit,*) DELTA_O(I),BETA_O(I)
-33      CONTINUE
+        ! columns: ener, delta_s, beta_s, delta_e, beta_e, delta_o, beta_o
+        ALLOCATE (layers(NIN,7))
+        READ(iunit,*) (layers(I,1), I = 1, NIN)
+        DO k=2,6,2
+          DO I=1,NIN
+            READ(iunit,*) layers(I,k),layers(I,k+1)
+          END DO
+        END DO
         READ(iunit,*) NPAIR
+        ! columns: t_oe, gratio, mlroughness1, mlroughness2
+        ALLOCATE (pairs(abs(npair),4))
+        pairs = 0.0d0
         if(npair .lt. 0) then ! if npair<0 roughness data is available
             do i = 1, abs(npair)
-                read(iunit,*) t_oe(i),gratio(i),mlroughness1(i),mlroughness2(i)
+                read(iunit,*) pairs(i,1),pairs(i,2),pairs(i,3),pairs(i,4)
             end do 
         else
             do i = 1, npair
-                read(iunit,*) t_oe(i),gratio(i)
-                mlroughness1(i)=0.0
-                mlroughness2(i)=0.0
+                read(iunit,*) pairs(i,1),pairs(i,2)
             end do
         endif
         npair = abs(npair)
@@ -4595,11 +5062,15 @@ IF (K_WHAT.EQ.0) THEN
         ! 0=None
         ! 1=spline files 
         ! 2=quadic coefficients
+        ntx = 0
+        nty = 0
+        ngx = 0
+        ngy = 0
 
         ! spline
         if (i_grade.eq.1) then
           read  (iunit,'(a)') file_grade   
-          OPEN  (45, FILE=adjustl(FILE_GRADE), STATUS='OLD', & 
+          OPEN  (NEWUNIT=iunit2, FILE=adjustl(FILE_GRADE), STATUS='OLD', & 
                 FORM='UNFORMATTED', IOSTAT=iErr)
           ! srio added test
           if (iErr /= 0 ) then
@@ -4607,38 +5078,587 @@ IF (K_WHAT.EQ.0) THEN
             stop 'File not found. Aborted.'
           end if
 
-          READ  (45) NTX, NTY
-          READ  (45) TX,TY
-          !DO 205 I = 1, NTX
-          !DO 205 J = 1, NTY
+          ALLOCATE (tspl(2,101,2,101),gspl(2,101,2,101))
+          tspl = 0.0d0
+          gspl = 0.0d0
+          READ  (iunit2) NTX, NTY
+          READ  (iunit2) TX,TY
           DO I = 1, NTX
             DO J = 1, NTY
-              READ  (45) TSPL(1,I,1,J),TSPL(1,I,2,J),    & ! spline for t
+              READ  (iunit2) TSPL(1,I,1,J),TSPL(1,I,2,J),    & ! spline for t
                          TSPL(2,I,1,J),TSPL(2,I,2,J)
             END DO
           END DO
 
-          READ (45) NGX, NGY
-          READ (45) GX,GY
+          READ (iunit2) NGX, NGY
+          READ (iunit2) GX,GY
           DO I = 1, NGX
             DO J = 1, NGY
-              READ (45) GSPL(1,I,1,J),GSPL(1,I,2,J),    & ! spline for gamma
+              READ (iunit2) GSPL(1,I,1,J),GSPL(1,I,2,J),    & ! spline for gamma
                         GSPL(2,I,1,J),GSPL(2,I,2,J)
             END DO
           END DO
 
-          CLOSE (45)
+          CLOSE (iunit2)
+          rvalues = (/ pack(layers,.true.), pack(pairs,.true.), tx, ty, pack(tspl,.true.), &
+                       gx, gy, pack(gspl,.true.) /)
+        else
+          lateral = (/ 1.0d0, 0.0d0, 0.0d0 /)
+          if (i_grade.eq.2) then  ! quadric coefficients
+            !
+            ! laterally gradded multilayer
+            !
+            read(iunit,*) lateral(1),lateral(2),lateral(3)
+          end if
+          rvalues = (/ pack(layers,.true.), pack(pairs,.true.), lateral /)
         end if
 
-        if (i_grade.eq.2) then  ! quadric coefficients
-          !
-          ! laterally gradded multilayer
-          !
-          read(iunit,*) lateral_grade_constant,lateral_grade_slope, &
-                        lateral_grade_quadratic
+        close(unit=iunit)
+        ivalues = (/ nin, npair, i_grade, ntx, nty, ngx, ngy /)
+
+End Subroutine TableReadPreMlayer
+
+! C+++
+! C	SUBROUTINE	TABLEREADBRAGG
+! C
+! C	PURPOSE		Reads a bragg file.
+! C			ivalues = (I_LATT,ATNUM_A,ATNUM_B,NREFL)
+! C			rvalues = (RN,D_SPACING,TEMPER,GA,GA_BAR,GB,GB_BAR (real
+! C				  and imaginary parts),CA(3),CB(3),ENERGY,FP_A,
+! C				  FPP_A,FP_B,FPP_B (NREFL each))
+! C
+! C---
+Subroutine TableReadBragg (file,ivalues,rvalues)
+
+	implicit none
+
+        character(len=*),                         intent(in)  :: file
+        integer(kind=ski),dimension(:),allocatable,intent(out) :: ivalues
+        real(kind=skr),dimension(:),allocatable,  intent(out) :: rvalues
+
+        complex(kind=skr),dimension(4)               :: g
+        real(kind=skr),dimension(17)                 :: head
+        real(kind=skr),dimension(:,:),allocatable    :: f
+        integer(kind=ski)  :: i_latt, atnum_a, atnum_b, nrefl, i, iunit, iErr
+
+        OPEN (NEWUNIT=iunit,FILE=file,STATUS='OLD', FORM='FORMATTED', IOSTAT=iErr)
+        ! srio added test
+        if (iErr /= 0 ) then
+          print *,"MIRROR: File not found: "//trim(file)
+          stop 'File not found. Aborted.'
         end if
+        READ (iunit,*) I_LATT,head(1),head(2)
+        READ (iunit,*) ATNUM_A,ATNUM_B,head(3)
+        READ (iunit,*) g(1)
+        READ (iunit,*) g(2)
+        READ (iunit,*) g(3)
+        READ (iunit,*) g(4)
+        READ (iunit,*) head(12),head(13),head(14)
+        READ (iunit,*) head(15),head(16),head(17)
+        READ (iunit,*) NREFL
+        ! columns: energy, fp_a, fpp_a, fp_b, fpp_b
+        ALLOCATE (f(NREFL,5))
+        DO I = 1, NREFL
+          READ (iunit,*) f(I,1), f(I,2), f(I,3)
+          READ (iunit,*) f(I,4), f(I,5)
+        END DO
+        CLOSE (iunit)
+        DO I = 1, 4
+          head(2+2*I) = real(g(I))
+          head(3+2*I) = aimag(g(I))
+        END DO
+        rvalues = (/ head, pack(f,.true.) /)
+        ivalues = (/ i_latt, atnum_a, atnum_b, nrefl /)
 
-        close(unit=iunit)
+End Subroutine TableReadBragg
+
+! C+++
+! C	SUBROUTINE	TABLEREADPRESURFACE
+! C
+! C	PURPOSE		Reads a presurface file (unformatted, with the
+! C			spline), or a formatted file with the mesh and
+! C			computes its spline (IBCCCU).
+! C			ivalues = (NX,NY)
+! C			rvalues = (X(501),Y(NY),CSPL(2,501,2,NY)), empty if
+! C				  the mesh is not valid
+! C
+! C	NOTE		If the environment variable SHADOW_SPLINE_SIDECAR
+! C			is set to 1, the spline of a formatted file is
+! C			also kept in the sidecar file <file>.spl (with the
+! C			size and content hash of the file, see
+! C			TableFileHash), so it is computed once and reused by
+! C			the other processes while the file is not changed.
+! C
+! C---
+Subroutine TableReadPresurface (file,ivalues,rvalues)
+
+	implicit none
+
+        character(len=*),                         intent(in)  :: file
+        integer(kind=ski),dimension(:),allocatable,intent(out) :: ivalues
+        real(kind=skr),dimension(:),allocatable,  intent(out) :: rvalues
+
+        real(kind=skr),dimension(:,:),allocatable :: Z
+        real(kind=skr),dimension(:),allocatable   :: wk
+        character(len=sklen) :: stmp
+        integer(kind=ski)    :: nx, ny, ncspl, nw, i, j, ier, iunit, iErr, iTmp2
+
+        ivalues = (/ 0_ski, 0_ski /)
+        inquire( file = file, formatted=stmp)
+        if (trim(stmp) .ne. "FORMATTED") then 
+           OPEN  (NEWUNIT=iunit, FILE=file, STATUS='OLD', FORM='UNFORMATTED')
+           READ  (iunit) NX, NY
+           if ((NX .gt. 100000) .or. (NY .gt. 1000000) .or. & 
+               (NX .lt. 0) .or. (NY .lt. 0)) then 
+               !
+               ! unrealistic numbers mean that the file is perhaps ASCII
+               ! so presurface is not run
+               !
+               stmp = "FORMATTED"
+           else
+               ALLOCATE (rvalues(501+NY+2*501*2*NY))
+               READ  (iunit) rvalues(1:501+NY)
+               READ  (iunit) rvalues(502+NY:)
+           endif
+           CLOSE (iunit)
+        endif
+        if (trim(stmp) .ne. "FORMATTED") then
+           ivalues = (/ NX, NY /)
+           return
+        endif
+
+        if (TableReadSidecar(file,ivalues,rvalues)) return
+        !
+        ! compute "on the fly" the spline as presurface has not been used. 
+        ! This part has been copied from shadow_preprocessors->presurface
+        !
+        OPEN  (NEWUNIT=iunit, FILE=file, STATUS='OLD', FORM='FORMATTED')
+        READ  (iunit,*) NX, NY
+        if ((nx .lt. 4) .or. (ny .lt. 4)) then
+           !print *,'SUR_SPLINE: Error: Not enough points to define arrays. Must be at'
+           !print *,'            least 4 points in each direction.'
+           CLOSE (iunit)
+           ALLOCATE (rvalues(0))
+           return
+        endif
+        if (nx .gt. 501) then
+           print *,'SUR_SPLINE: Error: Array X too large: '
+           print *,'            Maximum allowed is 501 points in X, unlimited in Y.'
+           print *,'            Please retry with smaller arrays.'
+           CLOSE (iunit)
+           ALLOCATE (rvalues(0))
+           return
+        endif
+        ncspl = 2*501*2*NY
+        nw = 2*501*ny+2*max(501,ny)
+        allocate(Z(501,NY))    
+        allocate(WK(nw))
+        ALLOCATE (rvalues(501+NY+ncspl))
+        rvalues = 0.0d0
+        READ (iunit,*) (rvalues(501+I),I=1,NY)
+        DO I=1,NX
+          READ (iunit,*) rvalues(I),(Z(I,J),J=1,NY)
+        END DO
+        CLOSE (iunit)
+        !C
+        !C Call IMSL routine to compute spline. Now use 501 points instead of 101.
+        !C
+        iTmp2 = 501
+        CALL IBCCCU ( Z, rvalues(1:501), NX, rvalues(502:501+NY), NY, &
+                      rvalues(502+NY:), iTmp2, WK, IER)
+        IF (IER.EQ.132) THEN
+            WRITE(6,*)'SUR_SPLINE: Error: The X and/or Y array are/is not ordered properly.' 
+            WRITE(6,*)'            Please check data in '//trim(file)
+            STOP
+        END IF
+        ivalues = (/ NX, NY /)
+        CALL TableWriteSidecar (file,ivalues,rvalues)
+
+End Subroutine TableReadPresurface
+
+! C+++
+! C	SUBROUTINE	TABLEREADSCREENEXTERNAL
+! C
+! C	PURPOSE		Reads the polygons of an external screen file (see
+! C			SCREEN_EXTERNAL_LOAD) and indexes them with a
+! C			uniform grid of NGX*NGZ cells over their bounding
+! C			box: the polygons whose bounding box touches the
+! C			cell K are CELLPOLY(CELLSTART(K):CELLSTART(K+1)-1).
+! C			ivalues = (IFLAG,NPOLY,NPOINT,NGX,NGZ,IVEC1(NPOLY),
+! C				  IVEC2(NPOLY),CELLSTART(NGX*NGZ+1),CELLPOLY)
+! C			rvalues = (XMIN,XMAX,ZMIN,ZMAX,XVEC(NPOINT),
+! C				  ZVEC(NPOINT))
+! C
+! C---
+Subroutine TableReadScreenExternal (file,ivalues,rvalues)
+
+	implicit none
+
+        character(len=*),                         intent(in)  :: file
+        integer(kind=ski),dimension(:),allocatable,intent(out) :: ivalues
+        real(kind=skr),dimension(:),allocatable,  intent(out) :: rvalues
+
+        real(kind=skr),dimension(:),allocatable    :: xvec,zvec
+        integer(kind=ski),dimension(:),allocatable :: ivec1,ivec2,cellstart,cellpoly
+        real(kind=skr)       :: xmin,xmax,zmin,zmax
+        integer(kind=ski)    :: npoly,npoint,iflag,ngx,ngz,ipoly,i1,i2,k1,k2,i,k,pass
+
+        CALL SCREEN_EXTERNAL_GETDIMENSIONS(file,npoly,npoint,iflag)
+        IF (iflag.NE.0.OR.npoly.LT.1.OR.npoint.LT.1) THEN
+          IF (iflag.EQ.0) iflag = -2
+          ivalues = (/ iflag, 0_ski, 0_ski, 0_ski, 0_ski /)
+          ALLOCATE (rvalues(0))
+          RETURN
+        END IF
+        ALLOCATE (xvec(npoint),zvec(npoint),ivec1(npoly),ivec2(npoly))
+        CALL SCREEN_EXTERNAL_LOAD(file,xvec,zvec,ivec1,ivec2,npoly,npoint,iflag)
+        IF (iflag.NE.0) THEN
+          ivalues = (/ iflag, 0_ski, 0_ski, 0_ski, 0_ski /)
+          ALLOCATE (rvalues(0))
+          RETURN
+        END IF
+        xmin = minval(xvec)
+        xmax = maxval(xvec)
+        zmin = minval(zvec)
+        zmax = maxval(zvec)
+        ngx = min(512,max(1,nint(sqrt(dble(npoly)))))
+        ngz = ngx
+        IF (xmax.LE.xmin) ngx = 1
+        IF (zmax.LE.zmin) ngz = 1
+        !
+        ! two passes: count the polygons of each cell, then fill them
+        !
+        ALLOCATE (cellstart(ngx*ngz+1))
+        cellstart = 0
+        DO pass=1,2
+          IF (pass.EQ.2) THEN
+            DO k=2,ngx*ngz+1
+              cellstart(k) = cellstart(k) + cellstart(k-1)
+            END DO
+            ALLOCATE (cellpoly(max(1_ski,cellstart(ngx*ngz+1))))
+            cellstart(2:) = cellstart(1:ngx*ngz)
+            cellstart(1) = 0
+          END IF
+          DO ipoly=1,npoly
+            i1 = ScreenExternalCell(minval(xvec(ivec1(ipoly):ivec1(ipoly)+ivec2(ipoly)-1)),xmin,xmax,ngx)
+            i2 = ScreenExternalCell(maxval(xvec(ivec1(ipoly):ivec1(ipoly)+ivec2(ipoly)-1)),xmin,xmax,ngx)
+            k1 = ScreenExternalCell(minval(zvec(ivec1(ipoly):ivec1(ipoly)+ivec2(ipoly)-1)),zmin,zmax,ngz)
+            k2 = ScreenExternalCell(maxval(zvec(ivec1(ipoly):ivec1(ipoly)+ivec2(ipoly)-1)),zmin,zmax,ngz)
+            DO k=k1,k2
+              DO i=i1,i2
+                cellstart((k-1)*ngx+i+1) = cellstart((k-1)*ngx+i+1) + 1
+                IF (pass.EQ.2) cellpoly(cellstart((k-1)*ngx+i+1)) = ipoly
+              END DO
+            END DO
+          END DO
+        END DO
+        cellstart = cellstart + 1
+        ivalues = (/ iflag, npoly, npoint, ngx, ngz, ivec1, ivec2, cellstart, cellpoly /)
+        rvalues = (/ xmin, xmax, zmin, zmax, xvec, zvec /)
+
+End Subroutine TableReadScreenExternal
+
+!
+! cell (1..ng) of the coordinate p in the grid of ng cells over [pmin,pmax]
+! of TableReadScreenExternal. It is monotonic in p, so a point inside the
+! bounding box of a polygon is always in one of the cells of the polygon.
+!
+Function ScreenExternalCell (p,pmin,pmax,ng) result(cell)
+
+	implicit none
+
+        real(kind=skr),    intent(in) :: p, pmin, pmax
+        integer(kind=ski), intent(in) :: ng
+        integer(kind=ski)             :: cell
+
+        IF (ng.EQ.1.OR.p.LE.pmin) THEN
+          cell = 1
+        ELSE IF (p.GE.pmax) THEN
+          cell = ng
+        ELSE
+          cell = min(ng,1_ski+int((p-pmin)/(pmax-pmin)*ng,kind=ski))
+        END IF
+
+End Function ScreenExternalCell
+
+!
+! true if the environment variable name is set to 1
+!
+Function EnvFlag (name) result(set)
+
+	implicit none
+
+        character(len=*),      intent(in) :: name
+        logical                :: set
+        character(len=sklen)   :: value
+        integer                :: length,status
+
+        CALL GET_ENVIRONMENT_VARIABLE (name,value,length,status)
+        set = status.EQ.0.AND.trim(value).EQ.'1'
+
+End Function EnvFlag
+
+!
+! returns the number of lost rays skipped by MIRROR1, SCREEN and IMAGE1 in
+! this thread (SHADOW_SKIP_LOST=1) since the previous call with reset
+!
+Function SkippedRays (reset) result(n)
+
+	implicit none
+
+        logical,               intent(in) :: reset
+        integer(kind=ski)                 :: n
+
+        n = skipped_rays
+        IF (reset) skipped_rays = 0
+
+End Function SkippedRays
+
+!
+! true if SHADOW_SPLINE_SIDECAR=1 (see TableReadPresurface)
+!
+Function TableSidecar () result(use)
+
+	implicit none
+
+        logical                :: use
+
+        use = EnvFlag('SHADOW_SPLINE_SIDECAR')
+
+End Function TableSidecar
+
+!
+! reads the spline of file from its sidecar, if it is enabled, exists and
+! is up to date (the size and content hash of file in its header match)
+!
+Function TableReadSidecar (file,ivalues,rvalues) result(found)
+
+	implicit none
+
+        character(len=*),                          intent(in)    :: file
+        integer(kind=ski),dimension(:),allocatable,intent(inout) :: ivalues
+        real(kind=skr),dimension(:),allocatable,   intent(inout) :: rvalues
+        logical                                                  :: found
+
+        integer(kind=ski)    :: fsize, sfsize, nx, ny, iunit, iErr
+        integer(kind=TABLE_HASH_INT),dimension(2) :: hash, shash
+
+        found = .false.
+        IF (.NOT.TableSidecar()) RETURN
+        CALL TableFileHash (file,fsize,hash)
+        IF (fsize.LT.0) RETURN
+        OPEN (NEWUNIT=iunit,FILE=trim(file)//'.spl',STATUS='OLD',FORM='UNFORMATTED', &
+              ACCESS='STREAM',IOSTAT=iErr)
+        IF (iErr.NE.0) RETURN
+        READ (iunit,IOSTAT=iErr) sfsize, shash, nx, ny
+        IF (iErr.EQ.0.AND.sfsize.EQ.fsize.AND.all(shash.EQ.hash).AND. &
+            nx.GE.4.AND.nx.LE.501.AND.ny.GE.4) THEN
+          IF (allocated(rvalues)) DEALLOCATE (rvalues)
+          ALLOCATE (rvalues(501+ny+2*501*2*ny),STAT=iErr)
+          IF (iErr.EQ.0) READ (iunit,IOSTAT=iErr) rvalues
+          IF (iErr.EQ.0) THEN
+            ivalues = (/ nx, ny /)
+            found = .true.
+          END IF
+        END IF
+        CLOSE (iunit)
+
+End Function TableReadSidecar
+
+!
+! writes the spline of file to its sidecar if it is enabled (written to a
+! temporary file and renamed, as other processes may be reading it)
+!
+Subroutine TableWriteSidecar (file,ivalues,rvalues)
+
+	implicit none
+
+        character(len=*),                 intent(in)  :: file
+        integer(kind=ski),dimension(:),   intent(in)  :: ivalues
+        real(kind=skr),dimension(:),      intent(in)  :: rvalues
+
+        character(len=sklen) :: tmpfile
+        integer(kind=ski)    :: fsize, iunit, iErr
+        integer(kind=TABLE_HASH_INT),dimension(2) :: hash
+
+        IF (.NOT.TableSidecar()) RETURN
+        CALL TableFileHash (file,fsize,hash)
+        IF (fsize.LT.0) RETURN
+        WRITE (tmpfile,'(A,I0)') trim(file)//'.spl.',getpid()
+        OPEN (NEWUNIT=iunit,FILE=tmpfile,STATUS='REPLACE',FORM='UNFORMATTED', &
+              ACCESS='STREAM',IOSTAT=iErr)
+        IF (iErr.NE.0) RETURN
+        WRITE (iunit,IOSTAT=iErr) fsize, hash, ivalues(1), ivalues(2), rvalues
+        IF (iErr.NE.0) THEN
+          ! no space left, keep computing the spline
+          CLOSE (iunit,STATUS='DELETE')
+          RETURN
+        END IF
+        CLOSE (iunit)
+        CALL RENAME (trim(tmpfile),trim(file)//'.spl')
+
+End Subroutine TableWriteSidecar
+
+! C+++
+! C	SUBROUTINE	REFLEC
+! C
+! C	PURPOSE		To compute the local reflectivity of a mirror or
+! C                     multilayer. Also compute filter transmittivity.
+! C
+! C	FLAGS		k_what:  .eq. 0 --> initialization call. Reads
+! C					in data file.
+! C			         .gt. 0 --> performs computations.
+! C			(see below)
+! C
+! C	ARGUMENTS	[ I ] PIN	: (x,y,z) of the intercept
+! C			[ I ] wnum 	: wavenumber (cm-1) 
+! C			[ I ] sin_ref	: sine of angle from surface
+! C			[ I ] cos_pole  : cosine of angle of normal from pole
+! C			[ O ] R_P 	: p-pol reflection coefficient
+! C			[ O ] R_S 	: s-pol    "  "
+! C			[ I ] ABSOR	: film thickness
+! C			[ O ] ABSOR	: absorption coefficient
+! C
+! C---
+SUBROUTINE REFLEC (PIN,WNUM,SIN_REF,COS_POLE,R_P,R_S,PHASEP,PHASES,ABSOR,K_WHAT)
+
+implicit none
+!IMPLICIT REAL(kind=skr) (A-E,G-H,O-Z)
+!IMPLICIT INTEGER(kind=ski)        (F,I-N)
+
+real(kind=skr),dimension(3),intent(in)   :: pin
+real(kind=skr),             intent(in)   :: wnum,sin_ref,cos_pole
+integer(kind=ski),          intent(in)   :: k_what
+real(kind=skr),             intent(inout):: absor
+real(kind=skr),             intent(out)  :: r_s,r_p,phases,phasep
+
+integer(kind=ski), parameter  :: dimMLenergy=300
+
+real(kind=skr),dimension(1000)   :: zf1,zf2
+real(kind=skr),dimension(dimMLenergy)    :: ener, &
+            delta_s,beta_s,delta_e,beta_e,delta_o,beta_o
+
+logical,dimension(5)    ::  ele,elo,els
+character(len=sklen)    ::  file_grade
+
+real(kind=skr),dimension(2,101,2,101) :: tspl,gspl
+real(kind=skr),dimension(101)         :: tx,ty,gx,gy
+real(kind=skr),dimension(6)           :: pds
+
+real(kind=skr)   :: lateral_grade_constant=1D0 !initialization avoids save
+real(kind=skr)   :: lateral_grade_slope=0D0 
+real(kind=skr)   :: lateral_grade_quadratic=0D0 
+integer(kind=ski):: i_grade=0
+
+real(kind=skr)   :: ab_coeff, cos_ref, del_x, depth0, elfactor, gfact
+real(kind=skr)   :: qmin, qmax, qstep, ratio, phot_ener, ratio1, ratio2
+real(kind=skr)   :: rho, rs1, rs2, tfact, tfilm, wnum0, xin, xlam, yin, gamma1
+integer(kind=ski):: i,j,nrefl,ierr,ier,index1,iunit,iunit2
+integer(kind=ski):: ngx, ngy, ntx, nty, nin, npair
+integer(kind=ski),dimension(:),allocatable :: ivalues
+real(kind=skr),dimension(:),allocatable    :: rvalues
+
+!dimension	tspl (2,101,2,101),tx(101),ty(101),pds(6)
+!dimension	gspl (2,101,2,101),gx(101),gy(101)
+!external	dbcevl
+
+! srio danger commented these commons, put in shadow_variables...
+!        common /aaa/ 	t_oe,gratio
+!        common /bbb/ 	delo,beto,dele,bete,dels,bets
+
+! C
+! C SAVE the variables that need to be saved across subsequent invocations
+! C of this subroutine.
+! C
+SAVE        QMIN, QMAX, QSTEP, DEPTH0, NREFL, TFILM, &
+            ZF1, ZF2, &
+            NIN, ENER,  &
+            DELTA_S, BETA_S,  &
+            NPAIR, &
+            DELTA_E,BETA_E, &
+            DELTA_O,BETA_O, &
+            TSPL,TX,TY,PDS, &
+            GSPL,GX,GY, &
+            NTX, NTY, NGX, NGY  ! added srio@esrf.eu 20130917
+!$omp threadprivate(QMIN, QMAX, QSTEP, DEPTH0, NREFL, TFILM, ZF1, ZF2, NIN, ENER, &
+!$omp&   DELTA_S, BETA_S, NPAIR, DELTA_E, BETA_E, DELTA_O, BETA_O, &
+!$omp&   TSPL, TX, TY, PDS, GSPL, GX, GY, NTX, NTY, NGX, NGY, &
+!$omp&   lateral_grade_constant, lateral_grade_slope, lateral_grade_quadratic, i_grade)
+! C
+! C Initialization call. The ZF1,ZF2 values do NOT correspond to the F1,F2
+! C atomic scattering factors, as they contain a more complex form:
+! C		ZFi = Fi*RADIUS*4*PI*ATOMS
+! C WNUM is the WAVENUMBER (cm-1) of the ray.
+! C ALFA and GAMMA are the complex dielectric function
+! C		EPSILON	  = 1 - ALFA + i*GAMMA		[ i=sqrt(-1) ]
+! C and are dependent ONLY on the material, while the reflectivities
+! C depend of course on the geometry too.
+! C ALFA and GAMMA may be generated by PREREF.EXE in [CERRINA.ABS],
+! C which is based on B.Henke data (see program header for complete reference).
+! C
+! C Two flags control the execution.
+! C 	F_REFL = 0	ZF1,ZF2 are read in as arrays
+! C	       = 1	ALFA and GAMMA are defined in the I/O session
+! C			and thus wavelength independent
+! C	       = 2      d-spacings and optical constants for multilayer
+! C			are read in 
+! C 	K_WHAT = 0	Initialization
+! C		 1	Reflection case
+! C		 2	Absorption case
+! C
+
+!todo: compute phases for the usual Fresnel reflection (mirrors). They 
+!      are set to zero here to avoid NaN in Macs. srio@esrf.eu 20150310
+phases = 0.0
+phasep = 0.0
+
+IF (K_WHAT.EQ.0) THEN
+    ! the files are read once per process (see TableLoad)
+    IF (F_REFL.EQ.0) THEN  !mirror
+        CALL TableLoad (TABLE_PREREFL,FILE_REFL,ivalues,rvalues)
+        NREFL  = ivalues(1)
+        QMIN   = rvalues(1)
+        QMAX   = rvalues(2)
+        QSTEP  = rvalues(3)
+        DEPTH0 = rvalues(4)
+        ZF1(1:NREFL) = rvalues(5:4+NREFL)
+        ZF2(1:NREFL) = rvalues(5+NREFL:4+2*NREFL)
+        TFILM = ABSOR
+        RETURN
+    ELSE IF (F_REFL.EQ.2) THEN  !multilayer
+        CALL TableLoad (TABLE_PRE_MLAYER,FILE_REFL,ivalues,rvalues)
+        NIN     = ivalues(1)
+        NPAIR   = ivalues(2)
+        I_GRADE = ivalues(3)
+        j = 0
+        ENER(1:NIN)    = rvalues(j+1:j+NIN) ; j = j+NIN
+        DELTA_S(1:NIN) = rvalues(j+1:j+NIN) ; j = j+NIN
+        BETA_S(1:NIN)  = rvalues(j+1:j+NIN) ; j = j+NIN
+        DELTA_E(1:NIN) = rvalues(j+1:j+NIN) ; j = j+NIN
+        BETA_E(1:NIN)  = rvalues(j+1:j+NIN) ; j = j+NIN
+        DELTA_O(1:NIN) = rvalues(j+1:j+NIN) ; j = j+NIN
+        BETA_O(1:NIN)  = rvalues(j+1:j+NIN) ; j = j+NIN
+        t_oe(1:NPAIR)         = rvalues(j+1:j+NPAIR) ; j = j+NPAIR
+        gratio(1:NPAIR)       = rvalues(j+1:j+NPAIR) ; j = j+NPAIR
+        mlroughness1(1:NPAIR) = rvalues(j+1:j+NPAIR) ; j = j+NPAIR
+        mlroughness2(1:NPAIR) = rvalues(j+1:j+NPAIR) ; j = j+NPAIR
+        if (i_grade.eq.1) then  ! spline
+          NTX = ivalues(4)
+          NTY = ivalues(5)
+          NGX = ivalues(6)
+          NGY = ivalues(7)
+          TX   = rvalues(j+1:j+size(TX)) ; j = j+size(TX)
+          TY   = rvalues(j+1:j+size(TY)) ; j = j+size(TY)
+          TSPL = reshape(rvalues(j+1:j+size(TSPL)),shape(TSPL)) ; j = j+size(TSPL)
+          GX   = rvalues(j+1:j+size(GX)) ; j = j+size(GX)
+          GY   = rvalues(j+1:j+size(GY)) ; j = j+size(GY)
+          GSPL = reshape(rvalues(j+1:j+size(GSPL)),shape(GSPL))
+        end if
+        if (i_grade.eq.2) then  ! quadric coefficients
+          lateral_grade_constant  = rvalues(j+1)
+          lateral_grade_slope     = rvalues(j+2)
+          lateral_grade_quadratic = rvalues(j+3)
+        end if
         tfilm = absor
         RETURN
     END IF
@@ -6028,6 +7048,12 @@ SUBROUTINE SCREEN (RAY,AP_IN,PH_IN,I_WHAT,I_ELEMENT)
 
 ! ** Checks if the ray has been reflected by the mirror.
 
+     	IF (skip_lost.AND.RAY(10,J).LT.0.0D0) THEN
+     	  skipped_rays = skipped_rays + 1
+     	  OUT(:,J) = 0.0D0
+     	  OUT(10,J) = RAY(10,J)
+     	  GO TO 100
+     	END IF
      	IF (RAY(10,J).LT.-1.0D6) GO TO 100
 
      	P_IN(1)	=   RAY(1,J)
@@ -6147,6 +7173,7 @@ SUBROUTINE SCREEN (RAY,AP_IN,PH_IN,I_WHAT,I_ELEMENT)
      	  V_1   = - RZ_SLIT(I_WHAT)/2
      	  V_2   =   RZ_SLIT(I_WHAT)/2
      	  DO 222 ICHECK=1,NPOINT
+	    IF (skip_lost.AND.RAY(10,ICHECK).LT.0.0D0) GO TO 222
 !C 
 !C  Assume obstruction, and then reverse decision for aperture.
 !C 
@@ -6176,6 +7203,7 @@ SUBROUTINE SCREEN (RAY,AP_IN,PH_IN,I_WHAT,I_ELEMENT)
 	  XCNTR =   CX_SLIT(I_WHAT)
 	  ZCNTR =   CZ_SLIT(I_WHAT)
      	  DO 300 I=1,NPOINT
+	    IF (skip_lost.AND.RAY(10,I).LT.0.0D0) GO TO 300
 	    PX = OUT(1,I)-XCNTR
 	    PZ = OUT(3,I)-ZCNTR
      	    TEST = PX**2/AXLAR + PZ**2/AXSMA - 1.0D0
@@ -6241,8 +7269,8 @@ SUBROUTINE SCREEN_EXTERNAL(I_SCR,I_ELEMENT,RAY,RAY_OUT)
         ! C
         ! C Local variables
         ! C
-        integer(kind=ski)    :: ierr,iflag,inp,ipoly,iray,istart
-        integer(kind=ski)    :: n_polys,n_points
+        integer(kind=ski)    :: iflag,inp,ipoly,iray,istart,icell,k
+        integer(kind=ski)    :: n_polys,n_points,ngx,ngz,ocell
         real(kind=skr)       :: px, pz
         logical              :: ray_lost, hit_found
         character(len=sklen) :: filename
@@ -6250,71 +7278,22 @@ SUBROUTINE SCREEN_EXTERNAL(I_SCR,I_ELEMENT,RAY,RAY_OUT)
         !
         ! Allocatable variables
         !
-        !real(kind=skr),dimension(MAX_NPOINTS)  :: xvec,zvec
-        !integer(kind=ski),dimension(MAX_NPOLY) :: ivec1,ivec2
-        real(kind=skr),dimension(:),allocatable    :: xvec,zvec
-        integer(kind=ski),dimension(:),allocatable :: ivec1,ivec2
-
-! C -------------  NOT LONGER APPLIES srio@esrf.eu 20120430 -------------
-! C The following two parameters limit the polygons that can be read in.
-! C There can be upto MAX_NPOLY polygons, and an accumulated total of 
-! C MAX_NPOINTS points summed over all the polygons. The accumulated sum
-! C includes polygon closure (eg., a rectangle has *5*, not 4 points after
-! C closure). To up the limits, modify the following and recompile.
-! C
-!        integer(kind=ski),parameter :: max_npoly=50, max_npoints=1000
+        integer(kind=ski),dimension(:),allocatable :: ivalues
+        real(kind=skr),dimension(:),allocatable    :: rvalues
 
 ! C
 ! C Load the external polygon file that describe the patterns on the screen.
 ! C The file format is described in SCREEN_EXTERNAL_LOAD().
 ! C
-! C Note that the two vectors, xvec and zvec, contain the points for all
-! C the polygons. Two aux vectors, ivec1 and ivec2, contain the starting
-! C indices (into xvec and zvec) and number of points per polygon.
+! C The polygons are read once per process and kept, with a grid index of
+! C their bounding boxes, in the table cache (see TableReadScreenExternal):
+! C rvalues contains the points for all the polygons (xvec and zvec), and
+! C ivalues the starting indices and number of points per polygon (ivec1
+! C and ivec2) and the polygons of each cell of the grid.
 ! C 
-        IFLAG = 0
         filename = FILE_SCR_EXT(I_SCR)
-        CALL SCREEN_EXTERNAL_GETDIMENSIONS(filename, N_POLYS,N_POINTS,IFLAG)
-        !print *,'>>> SCREEN_EXTERNAL_GETDIMENSIONS: N_POLYS: ',N_POLYS
-        !print *,'>>> SCREEN_EXTERNAL_GETDIMENSIONS: N_POINTS: ',N_POINTS
-        !print *,'>>> SCREEN_EXTERNAL_GETDIMENSIONS: IFLAG: ',IFLAG
-
-        ! allocate vectors
-        IF (.NOT. ALLOCATED(xvec)) THEN
-          ALLOCATE(xvec(n_points),STAT=ierr)
-          IF (ierr /= 0) THEN
-            print *,"SCREEN_EXTERNAL: Error allocating xvec" ; STOP 4
-          END IF
-        END IF
-        IF (.NOT. ALLOCATED(zvec)) THEN
-          ALLOCATE(zvec(n_points),STAT=ierr)
-          IF (ierr /= 0) THEN
-            print *,"SCREEN_EXTERNAL: Error allocating zvec" ; STOP 4
-          END IF
-        END IF
-
-        IF (.NOT. ALLOCATED(ivec1)) THEN
-          ALLOCATE(ivec1(n_polys),STAT=ierr)
-          IF (ierr /= 0) THEN
-            print *,"SCREEN_EXTERNAL: Error allocating ivec1" ; STOP 4
-          END IF
-        END IF
-
-        IF (.NOT. ALLOCATED(ivec2)) THEN
-          ALLOCATE(ivec2(n_polys),STAT=ierr)
-          IF (ierr /= 0) THEN
-            print *,"SCREEN_EXTERNAL: Error allocating ivec2" ; STOP 4
-          END IF
-        END IF
-
-        CALL SCREEN_EXTERNAL_LOAD(filename, &
-!                MAX_NPOLY, MAX_NPOINTS, &
-                XVEC,ZVEC,IVEC1,IVEC2,N_POLYS,N_POINTS,IFLAG)
-        !print *,'>>> MAX_NPOLY: ',MAX_NPOLY
-        !print *,'>>> MAX_NPOINTS: ',MAX_NPOINTS
-        !print *,'>>> N_POLYS: ',N_POLYS
-        !print *,'>>> N_POINTS: ',N_POINTS
-        !print *,'>>> XVEC: ',XVEC(1:NPOINTS)
+        CALL TableLoad (TABLE_SCREEN_EXTERNAL,filename,ivalues,rvalues)
+        IFLAG = ivalues(1)
 
         IF (IFLAG .EQ. -1) THEN
           CALL MSSG ('SCREEN_EXTERNAL', &
@@ -6325,32 +7304,45 @@ SUBROUTINE SCREEN_EXTERNAL(I_SCR,I_ELEMENT,RAY,RAY_OUT)
                'Error in External polygon description', i_one)
           STOP 1
         END IF
+        N_POLYS = ivalues(2)
+        N_POINTS = ivalues(3)
+        NGX = ivalues(4)
+        NGZ = ivalues(5)
+        OCELL = 5 + 2*N_POLYS
 
 ! C
-! C Algorithm: For each ray, see if it hits any of the polygons; if it does,
+! C Algorithm: For each ray, see if it hits any of the polygons of its cell
+! C (no polygon if it is out of the bounding box of all of them); if it does,
 ! C check if the polygon is a Aperture or Obstruction, and set the RAY_LOST
 ! C logical accordingly.
 ! C
-!        DO 200 IRAY=1,NPOINT
         DO IRAY=1,NPOINT
+          IF (skip_lost.AND.RAY(10,IRAY).LT.0.0D0) CYCLE
           HIT_FOUND = .FALSE.
           PX = RAY_OUT(1,IRAY)
           PZ = RAY_OUT(3,IRAY)
-          !DO 11 IPOLY = 1, N_POLYS
-          DO IPOLY = 1, N_POLYS
-            ISTART = IVEC1(IPOLY)
-            INP = IVEC2(IPOLY)
-            IFLAG = 0
-            CALL PNPOLY (PX, PZ, XVEC(ISTART), ZVEC(ISTART), INP, IFLAG)
+          IF (PX.GE.rvalues(1).AND.PX.LE.rvalues(2).AND. &
+              PZ.GE.rvalues(3).AND.PZ.LE.rvalues(4)) THEN
+            ICELL = (ScreenExternalCell(PZ,rvalues(3),rvalues(4),NGZ)-1)*NGX + &
+                    ScreenExternalCell(PX,rvalues(1),rvalues(2),NGX)
+            DO K = ivalues(OCELL+ICELL), ivalues(OCELL+ICELL+1)-1
+              IPOLY = ivalues(OCELL+NGX*NGZ+1+K)
+              ISTART = ivalues(5+IPOLY)
+              INP = ivalues(5+N_POLYS+IPOLY)
+              IFLAG = 0
+              CALL PNPOLY (PX, PZ, rvalues(4+ISTART), rvalues(4+N_POINTS+ISTART), INP, IFLAG)
 ! C
 ! C IFLAG = -1 implies point *outside* polygon, 0 vertex, 1 inside.
 ! C I_STOP = 1 for obstruction, and 0 for aperture.
 ! C
 ! C We just need a single hit (inside+vertex) for either type of slit.
 ! C
-            IF (IFLAG.EQ.1 .OR. IFLAG.EQ.0) HIT_FOUND = .TRUE.
-! 11	  CONTINUE
-          END DO 
+              IF (IFLAG.EQ.1 .OR. IFLAG.EQ.0) THEN
+                HIT_FOUND = .TRUE.
+                EXIT
+              END IF
+            END DO
+          END IF
 ! C
 ! C In case of aperture, a ray is lost if does NOT hit any of the polys;
 ! C in case of obstruction, a ray is lost if it hits *ANY* of the polys.
@@ -6367,12 +7359,6 @@ SUBROUTINE SCREEN_EXTERNAL(I_SCR,I_ELEMENT,RAY,RAY_OUT)
             RAY_OUT (10,IRAY) = - 1.0D2*I_ELEMENT - 1.0D0*I_SCR
           END IF
         END DO
-! 200	CONTINUE
-! C
-        IF (ALLOCATED(xvec)) DEALLOCATE(xvec)
-        IF (ALLOCATED(zvec)) DEALLOCATE(zvec)
-        IF (ALLOCATED(ivec1)) DEALLOCATE(ivec1)
-        IF (ALLOCATED(ivec2)) DEALLOCATE(ivec2)
         RETURN
 End Subroutine screen_external
 
@@ -6445,10 +7431,10 @@ SUBROUTINE  SCREEN_EXTERNAL_LOAD (FILENAME,  &
         integer(kind=ski),dimension(npoly1),intent(in out) :: ivec1,ivec2
 ! C
         integer(kind=ski) :: np1, poly_index, pt_index, start_index
-        integer(kind=ski),parameter :: io_unit=21
+        integer(kind=ski) :: io_unit
 ! C
         IFLAG = 0
-        OPEN(IO_UNIT, FILE=FILENAME, status='OLD', ERR=199)
+        OPEN(NEWUNIT=IO_UNIT, FILE=FILENAME, status='OLD', ERR=199)
         READ(IO_UNIT, *, ERR=299, END=299) NPOLY
         IF (NPOLY .NE. NPOLY1) THEN
           CALL MSSG ('SCREEN_EXTERNAL','problem reading file',i_one)
@@ -6536,11 +7522,11 @@ SUBROUTINE  SCREEN_EXTERNAL_GETDIMENSIONS (FILENAME, NPOLY,NPOINT,IFLAG)
     integer(kind=ski),intent(out) :: npoly,npoint,iflag
 
     integer(kind=ski) :: np1, poly_index, pt_index, start_index
-    integer(kind=ski),parameter :: io_unit=21
+    integer(kind=ski) :: io_unit
     real(kind=skr)    :: xtmp,ztmp,xtmp0,ztmp0
 
     IFLAG = 0
-    OPEN(IO_UNIT, FILE=FILENAME, status='OLD', ERR=199)
+    OPEN(NEWUNIT=IO_UNIT, FILE=FILENAME, status='OLD', ERR=199)
     READ(IO_UNIT, *, ERR=299, END=299) NPOLY
 ! C
 ! C read all the polygons as a compound one (ie., in the same vectors).
@@ -6951,7 +7937,8 @@ End Subroutine setsour
 ! C	PURPOSE		To compute the interpolated surface from a 
 ! C			bi-cubic spline.
 ! C
-! C	INPUT		An unformatted file prepared by PRESURFACE.
+! C	INPUT		An unformatted file prepared by PRESURFACE, or
+! C			the formatted mesh (see TableReadPresurface).
 ! C
 ! C	ARGUMENTS	Input:
 ! C			 {x,y} 	coordinates
@@ -6999,17 +7986,18 @@ SUBROUTINE SUR_SPLINE (XIN, YIN, ZOUT, VVOUT, IERR, SERR)
      	real(kind=skr),dimension(3) ::  vvout
         ! new to access directly data file (before presirface) srio@esrf.eu 20150227
         logical :: lTrueFalse
-        character(len=sklen) :: stmp
-	real(kind=skr),dimension(:,:),allocatable :: Z
-	real(kind=skr),dimension(:),allocatable   :: wk
-        integer(kind=ski) :: i,j,ic,iTmp2,nw,ier
+        integer(kind=ski),dimension(:),allocatable :: ivalues
+	real(kind=skr),dimension(:),allocatable   :: rvalues
+        integer(kind=ski),dimension(:),allocatable :: XINDX, YINDX
+        integer(kind=ski),dimension(1) :: ier
         integer(kind=ski) :: nx,ny
 	real(kind=skr)    :: dsdx, dsdy
 ! C
 ! C SAVE the variables that need to be saved across subsequent invocations
 ! C of this subroutine. 
 ! C
-        SAVE NX, NY, X, Y, CSPL
+        SAVE NX, NY, X, Y, CSPL, XINDX, YINDX
+!$omp threadprivate(NX, NY, X, Y, CSPL, XINDX, YINDX)
 
 
         SERR = 0
@@ -7018,87 +8006,39 @@ SUBROUTINE SUR_SPLINE (XIN, YIN, ZOUT, VVOUT, IERR, SERR)
             ! C Replace OPEN calls with library routine FOPENR()
             ! C	  CALL FOPENR(20, FILE_RIP, 'UNFORMATTED', IFERR, IOSTAT)
             ! C
-            inquire( file = file_rip, exist=lTrueFalse, formatted=stmp)
+            inquire( file = file_rip, exist=lTrueFalse)
             if (lTruefalse .eqv. .false.) then
                 print *,'SUR_SPLINE: Error: File not found: '//trim(FILE_RIP)
                 ierr = -1000
                 return
             endif
-            if (trim(stmp) .ne. "FORMATTED") then 
-               OPEN  (20, FILE=FILE_RIP, STATUS='OLD', FORM='UNFORMATTED')
-               READ  (20) NX, NY
-               if ((NX .gt. 100000) .or. (NY .gt. 1000000) .or. & 
-                   (NX .lt. 0) .or. (NY .lt. 0)) then 
-                   !
-                   ! unrealistic numbers mean that the file is perhaps ASCII
-                   ! so presurface is not run
-                   !
-                   stmp = "FORMATTED"
-                   CLOSE(20)
-                   goto 1010
-               endif
-
-               allocate( Y(NY) )
-               allocate( CSPL(2,501,2,NY) )
-               READ  (20) X,Y
-               READ  (20) CSPL
-               CLOSE (20)
-            endif
-            
-1010        continue
-            if (trim(stmp) .eq. "FORMATTED") then 
-               !
-               ! compute "on the fly" the spline as presurface has not been used. 
-               ! This part has been copied from shadow_preprocessors->presurface
-               !
-               !print*,'SUR_SPLINE: data input file before presurface.'
-               OPEN  (20, FILE=FILE_RIP, STATUS='OLD', FORM='FORMATTED')
-               READ  (20,*) NX, NY
-               if ((nx .lt. 4) .or. (ny .lt. 4)) then
-                  !print *,'SUR_SPLINE: Error: Not enough points to define arrays. Must be at'
-                  !print *,'            least 4 points in each direction.'
-                  ierr = -1000
-                  return
-               endif
-               if (nx .gt. 501) then
-                  print *,'SUR_SPLINE: Error: Array X too large: '
-                  print *,'            Maximum allowed is 501 points in X, unlimited in Y.'
-                  print *,'            Please retry with smaller arrays.'
-                  ierr = -1000
-                  return
-               endif
-               nw = 2*501*ny+2*max(501,ny)
-               allocate(Z(501,NY))    
-               allocate(WK(nw))
-
-               allocate(Y(NY))
-               allocate(CSPL(2,501,2,NY))
-               ic = 1+max(501,ny)
-               READ (20,*) (Y(I),I=1,NY)
-               DO I=1,NX
-                 READ (20,*) X(I),(Z(I,J),J=1,NY)
-               END DO
-               CLOSE (20)
-               !WRITE(6,*)'SUR_SPLINE: Array read correctly. Compute spline.'
-               !C
-               !C Call IMSL routine to compute spline. Now use 501 points instead of 101.
-               !C
-               iTmp2 = 501
-               CALL IBCCCU ( Z, X, NX, Y, NY, CSPL, iTmp2, WK, IER)
-               IF (IER.EQ.132) THEN
-                   WRITE(6,*)'SUR_SPLINE: Error: The X and/or Y array are/is not ordered properly.' 
-                   WRITE(6,*)'            Please check data in '//trim(FILE_RIP)
-                   STOP
-               END IF
-               !WRITE(6,*)'SUR_SPLINE: Spline succesfully completed.'
-
-            endif
+            ! the spline is computed once per process (see TableReadPresurface)
+            CALL TableLoad (TABLE_PRESURFACE,FILE_RIP,ivalues,rvalues)
+            IF (size(rvalues).EQ.0) THEN
+                ierr = -1000
+                return
+            END IF
+            NX = ivalues(1)
+            NY = ivalues(2)
+            IF(ALLOCATED( Y ))    DEALLOCATE(Y)
+            IF(ALLOCATED( CSPL )) DEALLOCATE(CSPL)
+            IF(ALLOCATED( XINDX )) DEALLOCATE(XINDX)
+            IF(ALLOCATED( YINDX )) DEALLOCATE(YINDX)
+            X    = rvalues(1:501)
+            Y    = rvalues(502:501+NY)
+            CSPL = reshape(rvalues(502+NY:),(/ 2_ski, 501_ski, 2_ski, NY /))
+            ! index of the knots, to find the cell of a point directly
+            ALLOCATE (XINDX(NX-1),YINDX(NY-1))
+            CALL DBCEVL_INDEX (X,NX,XINDX,NX-1)
+            CALL DBCEVL_INDEX (Y,NY,YINDX,NY-1)
 
             IERR = 0
             RETURN
         ELSE IF (IERR.EQ.-2) THEN !deallocate arrays
             IF(ALLOCATED( Y ))    DEALLOCATE(Y)
             IF(ALLOCATED( CSPL )) DEALLOCATE(CSPL)
+            IF(ALLOCATED( XINDX )) DEALLOCATE(XINDX)
+            IF(ALLOCATED( YINDX )) DEALLOCATE(YINDX)
             RETURN
         ELSE 
             ! C
@@ -7108,11 +8048,12 @@ SUBROUTINE SUR_SPLINE (XIN, YIN, ZOUT, VVOUT, IERR, SERR)
             ! C to -9 to indicate this fact.
             ! C
             ! C      	CALL	DBCEVL (X,NX,Y,NY,CSPL,101,XIN,YIN,PDS,IER)
-            CALL DBCEVL (X,NX,Y,NY,CSPL,i501,XIN,YIN,PDS,IER)
+            ! C      	CALL	DBCEVL (X,NX,Y,NY,CSPL,i501,XIN,YIN,PDS,IER)
+            CALL DBCEVL_BATCH (X,NX,Y,NY,CSPL,i501,XINDX,NX-1,YINDX,NY-1, &
+                               ione,(/XIN/),(/YIN/),PDS,IER)
             ! C
-            IF (IER.NE.0) THEN
-                IER = -9
-                SERR = IER
+            IF (IER(1).NE.0) THEN
+                SERR = -9
                 ! C   The 2 lines below are old stuff.
                 ! C     	  CALL	MSSG ('SURF_SPLINE','Return error # ',IER)
                 ! C     $	  CALL LEAVE ('SURF_SPLINE','Error in Spline Interpolation',IER)
@@ -7141,6 +8082,50 @@ SUBROUTINE SUR_SPLINE (XIN, YIN, ZOUT, VVOUT, IERR, SERR)
         END IF
 End Subroutine sur_spline
 
+! C+++
+! C	SUBROUTINE	PRESURFACE_EVAL
+! C
+! C	PURPOSE		Evaluates the spline of a presurface file (see
+! C			SUR_SPLINE) at n points at once.
+! C
+! C	ARGUMENTS	[ I ] file	: presurface file (or formatted mesh)
+! C			[ I ] xl,yl	: coordinates of the points
+! C			[ O ] pds	: z, dz/dx, dz/dy, d2z/dxdy, d2z/dx2
+! C					  and d2z/dy2 at each point (DBCEVL)
+! C			[ O ] ier	: 0 or the DBCEVL error of each point
+! C					  (33 to 36: out of the mesh)
+! C			[ O ] status	: 0, or -1000 if the file is not valid
+! C
+! C---
+SUBROUTINE PresurfaceEval (file,n,xl,yl,pds,ier,status)
+
+	implicit none
+
+        character(len=*),                 intent(in)  :: file
+        integer(kind=ski),                intent(in)  :: n
+        real(kind=skr),dimension(n),      intent(in)  :: xl,yl
+        real(kind=skr),dimension(6,n),    intent(out) :: pds
+        integer(kind=ski),dimension(n),   intent(out) :: ier
+        integer(kind=ski),                intent(out) :: status
+
+        integer(kind=ski),dimension(:),allocatable :: ivalues, xindx, yindx
+	real(kind=skr),dimension(:),allocatable    :: rvalues
+        integer(kind=ski) :: nx, ny
+
+        status = -1000
+        CALL TableLoad (TABLE_PRESURFACE,file,ivalues,rvalues)
+        IF (size(rvalues).EQ.0) RETURN
+        NX = ivalues(1)
+        NY = ivalues(2)
+        ALLOCATE (xindx(NX-1),yindx(NY-1))
+        CALL DBCEVL_INDEX (rvalues(1:NX),NX,xindx,NX-1)
+        CALL DBCEVL_INDEX (rvalues(502:501+NY),NY,yindx,NY-1)
+        CALL DBCEVL_BATCH (rvalues(1:NX),NX,rvalues(502:501+NY),NY,rvalues(502+NY:),i501, &
+                           xindx,NX-1,yindx,NY-1,n,xl,yl,pds,ier)
+        status = 0
+
+End Subroutine PresurfaceEval
+
 
 ! C+++
 ! C	SUBROUTINE	SURFACE
@@ -7344,14 +8329,214 @@ SUBROUTINE FA_ROTBACK (P_IN,P_OUT,OFF,AU,AV,AW)
      		     P_IN(2)*AV(2) + &
      		     P_IN(3)*AW(2) + OFF(2)
 
-     	P_OUT(3)=    P_IN(1)*AU(3) + &
-     		     P_IN(2)*AV(3) + &
-     		     P_IN(3)*AW(3) + OFF(3)
+     	P_OUT(3)=    P_IN(1)*AU(3) + &
+     		     P_IN(2)*AV(3) + &
+     		     P_IN(3)*AW(3) + OFF(3)
+
+        RETURN
+End Subroutine fa_rotback
+
+
+
+
+! C+++
+! C	SUBROUTINE	FACETFRAME
+! C
+! C	PURPOSE		Computes the center (on the baseline mirror) and
+! C			the local reference frame (normal, binormal and
+! C			tangential vectors) of the facet (IFAC_X,IFAC_Y)
+! C			of a faceted mirror. IFLAG is not 0 if the center
+! C			does not intercept the baseline.
+! C
+! C---
+SUBROUTINE FacetFrame (IFAC_X1,IFAC_Y1,PF_CENT,PF_NOR,PF_BNOR,PF_TAU,IFLAG)
+
+	implicit none
+
+        integer(kind=ski),           intent(in)  :: IFAC_X1,IFAC_Y1
+        real(kind=skr),dimension(3), intent(out) :: PF_CENT,PF_NOR,PF_BNOR,PF_TAU
+        integer(kind=ski),           intent(out) :: IFLAG
+
+        real(kind=skr)         :: TPAR
+        integer(kind=ski)      :: FRUS
+
+	PF_CENT(1)= IFAC_X1*RFAC_LENX
+	PF_CENT(2)= IFAC_Y1*RFAC_LENY
+	PF_CENT(3)=0.0D0
+
+! C
+! C Seperate the Torodial baselin case from
+! C the other baseline
+! C
+
+	IF (FMIRR.EQ.3) THEN
+	 IF (F_TORUS.EQ.0) THEN
+	    Z_VRS(3)=-1.0D0
+            IFLAG=1
+! C
+! C  note: here we have to reset F_TORUS = 3 in order to
+! C  find the proper distance from the z=0 plane to the
+! C  baseline mirror. i.e. At F_TORUS = 0 we calculate
+! C  the farthest distance while at F_TORUS = 3 we get
+! C  the closest distance.
+! C
+	    FRUS = F_TORUS
+	    F_TORUS = 3
+	    CALL INTERCEPT (PF_CENT,Z_VRS,TPAR,IFLAG)
+	      F_TORUS=FRUS
+	      Z_VRS(3)=1.0D0
+	 ELSE
+	      CALL LEAVE ('FACET','This part has not been considered yet',izero)
+         END IF
+! C
+! C For the base line other than Tordial baseline
+! C
+	ELSE
+	  IFLAG=-1
+! C
+! C Set the IFLAG = -1 for the closest intercepted length
+! C
+
+	      CALL INTERCEPT (PF_CENT,Z_VRS,TPAR,IFLAG)
+        END IF
+	IF (IFLAG.NE.0) RETURN
+	    PF_CENT(3) = TPAR
+
+
+! C Define the normal vector for the facet mirror
+! C
+	      CALL    NORMAL (PF_CENT,PF_NOR)
+	      IF (F_CONVEX.EQ.0) CALL SCALAR (PF_NOR,-1.0D0,PF_NOR) 
+	      CALL    NORM   (PF_NOR,PF_NOR)
+! C
+! C Define binormal and tangential vectors
+! C
+              PF_BNOR(2)=0.0D0
+	      IF (PF_NOR(3).EQ.0) CALL LEAVE &
+                    ('FACET','N_z should not be zero',izero)
+	    IF (PF_NOR(1).NE.0.) THEN
+	       PF_BNOR(1)=PF_NOR(3)
+	       PF_BNOR(3)=-1.0D0*PF_NOR(1)
+	    ELSE
+	       PF_BNOR(1)=1.0D0
+	       PF_BNOR(3)=0.0D0
+	    END IF
+	    CALL NORM(PF_BNOR,PF_BNOR)
+	       CALL CROSS (PF_NOR,PF_BNOR,PF_TAU)
+	       CALL NORM (PF_TAU,PF_TAU)
+
+End Subroutine FacetFrame
+
+! C+++
+! C	SUBROUTINE	FACETLOOKUP
+! C
+! C	PURPOSE		Returns the frame of the facet (IFAC_X,IFAC_Y) as
+! C			FacetFrame, computing it once per facet: the
+! C			frames are kept in a hash table (facet_keys and
+! C			facet_frames) emptied by MSETUP, so the rays that
+! C			hit the same facet share its frame.
+! C
+! C	NOTE		With SHADOW_FACET_REFERENCE=1 in the environment
+! C			the frame is computed for every ray, as before the
+! C			table was added (reference mode for validation).
+! C
+! C---
+SUBROUTINE FacetLookup (IFAC_X1,IFAC_Y1,PF_CENT,PF_NOR,PF_BNOR,PF_TAU,IFLAG)
+
+	implicit none
+
+        integer(kind=ski),           intent(in)  :: IFAC_X1,IFAC_Y1
+        real(kind=skr),dimension(3), intent(out) :: PF_CENT,PF_NOR,PF_BNOR,PF_TAU
+        integer(kind=ski),           intent(out) :: IFLAG
+
+        integer(kind=ski)      :: slot
+
+        IF (facet_reference) THEN
+          CALL FacetFrame (IFAC_X1,IFAC_Y1,PF_CENT,PF_NOR,PF_BNOR,PF_TAU,IFLAG)
+          RETURN
+        END IF
+        IF (.NOT.allocated(facet_keys)) CALL FacetResize (1024_ski)
+        slot = FacetSlot(IFAC_X1,IFAC_Y1)
+        IF (facet_keys(3,slot).EQ.0) THEN
+          IF (2*(facet_count+1).GT.size(facet_keys,2)) THEN
+            CALL FacetResize (2*size(facet_keys,2))
+            slot = FacetSlot(IFAC_X1,IFAC_Y1)
+          END IF
+          CALL FacetFrame (IFAC_X1,IFAC_Y1,facet_frames(1:3,slot),facet_frames(4:6,slot), &
+                           facet_frames(7:9,slot),facet_frames(10:12,slot),IFLAG)
+          facet_keys(:,slot) = (/ IFAC_X1, IFAC_Y1, merge(1_ski,2_ski,IFLAG.EQ.0) /)
+          facet_count = facet_count + 1
+        END IF
+        IFLAG = facet_keys(3,slot) - 1
+        PF_CENT = facet_frames(1:3,slot)
+        PF_NOR  = facet_frames(4:6,slot)
+        PF_BNOR = facet_frames(7:9,slot)
+        PF_TAU  = facet_frames(10:12,slot)
+
+End Subroutine FacetLookup
+
+!
+! slot of the facet (ifac_x1,ifac_y1) in the hash table of FacetLookup:
+! the one holding it or the empty one where it goes (linear probing)
+!
+Function FacetSlot (ifac_x1,ifac_y1) result(slot)
+
+	implicit none
+
+        integer(kind=ski), intent(in) :: ifac_x1,ifac_y1
+        integer(kind=ski)             :: slot, n
+
+        n = size(facet_keys,2)
+        slot = 1 + modulo(ifac_x1*40503_ski + ifac_y1,n)
+        DO WHILE (facet_keys(3,slot).NE.0)
+          IF (facet_keys(1,slot).EQ.ifac_x1.AND.facet_keys(2,slot).EQ.ifac_y1) RETURN
+          slot = 1 + modulo(slot,n)
+        END DO
+
+End Function FacetSlot
+
+!
+! sets the size of the hash table of FacetLookup, keeping its facets
+!
+Subroutine FacetResize (n)
+
+	implicit none
+
+        integer(kind=ski), intent(in) :: n
+
+        integer(kind=ski),dimension(:,:),allocatable :: keys
+        real(kind=skr),dimension(:,:),allocatable    :: frames
+        integer(kind=ski)                            :: i, slot
+
+        IF (allocated(facet_keys)) THEN
+          CALL move_alloc (facet_keys,keys)
+          CALL move_alloc (facet_frames,frames)
+        END IF
+        ALLOCATE (facet_keys(3,n),facet_frames(12,n))
+        facet_keys = 0
+        IF (.NOT.allocated(keys)) RETURN
+        DO i=1,size(keys,2)
+          IF (keys(3,i).NE.0) THEN
+            slot = FacetSlot(keys(1,i),keys(2,i))
+            facet_keys(:,slot) = keys(:,i)
+            facet_frames(:,slot) = frames(:,i)
+          END IF
+        END DO
+
+End Subroutine FacetResize
+
+!
+! empties the hash table of FacetLookup (called by MSETUP)
+!
+Subroutine FacetReset
 
-        RETURN
-End Subroutine fa_rotback
+	implicit none
 
+        facet_count = 0
+        IF (allocated(facet_keys)) facet_keys = 0
+        facet_reference = EnvFlag('SHADOW_FACET_REFERENCE')
 
+End Subroutine FacetReset
 
 !
 ! and now, THE MONSTER!!!!
@@ -7406,6 +8591,8 @@ Subroutine MIRROR1 (RAY,AP,PHASE,I_WHICH)
 	dimension	ANGLE(4,npoint)
 	!INTEGER		SURFERR
 	integer(kind=ski)  :: SURFERR
+	real(kind=skr),dimension(:),allocatable    :: TQUART
+	integer(kind=ski),dimension(:),allocatable :: IQUART
 
         !srio: already in implicit
 	!DOUBLE PRECISION	SCAT_FRAC,RGH_TMP1,RGH_TMP2
@@ -7537,6 +8724,16 @@ Subroutine MIRROR1 (RAY,AP,PHASE,I_WHICH)
 	IF (F_KOMA.EQ.1) THEN
 	   RETURN
 	END IF
+! C
+! C Intercepts on a torus of all the rays at once (see QUARTIC_BATCH),
+! C unless SHADOW_QUARTIC_REFERENCE=1 to solve them one by one
+! C
+	IF (FMIRR.EQ.3.AND.F_SEGMENT.NE.1) THEN
+	  IF (.NOT.EnvFlag('SHADOW_QUARTIC_REFERENCE')) THEN
+	    ALLOCATE (TQUART(NPOINT),IQUART(NPOINT))
+	    CALL QUARTIC_BATCH (RAY,NPOINT,TQUART,IQUART)
+	  END IF
+	END IF
 5009    CONTINUE
 ! C
 ! C Start the loop through the beam
@@ -7557,6 +8754,10 @@ end if
      	IF (RAY(10,ITIK).LT.0.0D0)	K_1 = K_1 + 1
      	IF (RAY(10,ITIK).GE.0.0D0)	K_2 = K_2 + 1
 ! * Check if the ray is acceptable
+	IF (skip_lost.AND.RAY(10,ITIK).LT.0.0D0) THEN
+	  skipped_rays = skipped_rays + 1
+	  GO TO 10000
+	END IF
 	IF (RAY(10,ITIK).LT.-1.0D6) 	GO TO 10000
 ! C
      	P_START(1)  =   RAY(1,ITIK)
@@ -7592,8 +8793,13 @@ end if
 ! C
 ! C solve for intercepts
 ! C
-	IFLAG	= 1
-     	CALL	INTERCEPT (P_START, VVIN, TPAR, IFLAG)
+	IF (ALLOCATED(TQUART)) THEN
+	  TPAR	= TQUART(ITIK)
+	  IFLAG	= IQUART(ITIK)
+	ELSE
+	  IFLAG	= 1
+     	  CALL	INTERCEPT (P_START, VVIN, TPAR, IFLAG)
+	END IF
 ! C
 ! C tests for return
 ! C
@@ -7972,60 +9178,13 @@ end if
 
 	IFAC_X  = IDNINT(PPOUT(1)/RFAC_LENX)
 	IFAC_Y  = IDNINT(PPOUT(2)/RFAC_LENY)
-	PF_CENT(1)= IFAC_X*RFAC_LENX
-	PF_CENT(2)= IFAC_Y*RFAC_LENY
 
 ! C
 ! C Determine the center coordinate of the facet
-! C and the new coordinate system
-! C
-	PF_CENT(3)=0.0D0
-
-! C
-! C Seperate the Torodial baselin case from
-! C the other baseline
-! C
-
-	IF (FMIRR.EQ.3) THEN
-	 IF (F_TORUS.EQ.0) THEN
-	    Z_VRS(3)=-1.0D0
-            IFLAG=1
-! C
-! C  note: here we have to reset F_TORUS = 3 in order to
-! C  find the proper distance from the z=0 plane to the
-! C  baseline mirror. i.e. At F_TORUS = 0 we calculate
-! C  the farthest distance while at F_TORUS = 3 we get
-! C  the closest distance.
-! C
-	    FRUS = F_TORUS
-	    F_TORUS = 3
-	    CALL INTERCEPT (PF_CENT,Z_VRS,TPAR,IFLAG)
-	      F_TORUS=FRUS
-	      Z_VRS(3)=1.0D0
-          IF (IFLAG.NE.0) THEN
-! C 6/5/93
-! C g.j.
-! C
-         DO 295 I_DEL=1,11
- 295       RAY (I_DEL,ITIK) = 0.0D0
-         RAY (10, ITIK) = -1.1D6*I_WHICH
-         goto 10000
-         END IF
-
-	 ELSE
-	      CALL LEAVE ('FACET','This part has not been considered yet',izero)
-         END IF
-! C
-! C For the base line other than Tordial baseline
-! C
-	ELSE
-	  IFLAG=-1
-! C
-! C Set the IFLAG = -1 for the closest intercepted length
+! C and the new coordinate system (computed once per facet)
 ! C
-
-	      CALL INTERCEPT (PF_CENT,Z_VRS,TPAR,IFLAG)
-	      IF (IFLAG.NE.0) THEN
+	CALL FacetLookup (IFAC_X,IFAC_Y,PF_CENT,PF_NOR,PF_BNOR,PF_TAU,IFLAG)
+	IF (IFLAG.NE.0) THEN
 ! C 6/5/93
 ! C g.j.
 ! C
@@ -8033,33 +9192,7 @@ end if
  297       RAY (I_DEL,ITIK) = 0.0D0
          RAY (10, ITIK) = -1.1D6*I_WHICH
          goto 10000
-         END IF
-
         END IF
-	    PF_CENT(3) = TPAR
-
-
-! C Define the normal vector for the facet mirror
-! C
-	      CALL    NORMAL (PF_CENT,PF_NOR)
-	      IF (F_CONVEX.EQ.0) CALL SCALAR (PF_NOR,-1.0D0,PF_NOR) 
-	      CALL    NORM   (PF_NOR,PF_NOR)
-! C
-! C Define binormal and tangential vectors
-! C
-              PF_BNOR(2)=0.0D0
-	      IF (PF_NOR(3).EQ.0) CALL LEAVE &
-                    ('FACET','N_z should not be zero',izero)
-	    IF (PF_NOR(1).NE.0.) THEN
-	       PF_BNOR(1)=PF_NOR(3)
-	       PF_BNOR(3)=-1.0D0*PF_NOR(1)
-	    ELSE
-	       PF_BNOR(1)=1.0D0
-	       PF_BNOR(3)=0.0D0
-	    END IF
-	    CALL NORM(PF_BNOR,PF_BNOR)
-	       CALL CROSS (PF_NOR,PF_BNOR,PF_TAU)
-	       CALL NORM (PF_TAU,PF_TAU)
 
 ! C
 ! C Local refence frame has been set
@@ -8580,7 +9713,7 @@ end if
 ! * phase relation. These two incoming vectors have to be resolved into the
 ! * local S- and P- component with a new phase relation.
 ! * A_VEC will be rotated later, once the amplitude will have been determined.
-     	CALL	CROSS 	(VVIN,VNOR,AS_TEMP)	! vector pp. to inc.pl.
+     	CALL	CROSS_M_FLAG 	(VVIN,VNOR,AS_TEMP,M_FLAG)	! vector pp. to inc.pl.
      	IF (M_FLAG.EQ.1) THEN
 	CALL	DOT	(AS_VEC,AS_VEC,AS2)
 	CALL	DOT	(AP_VEC,AP_VEC,AP2)
@@ -8980,20 +10113,20 @@ end if
         ! srio@esrf.eu 20110412 avoid writing effic.xx if FWRITE=3
         IF (FWRITE.NE.3) THEN
      	  CALL	FNAME	(FFILE, 'effic', I_WHICH, izero)
-	  OPEN (UNIT=20,FILE=FFILE,STATUS='UNKNOWN')
-	  REWIND (20)
-     	  IF (K_2.EQ.0)	WRITE (20,3000)
-	  WRITE (20,2000) NPOINT,K_2,K_5,I_WHICH,EFF_GEOM
+	  OPEN (NEWUNIT=iunit,FILE=FFILE,STATUS='UNKNOWN')
+	  REWIND (iunit)
+     	  IF (K_2.EQ.0)	WRITE (iunit,3000)
+	  WRITE (iunit,2000) NPOINT,K_2,K_5,I_WHICH,EFF_GEOM
      	  IF (F_REFLEC.EQ.1) THEN
-     	    WRITE (20,2010) ABS_REF_S,ABS_REF_P,ABS_REF
+     	    WRITE (iunit,2010) ABS_REF_S,ABS_REF_P,ABS_REF
      	  ELSE IF (F_REFLEC.EQ.2) THEN
-     	    WRITE (20,2020) ABS_REF
+     	    WRITE (iunit,2020) ABS_REF
      	  END IF
           IF (F_ROUGHNESS.EQ.1) THEN
-             WRITE(20,2040) krough_count2,krough_count
+             WRITE(iunit,2040) krough_count2,krough_count
           END IF
-     	  IF (F_REFLEC.NE.0) WRITE (20,2030) OVERALL
-	  CLOSE (20)
+     	  IF (F_REFLEC.NE.0) WRITE (iunit,2030) OVERALL
+	  CLOSE (iunit)
         END IF ! fwrite
 
 3000	FORMAT (1X,'WATCH OUT !! NO GOOD RAYS IN INPUT !!')
@@ -9015,12 +10148,12 @@ end if
 ! C write incidence and reflection information to file
  
         CALL FNAME (FFILE, 'angle', I_WHICH, izero)
-        OPEN (UNIT=55,FILE=FFILE,STATUS='UNKNOWN')
-        REWIND (55)
+        OPEN (NEWUNIT=iunit,FILE=FFILE,STATUS='UNKNOWN')
+        REWIND (iunit)
  
         DO 2525 J = 1,NPOINT
-2525      WRITE(55,*) ANGLE(1,J),ANGLE(2,J),ANGLE(3,J),ANGLE(4,J)
-        CLOSE(55)
+2525      WRITE(iunit,*) ANGLE(1,J),ANGLE(2,J),ANGLE(3,J),ANGLE(4,J)
+        CLOSE(iunit)
 	
 	END IF  ! write angle
 
@@ -10972,6 +12105,7 @@ SUBROUTINE sourceGeom (pool00,ray,npoint1) !bind(C,NAME="sourceGeom")
     integer(kind=ski) :: n_rej=0, k_rej=0, nrejected
     
     real(kind=skr)    :: xxx=0,yyy=0,zzz=0
+!$omp threadprivate(n_rej, k_rej, xxx, yyy, zzz)
 
     ! C
     ! C Save the *big* arrays so it will:
@@ -11850,56 +12984,33 @@ SUBROUTINE sourceGeom (pool00,ray,npoint1) !bind(C,NAME="sourceGeom")
 ! C	PARAMETERS	In Common blocks
 ! C
 ! C---
-SUBROUTINE RESTART18 (RAY18,NCOL1,NPOINT1) !,RAY,PHASE,AP)
+SUBROUTINE RESTART18 (RAY18,NCOL1,NPOINT1)
 
 	implicit none
 
         integer(kind=ski), intent(in) :: NPOINT1
         integer(kind=ski), intent(in) :: NCOL1
         real(kind=skr),dimension(18,NPOINT1),    intent(in out) :: RAY18
-        !real(kind=skr),dimension(NCOL1,NPOINT1), intent(in out) :: RAY
-        !real(kind=skr),dimension(3,NPOINT1),     intent(in out) :: PHASE, AP
-        real(kind=skr),dimension(NCOL1,NPOINT1)                  :: RAY
-        real(kind=skr),dimension(3,NPOINT1)                      :: PHASE, AP
+        real(kind=skr),dimension(:,:),allocatable                :: PHASE, AP
 
 !
-!       initialize
+! the sections of RAY18 are passed in place
 !
-        RAY   = 0.0D0
-        PHASE = 0.0D0
-        AP    = 0.0D0
-!
-! cp
-!
-        RAY(:,:)   = RAY18(1:NCOL1,:)
         IF (NCOL1 == 18) THEN
-          PHASE(:,:) = RAY18(13:15,:)
-          AP(:,:)    = RAY18(16:18,:)
-        END IF
-
-!
-! call the binded routine
-!
-
-	CALL RESTART(RAY,PHASE,AP)
-
-
+	  CALL RESTART(RAY18(1:12,:),RAY18(13:15,:),RAY18(16:18,:))
+        ELSE
 !
-! cp back
+! scalar beam (NCOL1=12): the amplitude of Ap (orthogonal to As) goes
+! into As, the weight of the ray, and Ap and the phases are not traced
 !
-        RAY18(1:NCOL1,:)  = RAY  
-        IF (NCOL1 == 18) THEN
-          RAY18(13:15,:) = PHASE
-          RAY18(16:18,:) = AP
+          RAY18(7:9,:) = RAY18(7:9,:) + RAY18(16:18,:)
+          RAY18(16:18,:) = 0.0D0
+          ALLOCATE (PHASE(3,NPOINT1),AP(3,NPOINT1))
+          PHASE = 0.0D0
+          AP    = 0.0D0
+	  CALL RESTART(RAY18(1:12,:),PHASE,AP)
 	END IF
 
-!TODO: remove, this is reduntant (for test)
-!        RAY(:,:)   = RAY18(1:NCOL1,:)
-!        IF (NCOL1 == 18) THEN
-!          PHASE(:,:) = RAY18(13:15,:)
-!          AP(:,:)    = RAY18(16:18,:)
-!        END IF
-
 End Subroutine restart18
   
 
@@ -11918,7 +13029,6 @@ End Subroutine restart18
 ! C
 ! C---
 SUBROUTINE SCREEN18 (RAY18,NCOL1,NPOINT1, &
-                     !RAY,AP,PHASE, &
                      i_what,i_element)
 
 	implicit none
@@ -11926,41 +13036,18 @@ SUBROUTINE SCREEN18 (RAY18,NCOL1,NPOINT1, &
         integer(kind=ski), intent(in) :: NPOINT1,NCOL1
         integer(kind=ski), intent(in) :: i_what,i_element
         real(kind=skr),dimension(18,NPOINT1),    intent(in out) :: RAY18
-        !real(kind=skr),dimension(NCOL1,NPOINT1), intent(in out) :: RAY
-        !real(kind=skr),dimension(3,NPOINT1),     intent(in out) :: PHASE, AP
-        real(kind=skr),dimension(NCOL1,NPOINT1) :: RAY
-        real(kind=skr),dimension(3,NPOINT1)     :: PHASE, AP
-        integer(kind=ski)                                   :: i,j
+        real(kind=skr),dimension(:,:),allocatable                :: PHASE, AP
 
 !
-!       initialize
+! the sections of RAY18 are passed in place (see RESTART18)
 !
-        RAY   = 0.0D0
-        PHASE = 0.0D0
-        AP    = 0.0D0
-!
-! cp
-!
-        RAY(:,:)   = RAY18(1:NCOL1,:)
-        IF (NCOL1 == 18) THEN
-          PHASE(:,:) = RAY18(13:15,:)
-          AP(:,:)    = RAY18(16:18,:)
-        END IF
-
-!
-! call the binded routine
-!
-
-	CALL SCREEN(RAY,AP,PHASE,I_WHAT,I_ELEMENT)
-
-
-!
-! cp back
-!
-        RAY18(1:NCOL1,:)  = RAY  
         IF (NCOL1 == 18) THEN
-          RAY18(13:15,:) = PHASE
-          RAY18(16:18,:) = AP
+	  CALL SCREEN(RAY18(1:12,:),RAY18(16:18,:),RAY18(13:15,:),I_WHAT,I_ELEMENT)
+        ELSE
+          ALLOCATE (PHASE(3,NPOINT1),AP(3,NPOINT1))
+          PHASE = 0.0D0
+          AP    = 0.0D0
+	  CALL SCREEN(RAY18(1:12,:),AP,PHASE,I_WHAT,I_ELEMENT)
 	END IF
 
 End Subroutine screen18
@@ -11981,7 +13068,6 @@ End Subroutine screen18
 ! C
 ! C---
 SUBROUTINE MIRROR18 (RAY18,NCOL1,NPOINT1, &
-                     !RAY,AP,PHASE, &
                      i_which)
 
 	implicit none
@@ -11989,40 +13075,18 @@ SUBROUTINE MIRROR18 (RAY18,NCOL1,NPOINT1, &
         integer(kind=ski), intent(in) :: NPOINT1,NCOL1
         integer(kind=ski), intent(in) :: i_which
         real(kind=skr),dimension(18,NPOINT1),    intent(in out) :: RAY18
-        !real(kind=skr),dimension(NCOL1,NPOINT1), intent(in out) :: RAY
-        !real(kind=skr),dimension(3,NPOINT1),     intent(in out) :: PHASE, AP
-        real(kind=skr),dimension(NCOL1,NPOINT1) :: RAY
-        real(kind=skr),dimension(3,NPOINT1)     :: PHASE, AP
-        integer(kind=ski)                                   :: i,j
-
-!
-!       initialize
-!
-        RAY   = 0.0D0
-        PHASE = 0.0D0
-        AP    = 0.0D0
-!
-! cp
-!
-        RAY(:,:)   = RAY18(1:NCOL1,:)
-        IF (NCOL1 == 18) THEN
-          PHASE(:,:) = RAY18(13:15,:)
-          AP(:,:)    = RAY18(16:18,:)
-        END IF
-
-!
-! call the binded routine
-!
-
-	CALL MIRROR1(RAY,AP,PHASE,I_WHICH)
+        real(kind=skr),dimension(:,:),allocatable                :: PHASE, AP
 
 !
-! cp back
+! the sections of RAY18 are passed in place (see RESTART18)
 !
-        RAY18(1:NCOL1,:)  = RAY  
         IF (NCOL1 == 18) THEN
-          RAY18(13:15,:) = PHASE
-          RAY18(16:18,:) = AP
+	  CALL MIRROR1(RAY18(1:12,:),RAY18(16:18,:),RAY18(13:15,:),I_WHICH)
+        ELSE
+          ALLOCATE (PHASE(3,NPOINT1),AP(3,NPOINT1))
+          PHASE = 0.0D0
+          AP    = 0.0D0
+	  CALL MIRROR1(RAY18(1:12,:),AP,PHASE,I_WHICH)
 	END IF
 
 End Subroutine MIRROR18
@@ -12049,41 +13113,18 @@ SUBROUTINE IMAGE18 (RAY18,NCOL1,NPOINT1, i_what)
         integer(kind=ski), intent(in) :: NPOINT1,NCOL1
         integer(kind=ski), intent(in) :: i_what
         real(kind=skr),dimension(18,NPOINT1),    intent(in out) :: RAY18
-        !real(kind=skr),dimension(NCOL1,NPOINT1), intent(in out) :: RAY
-        !real(kind=skr),dimension(3,NPOINT1),     intent(in out) :: PHASE, AP
-        real(kind=skr),dimension(NCOL1,NPOINT1) :: RAY
-        real(kind=skr),dimension(3,NPOINT1)     :: PHASE, AP
-        integer(kind=ski)                       :: i,j
-
-!
-!       initialize
-!
-        RAY   = 0.0D0
-        PHASE = 0.0D0
-        AP    = 0.0D0
-!
-! cp
-!
-        RAY(:,:)   = RAY18(1:NCOL1,:)
-        IF (NCOL1 == 18) THEN
-          PHASE(:,:) = RAY18(13:15,:)
-          AP(:,:)    = RAY18(16:18,:)
-        END IF
+        real(kind=skr),dimension(:,:),allocatable                :: PHASE, AP
 
 !
-! call the binded routine
+! the sections of RAY18 are passed in place (see RESTART18)
 !
-
-        CALL IMAGE1(RAY,AP,PHASE,I_WHAT)
-
-
-!
-! cp back
-!
-        RAY18(1:NCOL1,:)  = RAY  
         IF (NCOL1 == 18) THEN
-          RAY18(13:15,:) = PHASE
-          RAY18(16:18,:) = AP
+          CALL IMAGE1(RAY18(1:12,:),RAY18(16:18,:),RAY18(13:15,:),I_WHAT)
+        ELSE
+          ALLOCATE (PHASE(3,NPOINT1),AP(3,NPOINT1))
+          PHASE = 0.0D0
+          AP    = 0.0D0
+          CALL IMAGE1(RAY18(1:12,:),AP,PHASE,I_WHAT)
         END IF
 
 End Subroutine image18
@@ -12109,6 +13150,7 @@ SUBROUTINE DeAlloc
      integer(kind=ski) :: SERR,IFLAG
      real(kind=skr)    :: xin=0d0,yin=0d0,zout=0d0
      real(kind=skr),dimension(3)     :: vin=(/0.0,1.0,0.0/)
+!$omp threadprivate(xin, yin, zout, vin)
     
     WRITE(6,*)'Call to DEALLOC'
 
@@ -12156,6 +13198,14 @@ END SUBROUTINE DeAlloc
 ! C			[ O ]   oeType	: the type with oe variables (end.xx)
 ! C			[ O ]   RAY18	: the array with image (star.xx)
 ! C
+! C	NOTE		The ray loop runs in several OpenMP threads when
+! C			SHADOW_OMP_THREADS is set (see TRACE_THREADS).
+! C			With SHADOW_SCALAR_BEAM=1, an oe with NCOL=12
+! C			traces a scalar beam: As carries the whole
+! C			amplitude, Ap and the phases (columns 13-18) are
+! C			not traced (see RESTART18). Without it, the 18
+! C			columns are always traced, whatever NCOL (start
+! C			files often have NCOL=12).
 ! C
 ! C---
 SUBROUTINE TraceOE (oeType,ray18,npoint1,icount) bind(C,NAME="TraceOE")
@@ -12167,14 +13217,39 @@ SUBROUTINE TraceOE (oeType,ray18,npoint1,icount) bind(C,NAME="TraceOE")
         real(kind=skr),dimension(18,npoint1),  intent(in out) :: ray18
 	type (poolOE),                         intent(in out) :: oeType
 
-        integer(kind=ski)      :: i,ncol1
+        integer(kind=ski)      :: ncol1,nthreads
+
+
+        ! scalar beam (see RESTART18) if the oe has NCOL=12 and SHADOW_SCALAR_BEAM=1
+        ncol1 = 18
+        IF (oeType%NCOL.EQ.12.AND.EnvFlag('SHADOW_SCALAR_BEAM')) ncol1 = 12
+
+        nthreads = Trace_Threads(oeType,npoint1)
+        IF (nthreads.GT.1) THEN
+            CALL TraceOE_Parallel (oeType,ray18,ncol1,npoint1,icount,nthreads)
+        ELSE
+            CALL TraceOE_Setup (oeType,ncol1,npoint1,icount)
+            CALL TraceOE_Rays (oeType,ray18,ncol1,npoint1,icount)
+        END IF
+
+End Subroutine traceoe
+
+! C+++
+! C	SUBROUTINE	TRACEOE_SETUP
+! C
+! C	PURPOSE		loads the oe variables into the kernel and computes
+! C			the source, image, optical axis and mirror parameters
+! C
+! C---
+SUBROUTINE TraceOE_Setup (oeType,ncol1,npoint1,icount)
+
+	implicit none
 
+        integer(kind=ski),                     intent(in) :: ncol1,npoint1,icount
+	type (poolOE),                         intent(in out) :: oeType
 
-	if(ncol.ne.0) then
-		ncol1 = ncol ! cp from existing one
-	else
-		ncol1 = 18
-	endif
+        ! free the arrays kept by a prepared oe (see TraceOE_Prepared)
+        call TraceOE_Release
 
         call reset
 
@@ -12202,6 +13277,25 @@ SUBROUTINE TraceOE (oeType,ray18,npoint1,icount) bind(C,NAME="TraceOE")
 	! C
 	CALL MSETUP (ICOUNT)
 
+End Subroutine TraceOE_Setup
+
+! C+++
+! C	SUBROUTINE	TRACEOE_RAYS
+! C
+! C	PURPOSE		traces the rays through an oe set up by TRACEOE_SETUP
+! C
+! C---
+SUBROUTINE TraceOE_Rays (oeType,ray18,ncol1,npoint1,icount)
+
+	implicit none
+
+        integer(kind=ski),                     intent(in) :: ncol1,npoint1,icount
+        real(kind=skr),dimension(18,npoint1),  intent(in out) :: ray18
+	type (poolOE),                         intent(in out) :: oeType
+
+        integer(kind=ski)      :: i
+
+        skip_lost = EnvFlag('SHADOW_SKIP_LOST')
 	! C
 	! C This call rotates the last RAY file in the new MIRROR reference
 	! C frame
@@ -12248,9 +13342,13 @@ SUBROUTINE TraceOE (oeType,ray18,npoint1,icount) bind(C,NAME="TraceOE")
 	CALL IMAGE18 (RAY18,NCOL1,NPOINT1,ICOUNT)
 
        !
-       ! deallocate arrays
+       ! deallocate arrays (kept by a prepared oe until TraceOE_Release)
        !
-       CALL DEALLOC
+       IF (prepared_valid) THEN
+         IDUMMY = 1
+       ELSE
+         CALL DEALLOC
+       END IF
 
        !CALL	FNAME (FFILE, 'star', ICOUNT, izero)
        !IFLAG	= 0
@@ -12260,7 +13358,241 @@ SUBROUTINE TraceOE (oeType,ray18,npoint1,icount) bind(C,NAME="TraceOE")
 	! cp global variables in input/output type
 	call GlobalToPoolOE(oeType)
 
-End Subroutine traceoe
+End Subroutine TraceOE_Rays
+
+! C+++
+! C	FUNCTION	TRACE_THREADS
+! C
+! C	PURPOSE		returns the number of threads for the ray loop of
+! C			an oe. The parallel loop is selected with the
+! C			environment variable SHADOW_OMP_THREADS (number of
+! C			threads, 0 for the OpenMP default). It is used only
+! C			if the kernel is built with OpenMP and the oe writes
+! C			no files (FWRITE=3, no plates, angles or codling
+! C			slit), as these are written from the whole beam.
+! C
+! C---
+Function Trace_Threads (oeType,npoint1) result(nthreads)
+
+	implicit none
+
+	type (poolOE),                         intent(in) :: oeType
+        integer(kind=ski),                     intent(in) :: npoint1
+        integer(kind=ski)                                 :: nthreads
+
+        character(len=sklen)   :: value
+        integer                :: length,status
+        integer(kind=ski)      :: n
+
+        nthreads = 1
+#ifdef _OPENMP
+        IF (omp_in_parallel()) RETURN
+        CALL GET_ENVIRONMENT_VARIABLE ('SHADOW_OMP_THREADS',value,length,status)
+        IF (status.NE.0.OR.length.EQ.0) RETURN
+        READ (value,*,IOSTAT=status) n
+        IF (status.NE.0) RETURN
+        IF (n.LE.0) n = omp_get_max_threads()
+        IF (oeType%FWRITE.NE.3.OR.oeType%N_PLATES.GT.0.OR.oeType%F_ANGLE.NE.0 &
+            .OR.oeType%FMIRR.EQ.6.OR.oeType%F_KOMA.EQ.1) RETURN
+        ! every thread repeats the setup, keep enough rays per thread
+        nthreads = max(1_ski,min(n,npoint1/TRACE_MIN_RAYS))
+#endif
+
+End Function Trace_Threads
+
+! C+++
+! C	SUBROUTINE	TRACEOE_PARALLEL
+! C
+! C	PURPOSE		traces an oe splitting the beam among nthreads
+! C			OpenMP threads
+! C
+! C	ALGORITHM	Each thread has its own kernel variables (they are
+! C			threadprivate), so it sets up the oe by itself and
+! C			traces a contiguous chunk of ray18, with its own
+! C			scratch arrays (CODLING, ANGLE, ...). The setup is
+! C			done one thread at a time, as it may read and write
+! C			files. Each thread uses its own random substream
+! C			of a seed drawn from the stream of the caller. The oe
+! C			variables of the last chunk are returned, as in
+! C			the sequential trace.
+! C
+! C---
+SUBROUTINE TraceOE_Parallel (oeType,ray18,ncol1,npoint1,icount,nthreads)
+
+	implicit none
+
+        integer(kind=ski),                     intent(in) :: ncol1,npoint1,icount,nthreads
+        real(kind=skr),dimension(18,npoint1),  intent(in out) :: ray18
+	type (poolOE),                         intent(in out) :: oeType
+
+        type (poolOE)                          :: chunkOE,lastOE
+        integer(kind=ski)                      :: seed,ith,i0,i1,skipped
+
+        seed = 1 + int(WRAN(oeType%ISTAR1)*2.0D0**30,kind=ski)
+        skipped = 0
+
+!$omp parallel num_threads(nthreads) default(shared) private(chunkOE,ith,i0,i1)
+#ifdef _OPENMP
+        ith = omp_get_thread_num()
+#else
+        ith = 0
+#endif
+        i0 = 1 + (ith*npoint1)/nthreads
+        i1 = ((ith+1)*npoint1)/nthreads
+        chunkOE = oeType
+        CALL WRAN_STREAM (seed,icount,ith)
+!$omp critical (shadow_trace_setup)
+        CALL TraceOE_Setup (chunkOE,ncol1,i1-i0+1,icount)
+!$omp end critical (shadow_trace_setup)
+        CALL TraceOE_Rays (chunkOE,ray18(:,i0:i1),ncol1,i1-i0+1,icount)
+        IF (ith.EQ.nthreads-1) lastOE = chunkOE
+!$omp atomic
+        skipped = skipped + SkippedRays(.true.)
+!$omp end parallel
+
+        skipped_rays = skipped_rays + skipped
+        oeType = lastOE
+        oeType%NPOINT = npoint1
+
+End Subroutine TraceOE_Parallel
+
+! C+++
+! C	SUBROUTINE	TRACEOE_PREPARED
+! C
+! C	PURPOSE		traces an optical element as TRACEOE, reusing the
+! C			setup (source, image and optical axis, mirror
+! C			parameters, spline and polynomial surfaces, ripples)
+! C			of the previous call when the oe is the same.
+! C
+! C	ALGORITHM	After the setup the kernel variables are saved in
+! C			the prepared_* variables, and the arrays allocated
+! C			by the setup (spline) are kept. The next call with
+! C			the same oe (all its variables equal to the ones of
+! C			the oe before or after the previous trace), number
+! C			icount and ncol restores the saved variables and
+! C			goes to the ray loop. Any other oe runs the setup
+! C			again. A TRACEOE of another oe frees the arrays
+! C			(TRACEOE_RELEASE). The cache is per thread, the ray
+! C			loop runs always in the calling thread, and the
+! C			random ripples (F_R_RAN=1) are those of the setup.
+! C
+! C---
+SUBROUTINE TraceOE_Prepared (oeType,ray18,npoint1,icount)
+
+	implicit none
+
+        integer(kind=ski),                     intent(in) :: npoint1,icount
+        real(kind=skr),dimension(18,npoint1),  intent(in out) :: ray18
+	type (poolOE),                         intent(in out) :: oeType
+
+        integer(kind=ski)      :: ncol1
+
+        ! scalar beam (see RESTART18) if the oe has NCOL=12 and SHADOW_SCALAR_BEAM=1
+        ncol1 = 18
+        IF (oeType%NCOL.EQ.12.AND.EnvFlag('SHADOW_SCALAR_BEAM')) ncol1 = 12
+
+        IF (TraceOE_IsPrepared(oeType,ncol1,icount)) THEN
+          CALL PoolSourceToGlobal (prepared_src)
+          CALL PoolOEToGlobal (prepared_oe)
+          CALL KernelStateToGlobal (prepared_state)
+          NPOINT = NPOINT1
+          NCOL   = NCOL1
+        ELSE
+          prepared_in = oeType
+          CALL TraceOE_Setup (oeType,ncol1,npoint1,icount)
+          CALL GlobalToPoolSource (prepared_src)
+          CALL GlobalToPoolOE (prepared_oe)
+          CALL GlobalToKernelState (prepared_state)
+          prepared_ncol = ncol1
+          prepared_icount = icount
+          prepared_valid = .true.
+        END IF
+        CALL TraceOE_Rays (oeType,ray18,ncol1,npoint1,icount)
+        prepared_end = oeType
+
+End Subroutine TraceOE_Prepared
+
+! C+++
+! C	SUBROUTINE	TRACEOE_RELEASE
+! C
+! C	PURPOSE		frees the arrays kept by the oe prepared by
+! C			TRACEOE_PREPARED, if any, and forgets it
+! C
+! C---
+SUBROUTINE TraceOE_Release
+
+	implicit none
+
+        IF (.NOT.prepared_valid) RETURN
+        prepared_valid = .false.
+        CALL PoolOEToGlobal (prepared_oe)
+        CALL DEALLOC
+
+End Subroutine TraceOE_Release
+
+!
+! true if oeType is the prepared oe, traced with the same ncol and icount
+!
+Function TraceOE_IsPrepared (oeType,ncol1,icount) result(same)
+
+	implicit none
+
+	type (poolOE),                         intent(in) :: oeType
+        integer(kind=ski),                     intent(in) :: ncol1,icount
+        logical                                           :: same
+
+        same = .false.
+        IF (.NOT.prepared_valid) RETURN
+        IF (ncol1.NE.prepared_ncol.OR.icount.NE.prepared_icount) RETURN
+        same = SamePoolOE(oeType,prepared_end)
+        IF (.NOT.same) same = SamePoolOE(oeType,prepared_in)
+
+End Function TraceOE_IsPrepared
+
+!
+! compares two oe's byte by byte
+!
+Function SamePoolOE (oe1,oe2) result(same)
+
+	implicit none
+
+	type (poolOE),                         intent(in) :: oe1,oe2
+        logical                                           :: same
+
+        integer(kind=1),dimension(1)                      :: mold
+
+        same = all(transfer(oe1,mold) .eq. transfer(oe2,mold))
+
+End Function SamePoolOE
+
+!
+! copies the kernel variables (shadow_kernel_state.def) to and from a KernelState
+!
+Subroutine GlobalToKernelState (st)
+
+	implicit none
+
+	type (KernelState),                    intent(out) :: st
+
+#define EXPAND_STATE_SCALAR(ftype,fkind,name) st%name = name
+#define EXPAND_STATE_STRING(name,length) st%name = name
+#define EXPAND_STATE_ARRAYS(ftype,fkind,name,arrdim) st%name = name
+#include "shadow_kernel_state.def"
+
+End Subroutine GlobalToKernelState
+
+Subroutine KernelStateToGlobal (st)
+
+	implicit none
+
+	type (KernelState),                    intent(in) :: st
+
+#define EXPAND_STATE_SCALAR(ftype,fkind,name) name = st%name
+#define EXPAND_STATE_STRING(name,length) name = st%name
+#define EXPAND_STATE_ARRAYS(ftype,fkind,name,arrdim) name = st%name
+#include "shadow_kernel_state.def"
+
+End Subroutine KernelStateToGlobal
 
 !
 ! shadow3trace: driver for trace...
@@ -12424,8 +13756,10 @@ integer(kind=ski)                        :: nrefl_obj
 integer(kind=ski)                        :: nrefl_ima
 
 real(kind=skr)                  :: ratio, phot_ener, ratio1, ratio2
-integer(kind=ski)               :: index1,i,iErr
+integer(kind=ski)               :: index1,i,iErr,iunit
 real(kind=skr)                  :: wnum0,del_x
+integer(kind=ski),dimension(:),allocatable :: ivalues
+real(kind=skr),dimension(:),allocatable    :: rvalues
 ! note that alfa (watch the f!!) and gamma are called internally myALFA and myGAMMA
 ! to avoid conflict with the global ALFA and GAMMA.
 real(kind=skr)                  :: myALFA,myGAMMA
@@ -12438,6 +13772,8 @@ integer(kind=ski)               :: i_debug=0
 ! C
 SAVE        QMIN_obj, QMAX_obj, QSTEP_obj, DEPTH0_obj, NREFL_obj, zf1_obj, zf2_obj
 SAVE        QMIN_ima, QMAX_ima, QSTEP_ima, DEPTH0_ima, NREFL_ima, zf1_ima, zf2_ima
+!$omp threadprivate(QMIN_obj, QMAX_obj, QSTEP_obj, DEPTH0_obj, NREFL_obj, zf1_obj, zf2_obj)
+!$omp threadprivate(QMIN_ima, QMAX_ima, QSTEP_ima, DEPTH0_ima, NREFL_ima, zf1_ima, zf2_ima)
 
 ! C
 ! C Initialization call. 
@@ -12465,59 +13801,29 @@ case (0)  ! load files
     if (f_r_ind.eq.0) return
 
     if ((f_r_ind.eq.1).or.(f_r_ind.eq.3)) then 
-        ! only new ascii output from prerefl is accepted for lenses
-        OPEN  (23,FILE=FILE_R_IND_OBJ,STATUS='OLD', FORM='FORMATTED', IOSTAT=iErr)
-        ! srio added test
-        IF (ierr /= 0 ) then
-             PRINT *,"GET_REFRACTION_INDEX: Error: File not found: "//TRIM(file_r_ind_obj)
-             STOP ' Fatal error: aborted'
-        END IF
-        READ (23,*) QMIN_obj,QMAX_obj,QSTEP_obj,DEPTH0_obj
-        READ (23,*) NREFL_obj
-        IF (.NOT. ALLOCATED(zf1_obj)) THEN
-          ALLOCATE(zf1_obj(nrefl_obj),STAT=ierr)
-          IF (ierr /= 0) THEN
-            print *,"GET_REFRACTION_INDEX: Error allocating array" ; STOP 4
-          END IF
-        END IF
-        IF (.NOT. ALLOCATED(zf2_obj)) THEN
-          ALLOCATE(zf2_obj(nrefl_obj),STAT=ierr)
-          IF (ierr /= 0) THEN
-            print *,"GET_REFRACTION_INDEX: Error allocating array" ; STOP 4
-          END IF
-        END IF
-        READ (23,*) (zf1_obj(I),I=1,NREFL_obj)
-        READ (23,*) (zf2_obj(I),I=1,NREFL_obj)
-        CLOSE (23)
+        ! prerefl file, read once per process (see TableLoad)
+        CALL TableLoad (TABLE_PREREFL,FILE_R_IND_OBJ,ivalues,rvalues)
+        NREFL_obj  = ivalues(1)
+        QMIN_obj   = rvalues(1)
+        QMAX_obj   = rvalues(2)
+        QSTEP_obj  = rvalues(3)
+        DEPTH0_obj = rvalues(4)
+        zf1_obj = rvalues(5:4+NREFL_obj)
+        zf2_obj = rvalues(5+NREFL_obj:4+2*NREFL_obj)
         if (i_debug.gt.0) print *,">>Debug: file read successfully: "//trim(FILE_R_IND_OBJ)
     end if
 
 
     if ((f_r_ind.eq.2).or.(f_r_ind.eq.3)) then 
-        ! only new ascii output from prerefl is accepted for lenses
-        OPEN  (23,FILE=FILE_R_IND_IMA,STATUS='OLD', FORM='FORMATTED', IOSTAT=iErr)
-        ! srio added test
-        IF (ierr /= 0 ) then
-             PRINT *,"GET_REFRACTION_INDEX: Error: File not found: "//TRIM(file_r_ind_ima)
-             STOP ' Fatal error: aborted'
-        END IF
-        READ (23,*) QMIN_ima,QMAX_ima,QSTEP_ima,DEPTH0_ima
-        READ (23,*) NREFL_ima
-        IF (.NOT. ALLOCATED(zf1_ima)) THEN
-          ALLOCATE(zf1_ima(nrefl_ima),STAT=ierr)
-          IF (ierr /= 0) THEN
-            print *,"GET_REFRACTION_INDEX: Error allocating array" ; STOP 4
-          END IF
-        END IF
-        IF (.NOT. ALLOCATED(zf2_ima)) THEN
-          ALLOCATE(zf2_ima(nrefl_ima),STAT=ierr)
-          IF (ierr /= 0) THEN
-            print *,"GET_REFRACTION_INDEX: Error allocating array" ; STOP 4
-          END IF
-        END IF
-        READ (23,*) (zf1_ima(I),I=1,NREFL_ima)
-        READ (23,*) (zf2_ima(I),I=1,NREFL_ima)
-        CLOSE (23)
+        ! prerefl file, read once per process (see TableLoad)
+        CALL TableLoad (TABLE_PREREFL,FILE_R_IND_IMA,ivalues,rvalues)
+        NREFL_ima  = ivalues(1)
+        QMIN_ima   = rvalues(1)
+        QMAX_ima   = rvalues(2)
+        QSTEP_ima  = rvalues(3)
+        DEPTH0_ima = rvalues(4)
+        zf1_ima = rvalues(5:4+NREFL_ima)
+        zf2_ima = rvalues(5+NREFL_ima:4+2*NREFL_ima)
         if (i_debug.gt.0) print *,">>Debug: file read successfully: "//trim(FILE_R_IND_IMA)
     end if
 ! C
@@ -31,7 +31,7 @@ Module shadow_math
 !---- the vectorial calculus tools:   scalar, dot, cross, norm, vector, 
 !----                                 versor, proj, vsum, vdist
 
-    public :: wran, mysqrt
+    public :: wran, wran_stream, mysqrt
     public :: rotate, spl_int, lin_int, atan_2, gauss, binormal
     public :: scalar, dot, cross, norm, vector, versor, proj, vsum, vdist
     public :: gnormal, rotvector, mfp, cross_m_flag
@@ -40,8 +40,22 @@ Module shadow_math
     public :: ibcccu, ibcdcu
 
     private :: gcf,gser
+    private :: philox4x32, mulhilo32
     private :: erfc,gammp,gammq,gammln
 
+!---- state of wran (one per thread when compiled with OpenMP): the Philox
+!---- key and counter (32 bit words), and the numbers left from the last block
+    integer, parameter :: WRAN_INT = selected_int_kind(18)
+    integer(kind=WRAN_INT), parameter :: WRAN_MASK = 4294967295_WRAN_INT
+    integer(kind=WRAN_INT), parameter :: PHILOX_M0 = 3528531795_WRAN_INT  ! 0xD2511F53
+    integer(kind=WRAN_INT), parameter :: PHILOX_M1 = 3449720151_WRAN_INT  ! 0xCD9E8D57
+    integer(kind=WRAN_INT), parameter :: PHILOX_W0 = 2654435769_WRAN_INT  ! 0x9E3779B9
+    integer(kind=WRAN_INT), parameter :: PHILOX_W1 = 3144134277_WRAN_INT  ! 0xBB67AE85
+    integer(kind=WRAN_INT) :: wran_key(2)=0, wran_ctr(4)=0
+    real(kind=skr)         :: wran_buf(2)=0.0D0
+    integer(kind=ski)      :: wran_first=1, wran_next=3, wran_counter=0
+!$omp threadprivate(wran_key, wran_ctr, wran_buf, wran_first, wran_next, wran_counter)
+
 !----
 !---- Some mathematical routines from IMSL library.
 !----
@@ -59,6 +73,8 @@ Module shadow_math
 !
 !
     public :: mdnris, zrpoly, dbcevl, pnpoly
+    public :: dbcevl_index, dbcevl_batch
+    private :: dbcevl_cell, dbcevl_interval
     private :: merfi
     private :: zrpqlb, zrpqlc, zrpqld, zrpqle, zrpqlf, zrpqlg, zrpqlh, zrpqli
 
@@ -70,18 +86,19 @@ Contains
 !!C +++
 !!C	REAL FUNCTION	WRAN (ISEED)
 !!C
-!!C This function is simply a wrapper around the "real" (intrinsic) random
-!!C number generator, RAN, supplied by all FTN compilers. It servers two
-!!C purposes: filter out "bad" random numbers (== 0 in SHADOW) and allow
-!!C SHADOW to read its random numbers out of a text file, so we can get 
-!!C the results across platforms.
+!!C Returns a random number in (0,1) (0 and 1 are never returned, they are
+!!C "bad" random numbers in SHADOW).
 !!C
-!!C 1/23/92 added the option to use the RAND function (IBM RS600
-!!C specfically) in the absence of a RAN function.  Also, when the 6000
-!!C compiler becomes able to handle the CALL EXIT, the STOP should be
-!!C removed. (*update*).
+!!C The numbers come from a counter-based generator, Philox4x32-10
+!!C (Salmon et al., "Parallel random numbers: as easy as 1, 2, 3", SC11):
+!!C the n-th number of a stream is a function of the key (the seed), the
+!!C stream and substream numbers and n only. Streams can then be split among
+!!C threads, processes or chunks of rays and give the same numbers whatever
+!!C the number of workers. The stream is selected with WRAN_STREAM; if it
+!!C has not been, the first call starts stream 0, substream 0 of ISEED.
 !!C
-!!C 		ISEED: the seed to give RAN.
+!!C 		ISEED: the seed (0 = use the system clock), used in
+!!C 		       the first call only.
 !!C
 !!C ---
 
@@ -89,77 +106,104 @@ Contains
 
                 implicit none
 
-                INTEGER(KIND=SKI)              :: ISEED,K
-                INTEGER(KIND=SKI),dimension(1) :: iseed2
-                INTEGER(KIND=SKI)              :: first=1,wran_counter=0
-                real(kind=skr)                 :: XX
-
-                !first=1
-
-!!++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-!! Uncomment this part is for the built-in f95 random generator
-!!
-!!
-     !write(*,*) " "
-     !write(*,*) "WRAN: first: ",first
-     !write(*,*) "WRAN: wran_counter: ",wran_counter
-
-         if (first.eq.1) then
-                first = 0
-                CALL init_random_seed(iseed)
+                INTEGER(KIND=SKI)              :: ISEED
+                INTEGER(KIND=SKI)              :: clock
+                INTEGER(KIND=WRAN_INT)         :: out(4)
+
+         if (wran_first.eq.1) then
+                IF (iseed.eq.0) then
+                  CALL SYSTEM_CLOCK(COUNT=clock)
+                  print *,"WRAN: random seed initialised using system clock"
+                  CALL WRAN_STREAM(clock,0,0)
+                ELSE
+                  CALL WRAN_STREAM(iseed,0,0)
+                END IF
          end if
-         CALL RANDOM_NUMBER(WRAN)
-
-!!++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-!! Uncomment for Penelope random number generator
-!!
-!!
-!!           wran = RAND_PENELOPE(1.0D0)
-
-!!++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-!!
-!! This part is for calling the C generator using the wranc.c wrapper
-!! This part produces the same results than Shadow 2.x
-!!
-
-!! todo: MUST BE COMMENTED IN WINDOWS
-!!      WRAN = WRANC(ISEED)
-!!
+         ! each Philox block gives two numbers of 53 bits
+         if (wran_next.gt.2) then
+                CALL PHILOX4X32(wran_ctr,wran_key,out)
+                wran_buf(1) = (ishft(out(1),-5)*67108864_WRAN_INT + ishft(out(2),-6) + 0.5D0) &
+                              * 2.0D0**(-53)
+                wran_buf(2) = (ishft(out(3),-5)*67108864_WRAN_INT + ishft(out(4),-6) + 0.5D0) &
+                              * 2.0D0**(-53)
+                wran_ctr(1) = iand(wran_ctr(1) + 1, WRAN_MASK)
+                if (wran_ctr(1).eq.0) wran_ctr(2) = iand(wran_ctr(2) + 1, WRAN_MASK)
+                wran_next = 1
+         end if
+         WRAN = wran_buf(wran_next)
+         wran_next = wran_next + 1
 
       wran_counter=wran_counter+1
       RETURN
 END FUNCTION WRAN
 
+!
+! WRAN_STREAM: selects the random stream used by WRAN in the calling thread:
+! key ISEED, stream ISTREAM and substream ISUBSTREAM, starting from its first
+! number (WRAN does not seed it again). The threads of a parallel trace and
+! the chunks of a source use different substreams of the same seed.
+!
+SUBROUTINE WRAN_STREAM (ISEED,ISTREAM,ISUBSTREAM)
 
+                implicit none
 
-SUBROUTINE init_random_seed(iseed)
-            INTEGER(kind=ski),intent(in) :: iseed
-            INTEGER(kind=ski) :: i, clock
+                INTEGER(KIND=SKI), INTENT(IN)  :: ISEED,ISTREAM,ISUBSTREAM
 
-            !watch out the kind here !
-            INTEGER           :: n
-            INTEGER, DIMENSION(:), ALLOCATABLE :: seed
+         wran_first = 0
+         wran_key(1) = iand(int(ISEED,kind=WRAN_INT),WRAN_MASK)
+         wran_key(2) = 0
+         wran_ctr(1) = 0
+         wran_ctr(2) = 0
+         wran_ctr(3) = iand(int(ISUBSTREAM,kind=WRAN_INT),WRAN_MASK)
+         wran_ctr(4) = iand(int(ISTREAM,kind=WRAN_INT),WRAN_MASK)
+         wran_next = 3
+         RETURN
+END SUBROUTINE WRAN_STREAM
 
-            CALL RANDOM_SEED(size = n)
-            !print *,"n=",n
-            ALLOCATE(seed(n))
+!
+! PHILOX4X32: the Philox4x32-10 bijection of the counter CTR with key KEY.
+! The 32 bit unsigned words are kept in 64 bit integers.
+!
+SUBROUTINE PHILOX4X32 (CTR,KEY,OUT)
 
-            !CALL RANDOM_SEED(GET = oldseed)
-            !print *,"INIT: old seed=",seed
+                implicit none
 
+                INTEGER(KIND=WRAN_INT), INTENT(IN)  :: CTR(4),KEY(2)
+                INTEGER(KIND=WRAN_INT), INTENT(OUT) :: OUT(4)
+                INTEGER(KIND=WRAN_INT)              :: K(2),HI0,LO0,HI1,LO1
+                INTEGER(KIND=SKI)                   :: I
+
+         OUT = CTR
+         K = KEY
+         DO I=1,10
+                CALL MULHILO32(PHILOX_M0,OUT(1),HI0,LO0)
+                CALL MULHILO32(PHILOX_M1,OUT(3),HI1,LO1)
+                OUT = (/ ieor(ieor(HI1,OUT(2)),K(1)), LO1, ieor(ieor(HI0,OUT(4)),K(2)), LO0 /)
+                K(1) = iand(K(1) + PHILOX_W0, WRAN_MASK)
+                K(2) = iand(K(2) + PHILOX_W1, WRAN_MASK)
+         END DO
+         RETURN
+END SUBROUTINE PHILOX4X32
 
-            IF (iseed.eq.0) then
-              CALL SYSTEM_CLOCK(COUNT=clock)
-              seed = clock + 37 * (/ (i - 1, i = 1, n) /)
-              print *,"INIT_RANDOM_SEED: random seed initialised using system clock"
-            ELSE 
-              seed = iseed
-            END IF
-            !print *,"INIT: seed=",seed
-            CALL RANDOM_SEED(PUT = seed)
+!
+! MULHILO32: high and low 32 bit words of the product of two 32 bit
+! unsigned words, done in 16 bit pieces to stay within signed 64 bits.
+!
+SUBROUTINE MULHILO32 (A,B,HI,LO)
+
+                implicit none
+
+                INTEGER(KIND=WRAN_INT), INTENT(IN)  :: A,B
+                INTEGER(KIND=WRAN_INT), INTENT(OUT) :: HI,LO
+                INTEGER(KIND=WRAN_INT)              :: P1,P2,T
 
-            DEALLOCATE(seed)
-END SUBROUTINE
+         P1 = iand(B,65535_WRAN_INT)*A
+         P2 = ishft(B,-16)*A
+         T  = P1 + ishft(iand(P2,65535_WRAN_INT),16)
+         LO = iand(T,WRAN_MASK)
+         HI = ishft(T,-32) + ishft(P2,-16)
+         RETURN
+END SUBROUTINE MULHILO32
 
 
 !
@@ -861,6 +905,7 @@ SUBROUTINE GNORMAL (ARG,ISEED,IFLAG)
         real(kind=skr),    intent(out)   :: arg
 
         real(kind=skr)    :: ymin=0.0,ymax=0.0  ! initialization implies "SAVE"
+!$omp threadprivate(ymin, ymax)
         real(kind=skr)    :: yval
         integer(kind=ski) :: ierr
         !SAVE                YMIN, YMAX
@@ -1124,6 +1169,7 @@ End Subroutine rotvector
        integer(kind=ski),  intent(in)    :: iflag
 
        real(kind=skr)    :: ymin=0.0,ymax=0.0, aa0, yval
+!$omp threadprivate(ymin, ymax)
 
        !todo check this save
        !SAVE YMIN, YMAX
@@ -2943,16 +2989,8 @@ END FUNCTION RAND_PENELOPE
      INTEGER(kind=ski)  :: NX,NY,IC,IER
        REAL(kind=skr)     :: X(1),Y(1),C(2,IC,1),XL,YL,PDS(6)
 ! C                                  SPECIFICATIONS FOR LOCAL VARIABLES   
-       INTEGER(kind=ski)  :: I,J,K,KM1,KP1,KP2,LXPL,LX,LY,L,LXP1
+       INTEGER(kind=ski)  :: I,J,LX,LY
        INTEGER(kind=ski)  :: WARNINGDISPLAY=0
-       REAL(kind=skr)     :: HX,HY,SUX(2),SUY(2),SU(2),SVX(2),SV(2),SXY(2),  &
-                          U,V,SPLN0,SPLN1,SPLN2,S0,SH,SP0,SPH,H,D
-       SPLN0(S0,SH,SP0,SPH,H,D) = S0+D*(H*SP0+D*(3.D0*(SH-S0)-            &
-        (SPH+2.D0*SP0)*H+D*(2.D0*(S0-SH)+(SPH+SP0)*H)))
-       SPLN1(S0,SH,SP0,SPH,H,D) = SP0+D*(6.D0*(SH-S0)/H-2.D0*             &
-        (SPH+2.D0*SP0)+3.D0*D*(2.D0*(S0-SH)/H+(SPH+SP0)))
-       SPLN2(S0,SH,SP0,SPH,H,D) = 6.D0*(SH-S0)/H**2-2.D0*                 &
-        (SPH+2.D0*SP0)/H+D*(2.D0*(S0-SH)/H**2+(SPH+SP0)/H)*6.D0
 ! C                                  FIRST EXECUTABLE STATEMENT           
        IER = 0
        IF (XL.LT.X(1)) IER = 33
@@ -2967,7 +3005,54 @@ END FUNCTION RAND_PENELOPE
           IF (YL.LE.Y(J)) GO TO 20
    15  CONTINUE
        IER = 36
-   20  LXP1 = LX+1
+   20  CALL DBCEVL_CELL (X,Y,C,IC,LX,LY,XL,YL,PDS)
+      !srio IF (IER.GT.0) CALL UERTST(IER,6HDBCEVL)                           
+       IF ((IER.GT.0).AND.(WARNINGDISPLAY.NE.0)) THEN 
+           print *,"              "
+           print *,"Warning: Out of range in math routine dbcevl. "
+           SELECT CASE (iEr)
+             CASE(33)
+               print *,"              IER = 33, XL IS LESS THAN X(1)."
+               print *,"              XL,X(1),X(NX): ",XL,X(1),X(NX)
+             CASE(34)
+               print *,"              IER = 34, YL IS LESS THAN Y(1)."
+               print *,"              YL,Y(1),Y(NY): ",YL,Y(1),Y(NY)
+             CASE(35)
+               print *,"              IER = 35, XL IS GREATER THAN X(NX)."
+               print *,"              XL,X(1),X(NX): ",XL,X(1),X(NX)
+             CASE(36)
+               print *,"              IER = 36, YL IS GREATER THAN Y(NY)."
+               print *,"              YL,Y(1),Y(NY): ",YL,Y(1),Y(NY)
+             CASE DEFAULT
+           END SELECT
+           !print *,"              XL,X(1),X(NX): ",XL,X(1),X(NX)
+           !print *,"              YL,Y(1),Y(NY): ",YL,Y(1),Y(NY)
+           print *,"              "
+        END IF
+
+       RETURN
+        END SUBROUTINE DBCEVL
+
+! C+++
+! C	SUBROUTINE	DBCEVL_CELL
+! C
+! C	PURPOSE		evaluates the bicubic spline C (see DBCEVL) in the
+! C			cell [X(LX),X(LX+1)]x[Y(LY),Y(LY+1)] at (XL,YL)
+! C
+! C---
+        SUBROUTINE DBCEVL_CELL (X,Y,C,IC,LX,LY,XL,YL,PDS)
+     INTEGER(kind=ski)  :: IC,LX,LY
+       REAL(kind=skr)     :: X(*),Y(*),C(2,IC,*),XL,YL,PDS(6)
+       INTEGER(kind=ski)  :: I,J,K,KM1,KP1,KP2,LXPL,L,LXP1
+       REAL(kind=skr)     :: HX,HY,SUX(2),SUY(2),SU(2),SVX(2),SV(2),SXY(2),  &
+                          U,V,SPLN0,SPLN1,SPLN2,S0,SH,SP0,SPH,H,D
+       SPLN0(S0,SH,SP0,SPH,H,D) = S0+D*(H*SP0+D*(3.D0*(SH-S0)-            &
+        (SPH+2.D0*SP0)*H+D*(2.D0*(S0-SH)+(SPH+SP0)*H)))
+       SPLN1(S0,SH,SP0,SPH,H,D) = SP0+D*(6.D0*(SH-S0)/H-2.D0*             &
+        (SPH+2.D0*SP0)+3.D0*D*(2.D0*(S0-SH)/H+(SPH+SP0)))
+       SPLN2(S0,SH,SP0,SPH,H,D) = 6.D0*(SH-S0)/H**2-2.D0*                 &
+        (SPH+2.D0*SP0)/H+D*(2.D0*(S0-SH)/H**2+(SPH+SP0)/H)*6.D0
+       LXP1 = LX+1
        HX = X(LXP1)-X(LX)
        HY = Y(LY+1)-Y(LY)
        U = (XL-X(LX))/HX
@@ -2993,32 +3078,98 @@ END FUNCTION RAND_PENELOPE
        PDS(4) = SPLN1(SUX(1),SUX(2),SXY(1),SXY(2),HY,V)
        PDS(5) = SPLN2(SV(1),SV(2),SVX(1),SVX(2),HX,U)
        PDS(6) = SPLN2(SU(1),SU(2),SUY(1),SUY(2),HY,V)
-      !srio IF (IER.GT.0) CALL UERTST(IER,6HDBCEVL)                           
-       IF ((IER.GT.0).AND.(WARNINGDISPLAY.NE.0)) THEN 
-           print *,"              "
-           print *,"Warning: Out of range in math routine dbcevl. "
-           SELECT CASE (iEr)
-             CASE(33)
-               print *,"              IER = 33, XL IS LESS THAN X(1)."
-               print *,"              XL,X(1),X(NX): ",XL,X(1),X(NX)
-             CASE(34)
-               print *,"              IER = 34, YL IS LESS THAN Y(1)."
-               print *,"              YL,Y(1),Y(NY): ",YL,Y(1),Y(NY)
-             CASE(35)
-               print *,"              IER = 35, XL IS GREATER THAN X(NX)."
-               print *,"              XL,X(1),X(NX): ",XL,X(1),X(NX)
-             CASE(36)
-               print *,"              IER = 36, YL IS GREATER THAN Y(NY)."
-               print *,"              YL,Y(1),Y(NY): ",YL,Y(1),Y(NY)
-             CASE DEFAULT
-           END SELECT
-           !print *,"              XL,X(1),X(NX): ",XL,X(1),X(NX)
-           !print *,"              YL,Y(1),Y(NY): ",YL,Y(1),Y(NY)
-           print *,"              "
-        END IF
+       RETURN
+        END SUBROUTINE DBCEVL_CELL
+
+! C+++
+! C	SUBROUTINE	DBCEVL_INDEX
+! C
+! C	PURPOSE		builds the index of the knots X(1:NX) used by
+! C			DBCEVL_BATCH to find the interval of a point without
+! C			searching all of them: the range [X(1),X(NX)] is
+! C			split in NB buckets of the same width, and INDX(B)
+! C			is the first interval [X(L),X(L+1)] ending after
+! C			the start of bucket B.
+! C
+! C---
+        SUBROUTINE DBCEVL_INDEX (X,NX,INDX,NB)
+       INTEGER(kind=ski),intent(in)  :: NX,NB
+       REAL(kind=skr),intent(in)     :: X(NX)
+       INTEGER(kind=ski),intent(out) :: INDX(NB)
+       INTEGER(kind=ski)  :: B,L
+       REAL(kind=skr)     :: H
+
+       H = (X(NX)-X(1))/NB
+       L = 1
+       DO B=1,NB
+          DO WHILE (L.LT.NX-1.AND.X(L+1).LT.X(1)+(B-1)*H)
+             L = L+1
+          END DO
+          INDX(B) = L
+       END DO
+       RETURN
+        END SUBROUTINE DBCEVL_INDEX
 
+!
+! interval LX of XL in X as found by DBCEVL, using the index of DBCEVL_INDEX.
+! IOUT is -1 (XL < X(1)), 1 (XL > X(NX)) or 0.
+!
+        SUBROUTINE DBCEVL_INTERVAL (X,NX,INDX,NB,XL,LX,IOUT)
+       INTEGER(kind=ski)  :: NX,NB,INDX(NB),LX,IOUT,B
+       REAL(kind=skr)     :: X(NX),XL
+
+       IOUT = 0
+       IF (XL.LT.X(1)) THEN
+          IOUT = -1
+          LX = 1
+       ELSE IF (.NOT.(XL.LE.X(NX))) THEN
+          IOUT = 1
+          LX = NX-1
+       ELSE
+          B = min(NB,max(1_ski,int((XL-X(1))/(X(NX)-X(1))*NB,ski)+1))
+          LX = INDX(B)
+          ! exact position, the bucket may be off by rounding
+          DO WHILE (LX.GT.1.AND.XL.LE.X(LX))
+             LX = LX-1
+          END DO
+          DO WHILE (LX.LT.NX-1.AND.XL.GT.X(LX+1))
+             LX = LX+1
+          END DO
+       END IF
        RETURN
-        END SUBROUTINE DBCEVL
+        END SUBROUTINE DBCEVL_INTERVAL
+
+! C+++
+! C	SUBROUTINE	DBCEVL_BATCH
+! C
+! C	PURPOSE		evaluates the bicubic spline C at the N points
+! C			(XL(K),YL(K)), as DBCEVL, with the intervals found
+! C			with the indices XINDX(NXB) and YINDX(NYB) of X and
+! C			Y (see DBCEVL_INDEX).
+! C			PDS(:,K) and IER(K) are the outputs of DBCEVL for
+! C			each point.
+! C
+! C---
+        SUBROUTINE DBCEVL_BATCH (X,NX,Y,NY,C,IC,XINDX,NXB,YINDX,NYB,N,XL,YL,PDS,IER)
+       INTEGER(kind=ski),intent(in)  :: NX,NY,IC,NXB,NYB,N
+       INTEGER(kind=ski),intent(in)  :: XINDX(NXB),YINDX(NYB)
+       REAL(kind=skr),intent(in)     :: X(NX),Y(NY),C(2,IC,*),XL(N),YL(N)
+       REAL(kind=skr),intent(out)    :: PDS(6,N)
+       INTEGER(kind=ski),intent(out) :: IER(N)
+       INTEGER(kind=ski)  :: K,LX,LY,IOUTX,IOUTY
+
+       DO K=1,N
+          CALL DBCEVL_INTERVAL (X,NX,XINDX,NXB,XL(K),LX,IOUTX)
+          CALL DBCEVL_INTERVAL (Y,NY,YINDX,NYB,YL(K),LY,IOUTY)
+          IER(K) = 0
+          IF (IOUTX.LT.0) IER(K) = 33
+          IF (IOUTX.GT.0) IER(K) = 35
+          IF (IOUTY.LT.0) IER(K) = 34
+          IF (IOUTY.GT.0) IER(K) = 36
+          CALL DBCEVL_CELL (X,Y,C,IC,LX,LY,XL(K),YL(K),PDS(1,K))
+       END DO
+       RETURN
+        END SUBROUTINE DBCEVL_BATCH
 ! C>>>PNP2                                                                
 ! C     ..................................................................
 ! C                                                                       
@@ -91,6 +91,7 @@ Subroutine pspect (x1,x2,ierr,ipsflag,fileRoughness)
   integer(kind=ski)                              :: nx,ny
 
   save c1,p1,s1,c2,p2,s2,s0, xoffset,yoffset,nx,ny
+!$omp threadprivate(c1,p1,s1,c2,p2,s2,s0, xoffset,yoffset,nx,ny,iseed)
 
 !C
 !C If IPSFLAG < 0, call from SETSOUR -- reading files etc.
@@ -219,34 +220,34 @@ subroutine spgs_init(infilename, &
 
 
 
-      integer(kind=ski) ::  x,y,izero=0
+      integer(kind=ski) ::  x,y,izero=0,iunit
       real(kind=skr)    ::  xstart,ystart, xstep, ystep
 
-      open(unit=10,file = infilename,status = 'unknown')
-      read(10,*) nx
-      read(10,*) xstart
-      read(10,*) xstep
-      read(10,*) ny
+      open(newunit=iunit,file = infilename,status = 'unknown')
+      read(iunit,*) nx
+      read(iunit,*) xstart
+      read(iunit,*) xstep
+      read(iunit,*) ny
       if ((nx.gt.nMaxRough) .or. (ny.gt.nMaxRough)) then
          print *,'SPGS_INIT: using points in Ppwer Spectral Density: ',nx,ny
          print *,'SPGS_INIT: Maximum number of points :',nMaxRough
          izero = 0
          CALL LEAVE ('SPGS_INIT','Change program inputs.',izero)
       endif
-      read(10,*) ystart
-      read(10,*) ystep
+      read(iunit,*) ystart
+      read(iunit,*) ystep
       xoffset = xstart
       yoffset = ystart
       do y = 1,ny
           do x = 1,nx
             ! reads probability
-            read(10,*) p2(y,x)
+            read(iunit,*) p2(y,x)
             ! computes coordinates
             c1(x) = (x-1) * xstep
             c2(y,x) = (y-1) * ystep 
           end do
       end do
-      close(unit= 10)
+      close(unit=iunit)
 
       ! calculate S, the CDF (cumulated distribution function)
       call accumulate(nx,ny,c1,c2,p1,p2,s0,s1,s2)
@@ -10,8 +10,10 @@ import pip
 import platform
 import setuptools
 import setuptools.command.test
+import shutil
 import subprocess
 import sys
+import tempfile
 
 import numpy
 from numpy.distutils.command.build_clib import build_clib
@@ -33,9 +35,41 @@ class BuildClib(build_clib, object):
             if f in f90:
                 f90.remove(f)
         f90.extend(('-cpp', '-ffree-line-length-none', '-fomit-frame-pointer', '-I' + self.build_clib))
+        if self.__openmp(f90[0]):
+            # -fopenmp makes the kernel state threadprivate (reentrant kernel)
+            f90.append('-fopenmp')
+            for e in self.distribution.ext_modules:
+                if 'gomp' not in e.libraries:
+                    e.libraries.append('gomp')
+        else:
+            self.announce('building shadow3c without OpenMP (single-context kernel)', level=2)
         self.__version_h()
         return super(BuildClib, self).build_libraries(*args, **kwargs)
 
+    def __openmp(self, fc):
+        """Build with OpenMP? SHADOW_OPENMP=0 or 1, else whether fc links an OpenMP program
+
+        Without OpenMP the kernel falls back to one context (see ShadowLib.isReentrant)
+        """
+        v = os.environ.get('SHADOW_OPENMP')
+        if v:
+            return v != '0'
+        d = tempfile.mkdtemp()
+        try:
+            src = os.path.join(d, 'openmp.f90')
+            with open(src, 'w') as f:
+                f.write('program openmp\nuse omp_lib\nprint *, omp_get_max_threads()\nend program openmp\n')
+            with open(os.devnull, 'w') as null:
+                return subprocess.call(
+                    [fc, '-fopenmp', src, '-o', os.path.join(d, 'openmp')],
+                    stdout=null,
+                    stderr=null,
+                ) == 0
+        except OSError:
+            return False
+        finally:
+            shutil.rmtree(d, ignore_errors=True)
+
     def __version_h(self):
         self.mkpath(self.build_clib)
         t = '''{hline}
@@ -111,8 +145,8 @@ pksetup.setup(
                 'fortran/shadow_pre_sync_urgent.f90',
                 'fortran/shadow_preprocessors.f90',
                 'fortran/shadow_postprocessors.f90',
-                'fortran/shadow_bind_f.f90',
                 'fortran/shadow_crl.f90',
+                'fortran/shadow_bind_f.f90',
             ],
             'macros': [('_COMPILE4NIX', 1)],
             'include_dirs': ['def', 'fortran', 'c'],
@@ -129,6 +163,7 @@ pksetup.setup(
             name='Shadow.ShadowLib',
             sources=['c/shadow_bind_python.c'],
             include_dirs=['c', 'def', numpy.get_include()],
+            # BuildClib adds gomp when the kernel is built with OpenMP
             libraries=['shadow3c', 'gfortran'],
         ),
     ],
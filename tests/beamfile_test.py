@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""Beam files read with numpy (Shadow.beamfile)
+
+:copyright: Copyright (c) 2015 RadiaSoft LLC.  All Rights Reserved.
+:license: http://www.apache.org/licenses/LICENSE-2.0.html
+"""
+from __future__ import absolute_import, division, print_function
+
+import pytest
+
+def test_load_mmap(tmpdir):
+    import numpy
+    import Shadow
+
+    src = Shadow.Source()
+    src.NPOINT = 1000
+    beam = Shadow.Beam()
+    beam.genSource(src)
+    star = str(tmpdir.join('begin.dat'))
+    beam.write(star)
+
+    expect = Shadow.Beam()
+    expect.load(star)
+    mapped = Shadow.Beam()
+    mapped.load(star, mmap=True)
+    assert isinstance(mapped.rays, numpy.memmap)
+    assert not mapped.rays.flags.writeable
+    assert numpy.array_equal(expect.rays, mapped.rays)
+    assert expect.intensity(nolost=1) == mapped.intensity(nolost=1)
+    cow = Shadow.Beam()
+    cow.load(star, mmap='c')
+    cow.rays[:, 0] = 0.0
+    assert numpy.array_equal(expect.rays, Shadow.beamfile.memmap(star)), \
+        'The file must not change'
+
+    oe = Shadow.OE()
+    oe.FWRITE = 3
+    expect.traceOE(oe.duplicate(), 1)
+    mapped.traceOE(oe.duplicate(), 1)
+    assert not isinstance(mapped.rays, numpy.memmap)
+    assert numpy.array_equal(expect.rays, mapped.rays)
+    mapped.load(star, mmap=True)
+    oe.duplicate().trace(mapped, 1)
+    assert numpy.array_equal(expect.rays, mapped.rays)
+    mapped.load(star, mmap=True)
+    mapped.retrace(10.0)
+    expect.load(star)
+    expect.retrace(10.0)
+    assert numpy.array_equal(expect.rays, mapped.rays)
+    assert numpy.array_equal(beam.rays, Shadow.beamfile.memmap(star)), \
+        'The file must not change'
+    with open(str(tmpdir.join('bad.dat')), 'w') as f:
+        f.write('not a beam')
+    with pytest.raises(ValueError):
+        Shadow.beamfile.header(str(tmpdir.join('bad.dat')))
+
+
+def test_load_mmap_ncol(tmpdir, capsys):
+    import numpy
+    import Shadow
+
+    src = Shadow.Source()
+    src.NPOINT = 100
+    beam = Shadow.Beam()
+    beam.genSource(src)
+    star = str(tmpdir.join('begin.dat'))
+    Shadow.beamfile.write(star, beam.rays, ncol=12)
+    capsys.readouterr()
+    mapped = Shadow.Beam()
+    mapped.load(star, mmap=True)
+    assert capsys.readouterr().out == '', 'Files with 12 columns must be read silently'
+    assert not isinstance(mapped.rays, numpy.memmap)
+    assert numpy.array_equal(mapped.rays[:, :12], beam.rays[:, :12])
+
+
+def test_read_columns(tmpdir):
+    import numpy
+    import Shadow
+
+    src = Shadow.Source()
+    src.NPOINT = 1000
+    beam = Shadow.Beam()
+    beam.genSource(src)
+    oe = Shadow.OE()
+    oe.FMIRR = 5
+    oe.FHIT_C = 1
+    oe.RWIDX1 = oe.RWIDX2 = 0.001
+    oe.RLEN1 = oe.RLEN2 = 1000.0
+    oe.FWRITE = 3
+    beam.traceOE(oe, 1)
+    star = str(tmpdir.join('star.01'))
+    beam.write(star)
+
+    assert 0 < beam.nrays(nolost=1) < 1000
+    x, z, flag, w = Shadow.read_columns(star, (1, 3, 10, 23), nolost=1)
+    assert numpy.array_equal(x, beam.getshonecol(1, nolost=1))
+    assert numpy.array_equal(w, beam.getshonecol(23, nolost=1))
+    assert (flag > 0).all()
+    assert not isinstance(x, numpy.memmap)
+    x = Shadow.read_columns(star, 1, start=100, stop=300)
+    assert numpy.array_equal(x, beam.rays[100:300, 0])
+
+
+def test_read_write(tmpdir):
+    from concurrent.futures import ThreadPoolExecutor
+    import numpy
+    import Shadow
+
+    src = Shadow.Source()
+    src.NPOINT = 3000
+    beam = Shadow.Beam()
+    beam.genSource(src)
+    fortran = str(tmpdir.join('fortran.dat'))
+    Shadow.ShadowLib.Beam.write(beam, fortran)
+    star = str(tmpdir.join('begin.dat'))
+    beam.write(star)
+    with open(fortran, 'rb') as f, open(star, 'rb') as g:
+        assert f.read() == g.read(), 'The file must be the one written by the kernel'
+    expect = Shadow.ShadowLib.Beam()
+    expect.load(fortran)
+    assert numpy.array_equal(expect.rays, Shadow.beamfile.read(star))
+    assert numpy.array_equal(expect.rays[10:20], Shadow.beamfile.read(star, 10, 20))
+
+    Shadow.beamfile.write(star, beam.rays, ncol=12)
+    rays = Shadow.beamfile.read(star)
+    assert numpy.array_equal(rays[:, :12], beam.rays[:, :12]) and not rays[:, 12:].any()
+    Shadow.beamfile.write(star, beam.rays, version=1)
+    h = Shadow.beamfile.header(star)
+    assert h['version'] == 1 and h['npoint'] == 3000
+    assert numpy.array_equal(beam.rays, Shadow.beamfile.read(star))
+    assert numpy.array_equal(beam.rays[:, [0, 2, 9]],
+                             numpy.array(Shadow.read_columns(star, (1, 3, 10))).T)
+    loaded = Shadow.Beam()
+    loaded.load(star)
+    assert numpy.array_equal(beam.rays, loaded.rays)
+    with pytest.raises(ValueError):
+        Shadow.ShadowLib.Beam().load(star)
+
+    def round_trip(i):
+        file = str(tmpdir.join('star.%02d' % i))
+        rays = beam.rays * (i + 1)
+        Shadow.beamfile.write(file, rays)
+        return numpy.array_equal(rays, Shadow.beamfile.read(file))
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        assert all(executor.map(round_trip, range(8))), \
+            'Threads must read and write their own files'
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""Tracing only the good rays through a compound oe
+
+:copyright: Copyright (c) 2015 RadiaSoft LLC.  All Rights Reserved.
+:license: http://www.apache.org/licenses/LICENSE-2.0.html
+"""
+from __future__ import absolute_import, division, print_function
+
+import pytest
+
+def test_compact():
+    import numpy
+    import Shadow
+
+    src = Shadow.Source()
+    src.NPOINT = 5000
+    source = Shadow.Beam()
+    source.genSource(src)
+
+    def system(aperture=0.0005):
+        slit = Shadow.OE()
+        slit.set_empty(T_SOURCE=100.0)
+        size = numpy.zeros(10)
+        size[0] = aperture
+        flags = numpy.zeros(10)
+        flags[0] = 1
+        slit.set_screens(i_screen=flags, i_slit=flags, rx_slit=size, rz_slit=size)
+        oes = [slit]
+        for fmirr in (1, 3, 5):
+            oe = Shadow.OE()
+            oe.FMIRR = fmirr
+            oe.T_INCIDENCE = oe.T_REFLECTION = 88.0
+            oe.T_SOURCE = oe.T_IMAGE = 100.0
+            oes.append(oe)
+        for oe in oes:
+            oe.FWRITE = 3
+        return Shadow.CompoundOE(oes)
+
+    expect = source.duplicate()
+    expect.traceCompoundOE(system(), verbose=0)
+    good = expect.rays[:, 9] >= 0
+    assert 0 < good.sum() < 5000
+    beam = source.duplicate()
+    result = beam.traceCompoundOE(system(), verbose=0, compact=1)
+    assert list(result['traced']) == [5000] + [good.sum()] * 3
+    assert result['full'] == 4 * 5000
+    assert numpy.array_equal(beam.rays[:, 9] >= 0, good)
+    assert numpy.array_equal(beam.rays[good], expect.rays[good]), \
+        'Good rays must not depend on the compaction'
+    lost = expect.rays[:, 9] < 0
+    assert numpy.array_equal(beam.rays[lost, 9], expect.rays[lost, 9])
+
+    kept = source.duplicate()
+    result = kept.traceCompoundOE(system(), verbose=0, compact=2)
+    assert numpy.array_equal(kept.rays, expect.rays[good])
+    assert numpy.array_equal(result['index'], numpy.where(good)[0])
+    kept.uncompact()
+    assert numpy.array_equal(kept.rays, beam.rays), \
+        'uncompact must rebuild the full-size beam'
+
+    closed = source.duplicate()
+    result = closed.traceCompoundOE(system(1e-12), verbose=0, compact=2)
+    assert list(result['traced']) == [5000, 0, 0, 0]
+    assert closed.rays.shape == (5000, 18), 'With no good rays, the full-size beam is returned'
+    assert (closed.rays[:, 9] < 0).all()
+
+
+def test_skip_lost(monkeypatch):
+    import numpy
+    import Shadow
+    import Shadow.ShadowLib
+
+    src = Shadow.Source()
+    src.NPOINT = 5000
+    source = Shadow.Beam()
+    source.genSource(src)
+
+    def run():
+        slit = Shadow.OE()
+        slit.set_empty(T_SOURCE=100.0)
+        size = numpy.zeros(10)
+        size[0] = 0.0005
+        flags = numpy.zeros(10)
+        flags[0] = 1
+        slit.set_screens(i_screen=flags, i_slit=flags, rx_slit=size, rz_slit=size)
+        mirror = Shadow.OE()
+        mirror.FMIRR = 3
+        mirror.T_INCIDENCE = mirror.T_REFLECTION = 88.0
+        mirror.T_SOURCE = mirror.T_IMAGE = 100.0
+        beam = source.duplicate()
+        Shadow.ShadowLib.skippedRays()
+        for i, oe in enumerate((slit, mirror)):
+            oe.FWRITE = 3
+            beam.traceOE(oe, i + 1)
+        return beam.rays, Shadow.ShadowLib.skippedRays()
+
+    monkeypatch.delenv('SHADOW_SKIP_LOST', raising=False)
+    expect, skipped = run()
+    assert skipped == 0
+    good = expect[:, 9] >= 0
+    monkeypatch.setenv('SHADOW_SKIP_LOST', '1')
+    rays, skipped = run()
+    assert numpy.array_equal(rays[:, 9] >= 0, good)
+    assert numpy.array_equal(rays[good], expect[good]), \
+        'Skipping the lost rays must not change the good ones'
+    # lost by the slit, skipped by the image of the slit and by the mirror and its image
+    assert skipped == 3 * (5000 - good.sum())
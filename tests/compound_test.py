@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""Tracing a CompoundOE
+
+:copyright: Copyright (c) 2015 RadiaSoft LLC.  All Rights Reserved.
+:license: http://www.apache.org/licenses/LICENSE-2.0.html
+"""
+from __future__ import absolute_import, division, print_function
+
+import pytest
+
+def test_chunks():
+    import numpy
+    import Shadow
+
+    src = Shadow.Source()
+    src.NPOINT = 5000
+    source = Shadow.Beam()
+    source.genSource(src)
+
+    def compound():
+        coe = Shadow.CompoundOE()
+        for t_image in (1000.0, 500.0):
+            oe = Shadow.OE()
+            oe.FWRITE = 3
+            oe.T_IMAGE = t_image
+            coe.append(oe)
+        return coe
+
+    expect = source.duplicate()
+    expect.traceCompoundOE(compound())
+    got = source.duplicate()
+    coe = compound()
+    got.traceCompoundOE(coe, workers=2, chunk_size=1200)
+    assert numpy.array_equal(expect.rays, got.rays), \
+        'Chunked trace must match sequential trace'
+    assert coe.list[1].FWRITE == 3
+    empty = Shadow.Beam()
+    empty.rays = numpy.zeros((0, 18))
+    empty.traceCompoundOE(compound(), workers=2, chunk_size=1200)
+    assert empty.rays.shape == (0, 18)
+    with pytest.raises(ValueError):
+        source.duplicate().traceCompoundOE(compound(), write_star_files=1, workers=2)
+
+
+def test_single_call():
+    import numpy
+    import Shadow
+
+    src = Shadow.Source()
+    src.NPOINT = 2000
+    source = Shadow.Beam()
+    source.genSource(src)
+
+    def compound():
+        coe = Shadow.CompoundOE()
+        coe.append_crl(p0=1000.0, q0=500.0, nlenses=5, refraction_index=1.0 - 1e-6)
+        return coe
+
+    expect = source.duplicate()
+    coe_expect = compound()
+    for i, oe in enumerate(coe_expect.list):
+        expect.traceOE(oe, i + 1)
+    got = source.duplicate()
+    coe = compound()
+    got.traceCompoundOE(coe, verbose=0)
+    assert numpy.array_equal(expect.rays, got.rays), \
+        'Single call trace must match the traceOE loop'
+    assert coe.list[-1].T_IMAGE == coe_expect.list[-1].T_IMAGE
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""Beams stored in single precision
+
+:copyright: Copyright (c) 2015 RadiaSoft LLC.  All Rights Reserved.
+:license: http://www.apache.org/licenses/LICENSE-2.0.html
+"""
+from __future__ import absolute_import, division, print_function
+
+import pytest
+
+def test_float32(tmpdir, monkeypatch):
+    import numpy
+    import Shadow
+    import Shadow.ShadowLibExtensions
+
+    monkeypatch.setattr(Shadow.ShadowLibExtensions, 'TRACE_CHUNK_SIZE', 3000)
+    src = Shadow.Source()
+    src.NPOINT = 10000
+    source = Shadow.Beam()
+    source.genSource(src)
+
+    def system():
+        oes = []
+        for fmirr in (3, 1):
+            oe = Shadow.OE()
+            oe.FMIRR = fmirr
+            oe.T_INCIDENCE = oe.T_REFLECTION = 88.0
+            oe.T_SOURCE = oe.T_IMAGE = 100.0
+            oe.FHIT_C = 1
+            oe.RWIDX1 = oe.RWIDX2 = 0.001
+            oe.RLEN1 = oe.RLEN2 = 5.0
+            oe.FWRITE = 3
+            oes.append(oe)
+        return Shadow.CompoundOE(oes)
+
+    expect = source.duplicate()
+    expect.traceCompoundOE(system(), verbose=0)
+    good = expect.rays[:, 9] >= 0
+    assert 0 < good.sum() < 10000
+    beam = source.duplicate().set_dtype(numpy.float32)
+    assert beam.rays.dtype == numpy.float32
+    beam.traceCompoundOE(system(), verbose=0)
+    assert beam.rays.dtype == numpy.float32
+    assert numpy.array_equal(beam.rays[:, 9] >= 0, good)
+    assert numpy.allclose(beam.rays[good, :6], expect.rays[good, :6], rtol=1e-5, atol=1e-7), \
+        'float32 rays must match the float64 ones to single precision'
+    assert numpy.isclose(beam.intensity(nolost=1), expect.intensity(nolost=1), rtol=1e-5)
+    fwhm = beam.histo1(1, nbins=51, nolost=1)['fwhm']
+    assert numpy.isclose(fwhm, expect.histo1(1, nbins=51, nolost=1)['fwhm'], rtol=1e-3)
+
+    beam.write(str(tmpdir.join('star.02')))
+    loaded = Shadow.Beam()
+    loaded.load(str(tmpdir.join('star.02')))
+    assert numpy.array_equal(loaded.rays, beam.rays.astype(numpy.float64))
+    with pytest.raises(TypeError):
+        Shadow.ShadowLib.Beam.traceOE(beam, system().list[0], 1)
+    with pytest.raises(TypeError):
+        system().list[0].trace(beam, 1)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""Faceted mirrors computing each facet once
+
+:copyright: Copyright (c) 2015 RadiaSoft LLC.  All Rights Reserved.
+:license: http://www.apache.org/licenses/LICENSE-2.0.html
+"""
+from __future__ import absolute_import, division, print_function
+
+import pytest
+
+def test_facet_reference(tmpdir, monkeypatch):
+    import numpy
+    import Shadow
+
+    poly = str(tmpdir.join('facet.pol'))
+    with open(poly, 'w') as f:
+        f.write('2\n0 0 1 1.0\n2 0 0 -0.01\n0 2 0 -0.01\n-1 -1 -1 0.0\n')
+    src = Shadow.Source()
+    src.NPOINT = 5000
+    src.FDISTR = 1
+    src.HDIV1 = src.HDIV2 = 0.002
+    source = Shadow.Beam()
+    source.genSource(src)
+
+    def run():
+        beam = source.duplicate()
+        oe = Shadow.OE()
+        oe.FMIRR = 1
+        oe.T_INCIDENCE = oe.T_REFLECTION = 80.0
+        oe.F_FACET = 1
+        oe.FILE_FAC = poly.encode()
+        oe.RFAC_LENX = 0.5
+        oe.RFAC_LENY = 2.0
+        oe.FWRITE = 3
+        beam.traceOE(oe, 1)
+        return beam.rays
+
+    monkeypatch.setenv('SHADOW_FACET_REFERENCE', '1')
+    expect = run()
+    monkeypatch.delenv('SHADOW_FACET_REFERENCE')
+    got = run()
+    assert numpy.array_equal(expect, got), \
+        'Cached facet frames must match the computation per ray'
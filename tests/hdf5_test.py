@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""Beams in HDF5 files with Shadow.beamhdf5
+
+:copyright: Copyright (c) 2015 RadiaSoft LLC.  All Rights Reserved.
+:license: http://www.apache.org/licenses/LICENSE-2.0.html
+"""
+from __future__ import absolute_import, division, print_function
+
+import pytest
+
+def test_hdf5(tmpdir):
+    pytest.importorskip('h5py')
+    import numpy
+    import Shadow
+    import Shadow.beamhdf5
+
+    src = Shadow.Source()
+    src.NPOINT = 5000
+    oe = Shadow.OE()
+    oe.FMIRR = 5
+    oe.FHIT_C = 1
+    oe.RWIDX1 = oe.RWIDX2 = 0.001
+    oe.RLEN1 = oe.RLEN2 = 1000.0
+    oe.T_IMAGE = 500.0
+    file = str(tmpdir.join('star.h5'))
+    with Shadow.beamhdf5.Writer(file, source=src, oes=[oe], chunk_rays=1000) as writer:
+        got = Shadow.stream(src, [oe], chunk_rays=1200, accumulators=[writer], seed=12345)
+    expect = Shadow.parallel.run(src, [oe], workers=1, chunk_size=1200, seed=12345)['beam']
+
+    beam = Shadow.Beam()
+    beam.load_hdf5(file)
+    assert numpy.array_equal(expect.rays, beam.rays)
+    beam.load_hdf5(file, workers=2)
+    assert numpy.array_equal(expect.rays, beam.rays), \
+        'Parallel reads must match'
+    beam.load_hdf5(file, start=1100, stop=2500)
+    assert numpy.array_equal(expect.rays[1100:2500], beam.rays)
+
+    meta = Shadow.beamhdf5.metadata(file)
+    assert meta['npoint'] == 5000
+    assert meta['source'].NPOINT == 5000
+    assert meta['oes'][0].RWIDX1 == 0.001 and meta['oes'][0].FILE_REFL == oe.FILE_REFL
+    assert list(meta['chunks']['nrays']) == [1200, 1200, 1200, 1200, 200]
+    assert meta['statistics']['lost'] == got['results'][0]['lost'] == expect.nrays(nolost=2)
+
+    other = str(tmpdir.join('beam.h5'))
+    expect.write_hdf5(other, compression='lzf')
+    beam.load_hdf5(other)
+    assert numpy.array_equal(expect.rays, beam.rays)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""Distributed tracing with Shadow.parallel
+
+:copyright: Copyright (c) 2015 RadiaSoft LLC.  All Rights Reserved.
+:license: http://www.apache.org/licenses/LICENSE-2.0.html
+"""
+from __future__ import absolute_import, division, print_function
+
+import pytest
+
+def test_run():
+    import threading
+    import numpy
+    import Shadow
+    import Shadow.parallel
+
+    src = Shadow.Source()
+    src.NPOINT = 5000
+    oes = []
+    for t_image in (1000.0, 500.0):
+        oe = Shadow.OE()
+        oe.T_IMAGE = t_image
+        oes.append(oe)
+
+    expect = Shadow.parallel.run(src, oes, workers=1, chunk_size=1200, seed=12345)
+    got = Shadow.parallel.run(src, oes, workers=2, chunk_size=1200, seed=12345)
+    assert numpy.array_equal(expect['beam'].rays, got['beam'].rays), \
+        'Result must not depend on the number of workers'
+    assert got['beam'].rays.shape[0] == 5000
+    assert oes[0].FWRITE == 0, 'The oes must not be modified'
+    stats = got['statistics'][1]
+    beam = got['beam']
+    assert stats['nrays'] == 5000
+    assert stats['good'] == beam.nrays(nolost=1)
+    assert numpy.isclose(stats['intensity'], beam.intensity(nolost=1))
+    assert numpy.isclose(stats['mean'][1], beam.getshonecol(1, nolost=1).mean())
+    assert numpy.isclose(stats['std'][3], beam.getshonecol(3, nolost=1).std())
+
+    server = Shadow.parallel.WorkerServer(('localhost', 0), workers=1)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        with pytest.raises(ValueError):
+            Shadow.parallel.run(src, oes, remote=[server.address])
+        got = Shadow.parallel.run(src, oes, chunk_size=1200, seed=12345,
+                                  remote=[server.address, server.address],
+                                  authkey=server.authkey)
+    finally:
+        server.close()
+        thread.join()
+    assert numpy.array_equal(expect['beam'].rays, got['beam'].rays), \
+        'Remote workers must match local workers'
+
+
+def test_run_empty():
+    import numpy
+    import Shadow
+    import Shadow.parallel
+
+    src = Shadow.Source()
+    src.NPOINT = 0
+    oe = Shadow.OE()
+    got = Shadow.parallel.run(src, [oe], workers=1, seed=12345)
+    assert got['beam'].rays.shape == (0, 18)
+    assert got['oe_list'].number_oe() == 1
+    assert got['statistics'][0]['nrays'] == 0
+    src.NPOINT = 1000
+    oe.FMIRR = 5
+    oe.FHIT_C = 1
+    oe.RWIDX1 = oe.RWIDX2 = oe.RLEN1 = oe.RLEN2 = 1e-9
+    got = Shadow.parallel.run(src, [oe], workers=1, chunk_size=300, seed=12345)
+    stats = got['statistics'][0]
+    assert got['beam'].rays.shape == (1000, 18)
+    assert stats['good'] == 0 and stats['lost'] == 1000
+    assert stats['std'][1] == 0.0
+
+
+def test_statistics():
+    import numpy
+    import Shadow
+    import Shadow.parallel
+    import Shadow.streaming
+
+    # values far from zero, with a small spread: the sums of the squares lose it all
+    rays = numpy.zeros((3000, 18))
+    rays[:, 0] = 1e8 + numpy.random.RandomState(1).normal(0.0, 1e-3, 3000)
+    rays[:, 9] = 1.0
+    rays[:, 6] = 1.0
+    sums = []
+    m = Shadow.streaming.Moments((1,), nolost=1)
+    for i in range(0, 3000, 700):
+        beam = Shadow.Beam()
+        beam.rays = rays[i:i + 700].copy()
+        sums.append(Shadow.parallel._chunkSums(beam))
+        m.add(beam)
+    stats = Shadow.parallel.statistics(sums)
+    assert numpy.isclose(stats['mean'][1], rays[:, 0].mean(), rtol=1e-15)
+    assert numpy.isclose(stats['std'][1], rays[:, 0].std(), rtol=1e-6)
+    assert numpy.isclose(m.result()['std'][1], rays[:, 0].std(), rtol=1e-6)
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""Tracing many beams through a prepared OE
+
+:copyright: Copyright (c) 2015 RadiaSoft LLC.  All Rights Reserved.
+:license: http://www.apache.org/licenses/LICENSE-2.0.html
+"""
+from __future__ import absolute_import, division, print_function
+
+import pytest
+
+def test_prepare():
+    import numpy
+    import Shadow
+
+    src = Shadow.Source()
+    src.NPOINT = 2000
+    source = Shadow.Beam()
+    source.genSource(src)
+
+    def new_oe():
+        oe = Shadow.OE()
+        oe.FMIRR = 1
+        oe.T_INCIDENCE = oe.T_REFLECTION = 88.0
+        oe.FWRITE = 3
+        return oe
+
+    def run(oe):
+        beam = source.duplicate()
+        beam.traceOE(oe, 1)
+        return beam.rays
+
+    expect = run(new_oe())
+    oe = new_oe().prepare()
+    assert oe.prepared
+    for i in range(3):
+        assert numpy.array_equal(expect, run(oe)), \
+            'Prepared trace must match the trace of a new oe'
+    # the oe keeps the values after the trace, as an unprepared one
+    other = new_oe()
+    run(other)
+    oe.T_IMAGE = other.T_IMAGE = 500.0
+    assert numpy.array_equal(run(other), run(oe)), \
+        'Changing the oe must invalidate the prepared setup'
+    assert not oe.prepare(0).prepared
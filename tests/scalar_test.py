@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""Tracing scalar beams (NCOL=12, SHADOW_SCALAR_BEAM=1)
+
+:copyright: Copyright (c) 2015 RadiaSoft LLC.  All Rights Reserved.
+:license: http://www.apache.org/licenses/LICENSE-2.0.html
+"""
+from __future__ import absolute_import, division, print_function
+
+import pytest
+
+def test_scalar(monkeypatch):
+    import numpy
+    import Shadow
+
+    src = Shadow.Source()
+    src.NPOINT = 3000
+    src.F_POLAR = 1
+    src.POL_DEG = 0.7
+    source = Shadow.Beam()
+    source.genSource(src)
+    assert numpy.abs(source.rays[:, 15:18]).max() > 0
+
+    def run(ncol):
+        beam = source.duplicate()
+        for i, fmirr in enumerate((1, 3, 5)):
+            oe = Shadow.OE()
+            oe.FMIRR = fmirr
+            oe.T_INCIDENCE = oe.T_REFLECTION = 88.0
+            oe.T_SOURCE = oe.T_IMAGE = 100.0
+            oe.NCOL = ncol
+            oe.FWRITE = 3
+            beam.traceOE(oe, i + 1)
+        return beam
+
+    expect = run(18)
+    assert numpy.array_equal(run(12).rays, expect.rays), \
+        'NCOL=12 of existing start files must not change the trace'
+    monkeypatch.setenv('SHADOW_SCALAR_BEAM', '1')
+    beam = run(12)
+    monkeypatch.delenv('SHADOW_SCALAR_BEAM')
+    assert numpy.array_equal(beam.rays[:, :6], expect.rays[:, :6])
+    assert numpy.array_equal(beam.rays[:, 9:12], expect.rays[:, 9:12])
+    assert numpy.array_equal(beam.rays[:, 12:15], source.rays[:, 12:15]), \
+        'Phases must not be traced'
+    assert not beam.rays[:, 15:18].any(), 'Ap must be carried by As'
+    assert numpy.allclose(beam.getshonecol(23), expect.getshonecol(23), rtol=1e-12)
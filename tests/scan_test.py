@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""Tracing a beam through variants of an OE with OE.scan
+
+:copyright: Copyright (c) 2015 RadiaSoft LLC.  All Rights Reserved.
+:license: http://www.apache.org/licenses/LICENSE-2.0.html
+"""
+from __future__ import absolute_import, division, print_function
+
+import pytest
+
+def test_scan():
+    import numpy
+    import Shadow
+
+    src = Shadow.Source()
+    src.NPOINT = 5000
+    source = Shadow.Beam()
+    source.genSource(src)
+    rays = source.rays.copy()
+    oe = Shadow.OE()
+    oe.FMIRR = 1
+    oe.T_INCIDENCE = oe.T_REFLECTION = 88.0
+    oe.F_MOVE = 1
+    x_rot = numpy.linspace(-0.05, 0.05, 5)
+
+    table = oe.scan(source, {'X_ROT': x_rot, 'T_IMAGE': [500.0, 1000.0]},
+                    stats=['good', 'intensity', 'fwhm', 'centroid', 'std'], workers=2)
+    assert numpy.array_equal(source.rays, rays), 'The beam must not be modified'
+    assert oe.X_ROT == 0.0 and oe.FWRITE == 0, 'The oe must not be modified'
+    assert table['X_ROT'].shape == (10,)
+    assert table['fwhm'].shape == (10, 2)
+    for i in (0, 7):
+        variant = oe.duplicate()
+        variant.X_ROT = table['X_ROT'][i]
+        variant.T_IMAGE = table['T_IMAGE'][i]
+        variant.FWRITE = 3
+        beam = source.duplicate()
+        beam.traceOE(variant, 1)
+        assert table['good'][i] == beam.nrays(nolost=1)
+        assert numpy.isclose(table['intensity'][i], beam.intensity(nolost=1))
+        z = beam.getshonecol(3, nolost=1)
+        w = beam.getshonecol(23, nolost=1)
+        assert numpy.isclose(table['centroid'][i][1], numpy.average(z, weights=w))
+        assert numpy.isclose(table['fwhm'][i][0],
+                             beam.histo1(1, nbins=200, nolost=1, ref=23)['fwhm'])
+    assert not numpy.allclose(table['centroid'][:, 1], table['centroid'][0, 1])
+    with pytest.raises(ValueError):
+        oe.scan(source, {'X_ROT': x_rot}, stats=['median'])
+
+
+def test_scan_seed():
+    import numpy
+    import Shadow
+
+    # 5 random gaussian ripples (at most 10): their positions, amplitudes and widths come from
+    # the random stream
+    with open('scan_ripple.dat', 'w') as f:
+        f.write('5\n1\n12345\n' + '1.0e-3\n0.1\n0.5\n1.0\n5.0\n' * 5)
+    src = Shadow.Source()
+    src.NPOINT = 2000
+    src.ISTAR1 = 5676561
+    source = Shadow.Beam()
+    source.genSource(src)
+    oe = Shadow.OE()
+    oe.FMIRR = 1
+    oe.T_INCIDENCE = oe.T_REFLECTION = 88.0
+    oe.F_RIPPLE = 1
+    oe.F_G_S = 1
+    oe.FILE_RIP = b'scan_ripple.dat'
+    oe.F_MOVE = 1
+    variants = {'X_ROT': numpy.linspace(-0.01, 0.01, 6)}
+
+    serial = oe.scan(source, variants, stats=['centroid', 'std'], workers=1, seed=12345)
+    threads = oe.scan(source, variants, stats=['centroid', 'std'], workers=3, seed=12345)
+    for stat in ('centroid', 'std'):
+        assert numpy.array_equal(serial[stat], threads[stat]), \
+            'The result with a seed must not depend on the workers'
+    other = oe.scan(source, variants, stats=['std'], workers=3, seed=54321)
+    assert not numpy.array_equal(serial['std'], other['std'])
+    variant = oe.duplicate()
+    variant.X_ROT = serial['X_ROT'][4]
+    variant.FWRITE = 3
+    beam = source.duplicate()
+    beam.traceOE(variant, 1, 12345, 1, 4)
+    z = beam.getshonecol(3, nolost=1)
+    w = beam.getshonecol(23, nolost=1)
+    assert serial['centroid'][4][1] == numpy.average(z, weights=w)
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""Source generation
+
+:copyright: Copyright (c) 2015 RadiaSoft LLC.  All Rights Reserved.
+:license: http://www.apache.org/licenses/LICENSE-2.0.html
+"""
+from __future__ import absolute_import, division, print_function
+
+import pytest
+
+def test_chunks():
+    import numpy
+    import Shadow
+
+    src = Shadow.Source()
+    src.NPOINT = 5000
+    src.ISTAR1 = 5676561
+
+    def gen(**kwargs):
+        beam = Shadow.Beam()
+        beam.genSource(src, **kwargs)
+        return beam.rays
+
+    expect = gen(chunk_size=1200)
+    assert expect.shape == (5000, 18)
+    assert numpy.array_equal(expect[:, 11], numpy.arange(1, 5001))
+    assert not numpy.array_equal(expect[:1200, 0], expect[1200:2400, 0])
+    assert numpy.array_equal(expect, gen(chunk_size=1200, workers=3))
+    lazy = numpy.concatenate([b.rays for b in src.genBeamChunks(1200)])
+    assert numpy.array_equal(expect, lazy)
+
+
+def test_streams():
+    import numpy
+    import Shadow
+
+    src = Shadow.Source()
+    src.NPOINT = 3000
+
+    def gen(*args):
+        beam = Shadow.Beam()
+        beam.genSource(src, *args)
+        return beam.rays
+
+    a = gen(1234, 2, 1)
+    assert numpy.array_equal(a, gen(1234, 2, 1)), \
+        'Same seed, stream and substream must give the same rays'
+    assert not numpy.array_equal(a[:, 0], gen(1234, 2, 0)[:, 0])
+    assert not numpy.array_equal(a[:, 0], gen(1234, 3, 1)[:, 0])
+    chunks = list(src.genBeamChunks(1000, seed=1234, stream=2))
+    src.NPOINT = 1000
+    assert numpy.array_equal(chunks[1].rays[:, :11], gen(1234, 2, 1)[:, :11]), \
+        'Chunk i must be substream i'
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""Bounded-memory tracing with Shadow.stream
+
+:copyright: Copyright (c) 2015 RadiaSoft LLC.  All Rights Reserved.
+:license: http://www.apache.org/licenses/LICENSE-2.0.html
+"""
+from __future__ import absolute_import, division, print_function
+
+import pytest
+
+def test_stream():
+    import numpy
+    import Shadow
+
+    src = Shadow.Source()
+    src.NPOINT = 5000
+    oes = []
+    for t_image in (1000.0, 500.0):
+        oe = Shadow.OE()
+        oe.T_IMAGE = t_image
+        oe.FMIRR = 5
+        oe.FHIT_C = 1
+        oe.RWIDX1 = oe.RWIDX2 = 0.001
+        oe.RLEN1 = oe.RLEN2 = 1000.0
+        oes.append(oe)
+
+    h1 = Shadow.streaming.Histo1(1, [-0.002, 0.002], nbins=40, nolost=1, ref=23)
+    h2 = Shadow.streaming.Histo2(1, 3, [-0.002, 0.002], [-0.02, 0.02], nbins=20, nolost=1)
+    m = Shadow.streaming.Moments((1, 3), nolost=1, ref=23)
+    got = Shadow.stream(src, oes, chunk_rays=1200, accumulators=[h1, h2, m], seed=12345, workers=2)
+    expect = Shadow.parallel.run(src, oes, workers=1, chunk_size=1200, seed=12345)
+    assert oes[0].FWRITE == 0, 'The oes must not be modified'
+    beam = expect['beam']
+    assert 0 < beam.nrays(nolost=1) < 5000
+    for i, stats in enumerate(expect['statistics']):
+        assert got['statistics'][i]['lost'] == stats['lost']
+        assert numpy.isclose(got['statistics'][i]['intensity'], stats['intensity'])
+    h = beam.histo1(1, xrange=[-0.002, 0.002], nbins=40, nolost=1, ref=23)
+    assert numpy.allclose(got['results'][0]['histogram'], h['histogram'])
+    assert numpy.allclose(got['results'][0]['histogram_sigma'], h['histogram_sigma'])
+    assert got['results'][0]['fwhm'] == h['fwhm']
+    h = beam.histo2(1, 3, xrange=[-0.002, 0.002], yrange=[-0.02, 0.02], nbins=20, nolost=1)
+    assert numpy.allclose(got['results'][1]['histogram'], h['histogram'])
+    x = beam.getshonecol(1, nolost=1)
+    w = beam.getshonecol(23, nolost=1)
+    assert numpy.isclose(got['results'][2]['mean'][1], numpy.average(x, weights=w))
+    assert numpy.isclose(got['results'][2]['std'][1],
+                         beam.get_standard_deviation(1, nolost=1, ref=1))
+    assert got['results'][2]['max'][1] == x.max()
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""Reflectivity tables read once per process
+
+:copyright: Copyright (c) 2015 RadiaSoft LLC.  All Rights Reserved.
+:license: http://www.apache.org/licenses/LICENSE-2.0.html
+"""
+from __future__ import absolute_import, division, print_function
+
+import pytest
+
+def test_load_tables(tmpdir):
+    import os
+    import numpy
+    import Shadow
+
+    def write_prerefl(alfa, gamma):
+        # ascii prerefl file with constant optical constants
+        nrefl = 100
+        with open(str(tmpdir.join('prerefl.dat')), 'w') as f:
+            f.write('1e6 1e9 %g 0\n%d\n' % ((1e9 - 1e6) / (nrefl - 1), nrefl))
+            f.write(' '.join([repr(alfa)] * nrefl) + '\n')
+            f.write(' '.join([repr(gamma)] * nrefl) + '\n')
+
+    src = Shadow.Source()
+    src.NPOINT = 1000
+    source = Shadow.Beam()
+    source.genSource(src)
+
+    def run():
+        beam = source.duplicate()
+        oe = Shadow.OE()
+        oe.FMIRR = 5
+        oe.T_INCIDENCE = oe.T_REFLECTION = 89.5
+        oe.F_REFLEC = 1
+        oe.FILE_REFL = str(tmpdir.join('prerefl.dat')).encode()
+        oe.FWRITE = 3
+        beam.traceOE(oe, 1)
+        return oe, beam.intensity(nolost=1)
+
+    write_prerefl(1e-4, 1e-7)
+    oe, expect = run()
+    assert oe.load_tables() == [('prerefl', str(tmpdir.join('prerefl.dat')))]
+    assert expect < 1000.0
+    assert run()[1] == expect
+    # same modification time (in seconds), other size
+    write_prerefl(2.5e-5, 1e-7)
+    assert run()[1] < expect, \
+        'A modified table must be read again'
+    # same size and same modification time, other contents
+    write_prerefl(1e-4, 1e-7)
+    expect = run()[1]
+    stat = os.stat(str(tmpdir.join('prerefl.dat')))
+    write_prerefl(3e-4, 1e-7)
+    assert os.path.getsize(str(tmpdir.join('prerefl.dat'))) == stat.st_size
+    os.utime(str(tmpdir.join('prerefl.dat')), ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    got = run()[1]
+    assert got != expect, 'A table rewritten in the same second must be read again'
+    Shadow.ShadowLib.clearTables()
+    assert run()[1] == got
+    Shadow.ShadowLib.clearTables()
+    with pytest.raises(ValueError):
+        Shadow.ShadowLib.loadTable('unknown', str(tmpdir.join('prerefl.dat')))
+
+
+def test_presurface_sidecar(tmpdir, monkeypatch):
+    import os
+    import numpy
+    import Shadow
+
+    mesh = str(tmpdir.join('mesh.dat'))
+
+    def write_mesh(height):
+        x = numpy.linspace(-2, 2, 21)
+        y = numpy.linspace(-10, 10, 31)
+        z = height * numpy.exp(-x[:, None] ** 2 - y[None, :] ** 2 / 20.0)
+        with open(mesh, 'w') as f:
+            f.write('%d %d\n' % (len(x), len(y)))
+            f.write(' '.join(['%.6e' % v for v in y]) + '\n')
+            for i in range(len(x)):
+                f.write(' '.join(['%.6e' % v for v in [x[i]] + list(z[i])]) + '\n')
+
+    write_mesh(1e-4)
+
+    src = Shadow.Source()
+    src.NPOINT = 1000
+    source = Shadow.Beam()
+    source.genSource(src)
+
+    def run():
+        Shadow.ShadowLib.clearTables()
+        beam = source.duplicate()
+        oe = Shadow.OE()
+        oe.FMIRR = 5
+        oe.T_INCIDENCE = oe.T_REFLECTION = 89.0
+        oe.F_RIPPLE = 1
+        oe.F_G_S = 2
+        oe.FILE_RIP = mesh.encode()
+        oe.FWRITE = 3
+        beam.traceOE(oe, 1)
+        return beam.rays
+
+    monkeypatch.delenv('SHADOW_SPLINE_SIDECAR', raising=False)
+    expect = run()
+    assert not tmpdir.join('mesh.dat.spl').exists()
+    monkeypatch.setenv('SHADOW_SPLINE_SIDECAR', '1')
+    assert numpy.array_equal(expect, run())
+    assert tmpdir.join('mesh.dat.spl').exists()
+    assert numpy.array_equal(expect, run()), \
+        'Spline read from the sidecar must match the computed one'
+    # other mesh of the same size, with the modification time of the sidecar
+    stat = os.stat(mesh)
+    write_mesh(2e-4)
+    assert os.path.getsize(mesh) == stat.st_size
+    os.utime(mesh, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    monkeypatch.delenv('SHADOW_SPLINE_SIDECAR')
+    expect = run()
+    monkeypatch.setenv('SHADOW_SPLINE_SIDECAR', '1')
+    assert numpy.array_equal(expect, run()), \
+        'A stale sidecar must not be used'
+
+
+def test_presurface_eval(tmpdir):
+    import numpy
+    import Shadow
+
+    mesh = str(tmpdir.join('mesh.dat'))
+    x = numpy.linspace(-2, 2, 21)
+    y = numpy.linspace(-10, 10, 31)
+    z = 1e-4 * numpy.exp(-x[:, None] ** 2 - y[None, :] ** 2 / 20.0)
+    with open(mesh, 'w') as f:
+        f.write('%d %d\n' % (len(x), len(y)))
+        f.write(' '.join([repr(v) for v in y]) + '\n')
+        for i in range(len(x)):
+            f.write(' '.join([repr(v) for v in [x[i]] + list(z[i])]) + '\n')
+
+    xx, yy = numpy.meshgrid(x, y, indexing='ij')
+    zs, dzdx, dzdy = Shadow.ShadowLib.presurfaceEval(mesh, xx, yy)
+    assert zs.shape == xx.shape
+    assert numpy.allclose(zs, z, rtol=0, atol=1e-12), \
+        'The spline must go through the mesh'
+    zs, dzdx, dzdy = Shadow.ShadowLib.presurfaceEval(mesh, [0.3, 3.0], [-1.0, 0.0])
+    assert numpy.isclose(dzdx[0], -2 * 0.3 * 1e-4 * numpy.exp(-0.09 - 0.05), rtol=1e-2)
+    assert numpy.isnan(zs[1]) and numpy.isnan(dzdy[1]), \
+        'Points out of the mesh must be nan'
+
+
+def test_screen_external(tmpdir):
+    import numpy
+    import Shadow
+
+    # checkerboard of squares of 0.01 cm
+    polys = str(tmpdir.join('polys.dat'))
+    squares = [(i, j) for i in range(-20, 20) for j in range(-20, 20) if (i + j) % 2 == 0]
+    with open(polys, 'w') as f:
+        f.write('%d\n' % len(squares))
+        for i, j in squares:
+            f.write('4\n')
+            for x, z in ((i, j), (i + 1, j), (i + 1, j + 1), (i, j + 1)):
+                f.write('%r %r\n' % (x * 0.01, z * 0.01))
+
+    src = Shadow.Source()
+    src.NPOINT = 5000
+    src.WXSOU = src.WZSOU = 0.5
+    source = Shadow.Beam()
+    source.genSource(src)
+
+    oe = Shadow.OE()
+    oe.FMIRR = 5
+    oe.T_INCIDENCE = oe.T_REFLECTION = 0.0
+    oe.T_SOURCE = oe.T_IMAGE = 0.0
+    oe.F_SCREEN = 1
+    oe.N_SCREEN = 1
+    oe.I_SCREEN[0] = oe.I_SLIT[0] = 1
+    oe.K_SLIT[0] = 2
+    file_scr_ext = oe.FILE_SCR_EXT.copy()
+    file_scr_ext[0] = polys.encode()
+    oe.FILE_SCR_EXT = file_scr_ext
+    oe.FWRITE = 3
+    assert oe.load_tables() == [('screen_external', polys)]
+    beam = source.duplicate()
+    beam.traceOE(oe, 1)
+    x = numpy.floor(source.rays[:, 0] / 0.01)
+    z = numpy.floor(source.rays[:, 2] / 0.01)
+    inside = ((x + z) % 2 == 0) & (x >= -20) & (x < 20) & (z >= -20) & (z < 20)
+    assert numpy.array_equal(beam.rays[:, 9] > 0, inside), \
+        'Only the rays inside the squares must pass the aperture'
+    Shadow.ShadowLib.clearTables()
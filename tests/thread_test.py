@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""Tracing from several python threads
+
+:copyright: Copyright (c) 2015 RadiaSoft LLC.  All Rights Reserved.
+:license: http://www.apache.org/licenses/LICENSE-2.0.html
+"""
+from __future__ import absolute_import, division, print_function
+
+import pytest
+
+def test_thread_pool():
+    from concurrent.futures import ThreadPoolExecutor
+    import numpy
+    import Shadow
+
+    src = Shadow.Source()
+    src.NPOINT = 2000
+    source = Shadow.Beam()
+    source.genSource(src)
+
+    def run(t_image):
+        beam = source.duplicate()
+        oe = Shadow.OE()
+        oe.T_IMAGE = t_image
+        # no star/mirr files, so reentrant kernels trace concurrently
+        oe.FWRITE = 3
+        beam.traceOE(oe, 1)
+        return beam.rays
+
+    distances = [1000.0 + 100.0 * i for i in range(4)]
+    expect = [run(d) for d in distances]
+    with ThreadPoolExecutor(max_workers=4) as e:
+        got = list(e.map(run, distances))
+    assert isinstance(Shadow.ShadowLib.isReentrant(), bool)
+    for x, y in zip(expect, got):
+        assert numpy.array_equal(x, y), \
+            'Threaded trace must match sequential trace'
+
+
+def test_parallel_ray_loop(monkeypatch):
+    import numpy
+    import Shadow
+
+    src = Shadow.Source()
+    src.NPOINT = 8000
+    source = Shadow.Beam()
+    source.genSource(src)
+
+    def run():
+        beam = source.duplicate()
+        oe = Shadow.OE()
+        oe.FMIRR = 1
+        oe.FHIT_C = 1
+        oe.FSHAPE = 1
+        oe.RWIDX1 = oe.RWIDX2 = 0.05
+        oe.RLEN1 = oe.RLEN2 = 0.1
+        oe.FWRITE = 3
+        beam.traceOE(oe, 1)
+        return beam.rays
+
+    monkeypatch.delenv('SHADOW_OMP_THREADS', raising=False)
+    expect = run()
+    monkeypatch.setenv('SHADOW_OMP_THREADS', '4')
+    assert numpy.array_equal(expect, run()), \
+        'Parallel ray loop must match sequential trace'
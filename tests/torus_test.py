@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""Intercepts of all the rays on a torus at once
+
+:copyright: Copyright (c) 2015 RadiaSoft LLC.  All Rights Reserved.
+:license: http://www.apache.org/licenses/LICENSE-2.0.html
+"""
+from __future__ import absolute_import, division, print_function
+
+import pytest
+
+def test_quartic_batch(monkeypatch):
+    import numpy
+    import Shadow
+
+    src = Shadow.Source()
+    src.NPOINT = 5000
+    src.FDISTR = 1
+    src.HDIV1 = src.HDIV2 = 0.004
+    src.VDIV1 = src.VDIV2 = 0.001
+    source = Shadow.Beam()
+    source.genSource(src)
+
+    def run(f_torus):
+        beam = source.duplicate()
+        oe = Shadow.OE()
+        oe.FMIRR = 3
+        oe.F_TORUS = f_torus
+        oe.T_INCIDENCE = oe.T_REFLECTION = 88.0
+        oe.F_EXT = 1
+        oe.R_MAJ = 3000.0
+        oe.R_MIN = 30.0
+        oe.FWRITE = 3
+        beam.traceOE(oe, 1)
+        return beam.rays
+
+    for f_torus in range(4):
+        monkeypatch.setenv('SHADOW_QUARTIC_REFERENCE', '1')
+        expect = run(f_torus)
+        monkeypatch.delenv('SHADOW_QUARTIC_REFERENCE')
+        got = run(f_torus)
+        assert numpy.array_equal(expect[:, 9], got[:, 9])
+        assert numpy.allclose(expect, got, rtol=0, atol=1e-8), \
+            'Batch intercepts must match ZRPOLY (F_TORUS={})'.format(f_torus)